@@ -0,0 +1,254 @@
+"""Benchmark genFcWsLoadFiles against a local GDC API stand-in on synthetic cohorts.
+
+For each requested cohort size, a synthetic fixture and matching manifest are generated, served by a
+gdc_stub_server running in this process, and the full genFcWsLoadFiles pipeline is run against it in a
+child process.  Wall time, GDC request count, bytes served, peak RSS of the child and the size of the
+load files it writes are reported.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid as uuidlib
+
+from fcgdctools.gdc_stub_server import FixtureStore, MANIFEST_COLUMNS, serve
+
+DEFAULT_SIZES = "1000,10000"
+
+# number of cases sharing each multi-case (deferred) MAF file
+CASES_PER_MAF = 10
+
+class _CohortBuilder():
+
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.store = FixtureStore()
+        self.num_files = 0
+
+    def uuid(self):
+        return str(uuidlib.UUID(int=self.rng.getrandbits(128), version=4))
+
+    def new_case(self, n, program, project_id):
+        if program == 'TCGA':
+            submitter_id = 'TCGA-{0:02d}-{1}'.format(n % 100, _base36(n, 4))
+        else:
+            submitter_id = 'C3L-{0:05d}'.format(n)
+        case = {'case_id' : self.uuid(), 'submitter_id' : submitter_id, 'primary_site' : 'Bronchus and lung',
+                'project' : {'project_id' : project_id, 'program' : {'name' : program}}, 'samples' : []}
+        self.store.add('cases', case)
+        return case
+
+    def new_sample(self, case, sample_type_id, sample_type, tissue_type, index=0):
+        if case['project']['program']['name'] == 'TCGA':
+            submitter_id = '{0}-{1}{2}'.format(case['submitter_id'], sample_type_id, 'ABCDEFGH'[index])
+        else:
+            submitter_id = '{0}-{1:02d}'.format(case['submitter_id'], len(case['samples']) + 1)
+            sample_type_id = None
+        sample = {'sample_id' : self.uuid(), 'submitter_id' : submitter_id, 'sample_type_id' : sample_type_id,
+                  'sample_type' : sample_type, 'tissue_type' : tissue_type, 'portions' : []}
+        case['samples'].append(sample)
+        return sample
+
+    def new_aliquot(self, sample, portion, analyte, plate):
+        if sample['sample_type_id'] is not None:
+            submitter_id = '{0}-{1:02d}{2}-{3}-07'.format(sample['submitter_id'], portion, analyte, plate)
+        else:
+            submitter_id = '{0}-{1:02d}{2}'.format(sample['submitter_id'], portion, analyte)
+        aliquot = {'aliquot_id' : self.uuid(), 'submitter_id' : submitter_id}
+        sample['portions'].append({'analytes' : [{'aliquots' : [aliquot]}]})
+        return aliquot
+
+    def add_file(self, cases_and_aliquots, data_category, data_type, data_format, experimental_strategy=None,
+                 workflow_type=None, file_name=None, with_index=False, access='open'):
+        # cases_and_aliquots: list of (case, [(sample, aliquot), ...] or None for case-level files)
+        file_id = self.uuid()
+        file_cases = []
+        for case, sample_aliquots in cases_and_aliquots:
+            file_case = {k : v for k, v in case.items() if k not in ('samples', 'primary_site')}
+            if sample_aliquots is not None:
+                file_case['samples'] = [dict({k : v for k, v in sample.items() if k != 'portions'},
+                                             portions=[{'analytes' : [{'aliquots' : [aliquot]}]}])
+                                        for sample, aliquot in sample_aliquots]
+            file_cases.append(file_case)
+        doc = {'file_id' : file_id, 'file_name' : file_name or '{0}.{1}'.format(file_id, data_format.lower()),
+               'md5sum' : uuidlib.UUID(int=self.rng.getrandbits(128)).hex, 'file_size' : self.rng.randint(10**3, 10**10),
+               'state' : 'released', 'access' : access, 'data_category' : data_category, 'data_type' : data_type,
+               'data_format' : data_format, 'cases' : file_cases}
+        if experimental_strategy is not None:
+            doc['experimental_strategy'] = experimental_strategy
+        if workflow_type is not None:
+            doc['analysis'] = {'workflow_type' : workflow_type}
+        if with_index:
+            doc['index_files'] = [{'file_id' : self.uuid(), 'file_name' : doc['file_name'] + '.bai', 'data_format' : 'BAI'}]
+        self.store.add('files', doc)
+        self.num_files += 1
+        return doc
+
+def _base36(n, width):
+    digits = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    s = ''
+    for _ in range(width):
+        n, d = divmod(n, 36)
+        s = digits[d] + s
+    return s
+
+def _add_tcga_case(builder, n):
+    case = builder.new_case(n, 'TCGA', 'TCGA-SYN')
+    tumor = builder.new_sample(case, '01', 'Primary Tumor', 'Tumor')
+    normal = builder.new_sample(case, '10', 'Blood Derived Normal', 'Normal')
+    plate = _base36(n % 1296, 2)
+    tumor_dna = builder.new_aliquot(tumor, 11, 'D', 'A0' + plate)
+    normal_dna = builder.new_aliquot(normal, 1, 'D', 'A0' + plate)
+    tumor_rna = builder.new_aliquot(tumor, 11, 'R', 'A1' + plate)
+
+    # single-case, case-level files
+    builder.add_file([(case, None)], 'Clinical', 'Clinical Supplement', 'BCR XML',
+                     file_name='nationwidechildrens.org_clinical.{0}.xml'.format(case['submitter_id']))
+    builder.add_file([(case, None)], 'Biospecimen', 'Biospecimen Supplement', 'BCR XML',
+                     file_name='nationwidechildrens.org_biospecimen.{0}.xml'.format(case['submitter_id']))
+    # single-sample files
+    for sample, aliquot in [(tumor, tumor_dna), (normal, normal_dna)]:
+        builder.add_file([(case, [(sample, aliquot)])], 'Sequencing Reads', 'Aligned Reads', 'BAM', 'WXS',
+                         'BWA with Mark Duplicates and Cocleaning', with_index=True, access='controlled')
+    builder.add_file([(case, [(tumor, tumor_rna)])], 'Transcriptome Profiling', 'Gene Expression Quantification', 'TXT',
+                     'RNA-Seq', 'HTSeq - Counts')
+    # tumor/normal pair file
+    builder.add_file([(case, [(tumor, tumor_dna), (normal, normal_dna)])], 'Simple Nucleotide Variation',
+                     'Raw Simple Somatic Mutation', 'VCF', 'WXS', 'MuTect2', access='controlled')
+    # slide image
+    builder.add_file([(case, [(tumor, tumor_dna)])], 'Biospecimen', 'Slide Image', 'SVS', 'Tissue Slide',
+                     file_name='{0}-01-TS1.{1}.svs'.format(tumor['submitter_id'], builder.uuid()))
+
+    # replicate collisions
+    if n % 5 == 0:
+        replicate_rna = builder.new_aliquot(tumor, 21, 'R', 'A2' + plate)
+        builder.add_file([(case, [(tumor, replicate_rna)])], 'Transcriptome Profiling', 'Gene Expression Quantification', 'TXT',
+                         'RNA-Seq', 'HTSeq - Counts')
+    if n % 7 == 0:
+        builder.add_file([(case, [(tumor, tumor_dna)])], 'Biospecimen', 'Slide Image', 'SVS', 'Tissue Slide',
+                         file_name='{0}-02-TS1.{1}.svs'.format(tumor['submitter_id'], builder.uuid()))
+    return case, [(tumor, tumor_dna), (normal, normal_dna)]
+
+def _add_cptac_case(builder, n):
+    # CPTAC pools several specimens of a patient when one doesn't provide enough material
+    case = builder.new_case(n, 'CPTAC', 'CPTAC-3')
+    tumors = [builder.new_sample(case, None, 'Primary Tumor', 'Tumor', i) for i in range(2)]
+    normal = builder.new_sample(case, None, 'Blood Derived Normal', 'Normal')
+    tumor_aliquots = [(tumor, builder.new_aliquot(tumor, 1, 'D', None)) for tumor in tumors]
+    normal_aliquot = (normal, builder.new_aliquot(normal, 1, 'D', None))
+
+    builder.add_file([(case, None)], 'Clinical', 'Clinical Supplement', 'BCR XML',
+                     file_name='clinical.{0}.xml'.format(case['submitter_id']))
+    builder.add_file([(case, tumor_aliquots)], 'Sequencing Reads', 'Aligned Reads', 'BAM', 'WXS',
+                     'BWA with Mark Duplicates and Cocleaning', with_index=True, access='controlled')
+    builder.add_file([(case, [normal_aliquot])], 'Sequencing Reads', 'Aligned Reads', 'BAM', 'WXS',
+                     'BWA with Mark Duplicates and Cocleaning', with_index=True, access='controlled')
+    builder.add_file([(case, tumor_aliquots + [normal_aliquot])], 'Simple Nucleotide Variation',
+                     'Raw Simple Somatic Mutation', 'VCF', 'WXS', 'MuTect2', access='controlled')
+
+def synthesize_cohort(num_files, seed=0):
+    """Generate a FixtureStore of about num_files files mixing single-case files, tumor/normal pairs,
+    CPTAC pooled samples, multi-case (deferred) files, replicate collisions and slide images.
+    """
+    builder = _CohortBuilder(seed)
+    maf_group = []
+    n = 0
+    while builder.num_files < num_files:
+        if n % 8 == 7:
+            _add_cptac_case(builder, n)
+        else:
+            case, sample_aliquots = _add_tcga_case(builder, n)
+            maf_group.append((case, sample_aliquots))
+        if len(maf_group) == CASES_PER_MAF:
+            # multi-case file, processed after all single-case files
+            builder.add_file(maf_group, 'Simple Nucleotide Variation', 'Masked Somatic Mutation', 'MAF', 'WXS',
+                             'MuTect2 Variant Aggregation and Masking')
+            maf_group = []
+        n += 1
+    return builder.store
+
+def write_manifest(store, path):
+    with open(path, 'w') as fp:
+        fp.write('\t'.join(MANIFEST_COLUMNS) + '\n')
+        for doc in store.values('files'):
+            fp.write('\t'.join([doc['file_id'], doc['file_name'], doc['md5sum'], str(doc['file_size']), doc['state']]) + '\n')
+
+def run_benchmark(num_files, work_dir, loadfiles_args=(), latency=0.0, error_rate=0.0, seed=0):
+    """Run genFcWsLoadFiles on a synthetic cohort of num_files files and return its measurements."""
+    store = synthesize_cohort(num_files, seed)
+    manifest = os.path.join(work_dir, 'bench_{0}.tsv'.format(num_files))
+    write_manifest(store, manifest)
+
+    server = serve(store, latency=latency, error_rate=error_rate, seed=seed)
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([package_root] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+    command = [sys.executable, '-m', 'fcgdctools.fc_loadfiles', os.path.basename(manifest),
+               '--gdc_api_root', server.url, '--no_cache'] + list(loadfiles_args)
+    try:
+        with open(os.path.join(work_dir, 'bench_{0}.log'.format(num_files)), 'w') as log:
+            start = time.time()
+            process = subprocess.Popen(command, cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+            _, status, rusage = os.wait4(process.pid, 0)
+            wall_time = time.time() - start
+            # like Popen.returncode: the exit status, or minus the number of the signal that ended the process
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    basename = os.path.splitext(os.path.basename(manifest))[0]
+    output_bytes = sum(os.path.getsize(os.path.join(work_dir, f)) for f in os.listdir(work_dir)
+                       if f.startswith(basename + '_') and f.endswith('.tsv'))
+    return {'files' : len(store.documents['files']), 'cases' : len(store.documents['cases']),
+            'exit_code' : process.returncode, 'wall_time' : wall_time,
+            'requests' : server.total_requests, 'bytes_served' : server.bytes_sent,
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_mb' : rusage.ru_maxrss / 1024.0, 'output_bytes' : output_bytes}
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark genFcWsLoadFiles on synthetic GDC manifests served by a local GDC API stand-in',
+                                     epilog='arguments after -- are passed to genFcWsLoadFiles')
+    parser.add_argument("-s", "--sizes", help="comma-separated numbers of manifest files to benchmark (default: {0})".format(DEFAULT_SIZES),
+                        default=DEFAULT_SIZES)
+    parser.add_argument("--latency", help="seconds the stand-in adds to every response", type=float, default=0.0)
+    parser.add_argument("--error_rate", help="fraction of requests the stand-in answers with a 503", type=float, default=0.0)
+    parser.add_argument("--seed", help="random seed for the synthetic cohorts", type=int, default=0)
+    parser.add_argument("-o", "--output", help="write the results as JSON to this file")
+    parser.add_argument("-k", "--keep", help="keep the working directory with manifests, logs and load files", action="store_true")
+    argv = sys.argv[1:]
+    loadfiles_args = []
+    if '--' in argv:
+        loadfiles_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix='fcgdctools_bench_')
+    results = []
+    print("{0:>8} {1:>8} {2:>6} {3:>10} {4:>9} {5:>12} {6:>12} {7:>12}".format(
+        'files', 'cases', 'exit', 'wall (s)', 'requests', 'served (MB)', 'peak RSS (MB)', 'output (MB)'))
+    try:
+        for size in [int(s) for s in args.sizes.split(',')]:
+            result = run_benchmark(size, work_dir, loadfiles_args, args.latency, args.error_rate, args.seed)
+            results.append(result)
+            print("{0:>8} {1:>8} {2:>6} {3:>10.2f} {4:>9} {5:>12.2f} {6:>12.1f} {7:>12.2f}".format(
+                result['files'], result['cases'], result['exit_code'], result['wall_time'], result['requests'],
+                result['bytes_served'] / 2.0**20, result['peak_rss_mb'], result['output_bytes'] / 2.0**20))
+            sys.stdout.flush()
+    finally:
+        if args.keep:
+            print("working directory: {0}".format(work_dir))
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({'loadfiles_args' : loadfiles_args, 'results' : results}, fp, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+import collections
+import collections.abc
+import json
+import os
+import sqlite3
+import tempfile
+
+from fcgdctools.entity_table import EntityTable, Entity, _entity_key, _entity_id
+from fcgdctools.run_journal import JournaledTable
+
+STORES = ['memory', 'disk']
+
+DEFAULT_CACHE_ENTITIES = 100000
+
+# number of entities or keys read from the database at a time when visiting all of them
+SCAN_BATCH_SIZE = 1000
+
+class EntityStore():
+    """Scratch SQLite database holding the entity tables and per-file mappings of a run too large to
+    keep in memory.
+
+    The database is a temporary file, removed by close().  It is not meant to survive the run: the
+    run journal, not the store, is what an interrupted run is resumed from, so it is written without
+    a rollback journal or fsyncs.
+    """
+
+    def __init__(self, directory=None):
+        fd, self.path = tempfile.mkstemp(prefix='fcgdctools_store_', suffix='.sqlite', dir=directory)
+        os.close(fd)
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute("PRAGMA journal_mode=OFF")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute("""CREATE TABLE entities (
+                                  name TEXT NOT NULL,
+                                  id TEXT NOT NULL,
+                                  value TEXT NOT NULL,
+                                  PRIMARY KEY (name, id)) WITHOUT ROWID""")
+        self._conn.execute("""CREATE TABLE mappings (
+                                  name TEXT NOT NULL,
+                                  key TEXT NOT NULL,
+                                  value TEXT NOT NULL,
+                                  PRIMARY KEY (name, key)) WITHOUT ROWID""")
+
+    def table(self, kind, name=None, cache_size=DEFAULT_CACHE_ENTITIES, journaled=False):
+        """A new, empty table of entities of the given kind, stored under name (default: kind)."""
+        table_class = JournaledDiskEntityTable if journaled else DiskEntityTable
+        return table_class(kind, store=self, name=name, cache_size=cache_size)
+
+    def mapping(self, name):
+        """A new, empty mapping of string keys to JSON-serializable values."""
+        return DiskMapping(self, name)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            os.remove(self.path)
+
+class DiskEntityTable(EntityTable):
+    """EntityTable whose entities are stored in an EntityStore, with an in-memory write-back cache of
+    the cache_size most recently used ones.
+
+    Entities, entity ids and keys() are visited in entity id order.
+    """
+
+    def __init__(self, kind, store, name=None, cache_size=DEFAULT_CACHE_ENTITIES):
+        super().__init__(kind)
+        self.name = name if name is not None else kind
+        self.cache_size = cache_size
+        self._conn = store._conn
+        self._entities = collections.OrderedDict()
+        self._dirty = set()
+        self._conn.execute("DELETE FROM entities WHERE name=?", (self.name,))
+
+    def _read(self, key):
+        row = self._conn.execute("SELECT value FROM entities WHERE name=? AND id=?", (self.name, _entity_id(key))).fetchone()
+        return Entity(json.loads(row[0])) if row is not None else None
+
+    def _write(self, keys):
+        self._conn.executemany("INSERT OR REPLACE INTO entities VALUES (?, ?, ?)",
+                               ((self.name, _entity_id(key), json.dumps(dict(self._entities[key]), separators=(',', ':'))) for key in keys))
+
+    def _load(self, key):
+        entity = self._entities.get(key)
+        if entity is not None:
+            self._entities.move_to_end(key)
+            return entity
+        entity = self._read(key)
+        if entity is not None:
+            self._cache(key, entity)
+        return entity
+
+    def _store(self, key, entity):
+        self._dirty.add(key)
+        self._cache(key, entity)
+
+    def _cache(self, key, entity):
+        self._entities[key] = entity
+        self._entities.move_to_end(key)
+        if len(self._entities) > self.cache_size:
+            # evict down to 90% of the cache size, so that we don't evict on every subsequent access
+            evicted = [key for key, _ in zip(self._entities, range(len(self._entities) - int(self.cache_size * 0.9)))]
+            self._write([key for key in evicted if key in self._dirty])
+            for key in evicted:
+                self._dirty.discard(key)
+                del self._entities[key]
+
+    def _discard(self, key):
+        self._entities.pop(key, None)
+        self._dirty.discard(key)
+        self._conn.execute("DELETE FROM entities WHERE name=? AND id=?", (self.name, _entity_id(key)))
+
+    def flush(self):
+        """Write the changed entities in the cache to the store."""
+        self._write(self._dirty)
+        self._dirty.clear()
+
+    def _scan(self, columns):
+        # rows of all entities in id order, read in batches so that the table can be changed while visited
+        self.flush()
+        last = ''
+        while True:
+            rows = self._conn.execute("SELECT id, {0} FROM entities WHERE name=? AND id>? ORDER BY id LIMIT ?".format(columns),
+                                      (self.name, last, SCAN_BATCH_SIZE)).fetchall()
+            yield from rows
+            if len(rows) < SCAN_BATCH_SIZE:
+                return
+            last = rows[-1][0]
+
+    def __len__(self):
+        self.flush()
+        return self._conn.execute("SELECT COUNT(*) FROM entities WHERE name=?", (self.name,)).fetchone()[0]
+
+    def __iter__(self):
+        return (entity_id for entity_id, _ in self._scan('NULL'))
+
+    def items(self):
+        for entity_id, value in self._scan('value'):
+            # entities changed since the batch was read are in the cache
+            entity = self._entities.get(_entity_key(entity_id))
+            yield entity_id, entity if entity is not None else Entity(json.loads(value))
+
+    def values(self):
+        return (entity for _, entity in self.items())
+
+    def sorted_keys(self):
+        return iter(self)
+
+    def sorted_items(self):
+        return self.items()
+
+    def clear(self):
+        self._entities.clear()
+        self._dirty.clear()
+        self.columns.clear()
+        self._conn.execute("DELETE FROM entities WHERE name=?", (self.name,))
+
+class JournaledDiskEntityTable(JournaledTable, DiskEntityTable):
+    pass
+
+class DiskMapping(collections.abc.MutableMapping):
+    """Mapping of string keys to JSON-serializable values stored in an EntityStore."""
+
+    def __init__(self, store, name):
+        self.name = name
+        self._conn = store._conn
+        self._conn.execute("DELETE FROM mappings WHERE name=?", (self.name,))
+
+    def __getitem__(self, key):
+        row = self._conn.execute("SELECT value FROM mappings WHERE name=? AND key=?", (self.name, key)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __contains__(self, key):
+        return self._conn.execute("SELECT 1 FROM mappings WHERE name=? AND key=?", (self.name, key)).fetchone() is not None
+
+    def __setitem__(self, key, value):
+        self._conn.execute("INSERT OR REPLACE INTO mappings VALUES (?, ?, ?)", (self.name, key, json.dumps(value)))
+
+    def __delitem__(self, key):
+        if self._conn.execute("DELETE FROM mappings WHERE name=? AND key=?", (self.name, key)).rowcount == 0:
+            raise KeyError(key)
+
+    def __iter__(self):
+        last = ''
+        while True:
+            keys = [row[0] for row in self._conn.execute("SELECT key FROM mappings WHERE name=? AND key>? ORDER BY key LIMIT ?",
+                                                         (self.name, last, SCAN_BATCH_SIZE))]
+            yield from keys
+            if len(keys) < SCAN_BATCH_SIZE:
+                return
+            last = keys[-1]
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM mappings WHERE name=?", (self.name,)).fetchone()[0]
@@ -0,0 +1,271 @@
+import array
+import collections.abc
+import re
+import sys
+
+DRS_URL_PREFIX = "drs://dataguids.org/"
+
+# prefixes of the uuid-valued strings that entities store as bytes, see _uuid_ref()
+UUID_PREFIXES = ['', DRS_URL_PREFIX]
+
+_UUID = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+# one byte of prefix index, 16 bytes of uuid
+_UUID_REF_SIZE = 17
+
+def _uuid_ref(value):
+    # the bytes encoding of a string made of one of UUID_PREFIXES and a lowercase uuid; None for any other value
+    if isinstance(value, str):
+        for index, prefix in enumerate(UUID_PREFIXES):
+            if len(value) == len(prefix) + 36 and value.startswith(prefix) and _UUID.fullmatch(value, len(prefix)):
+                return bytes((index,)) + bytes.fromhex(value[len(prefix):].replace('-', ''))
+    return None
+
+def _format_uuid(digits):
+    return '{0}-{1}-{2}-{3}-{4}'.format(digits[:8], digits[8:12], digits[12:16], digits[16:20], digits[20:])
+
+def _uuid_ref_string(ref):
+    return UUID_PREFIXES[ref[0]] + _format_uuid(ref[1:].hex())
+
+def _entity_key(entity_id):
+    # uuid entity ids are stored as their 128-bit integer value
+    if isinstance(entity_id, str) and len(entity_id) == 36 and _UUID.fullmatch(entity_id):
+        return int(entity_id.replace('-', ''), 16)
+    return entity_id
+
+def _entity_id(key):
+    if type(key) is int:
+        return _format_uuid('{0:032x}'.format(key))
+    return key
+
+# attribute names are stored as indexes into _ATTRIBUTE_NAMES, shared by all tables
+_ATTRIBUTE_NAMES = []
+_ATTRIBUTE_NAME_IDS = dict()
+
+def _attribute_name_id(attribute_name, add=False):
+    name_id = _ATTRIBUTE_NAME_IDS.get(attribute_name)
+    if name_id is None and add:
+        name_id = len(_ATTRIBUTE_NAMES)
+        _ATTRIBUTE_NAMES.append(sys.intern(attribute_name))
+        _ATTRIBUTE_NAME_IDS[_ATTRIBUTE_NAMES[name_id]] = name_id
+    return name_id
+
+class Entity(collections.abc.Mapping):
+    """Read-only mapping of attribute name -> value for one entity, stored compactly.
+
+    Attribute names are kept as ids in an array.  Values that are uuids or DRS URLs are packed into a 
+    single bytes object and the value list holds their (int) position in it; DRS URLs are only built 
+    again when the value is read, e.g. when the load files are written.  Other values, strings or None, 
+    are kept as is, interned.
+    """
+
+    __slots__ = ('_name_ids', '_values', '_refs')
+
+    def __init__(self, attributes=()):
+        self._name_ids = array.array('I')
+        self._values = []
+        self._refs = b''
+        for attribute_name, value in dict(attributes).items():
+            self._set(attribute_name, value)
+
+    def _index(self, attribute_name):
+        name_id = _attribute_name_id(attribute_name)
+        if name_id is None:
+            return -1
+        try:
+            return self._name_ids.index(name_id)
+        except ValueError:
+            return -1
+
+    def _value(self, stored):
+        if type(stored) is int:
+            offset = stored * _UUID_REF_SIZE
+            return _uuid_ref_string(self._refs[offset:offset + _UUID_REF_SIZE])
+        return stored
+
+    def _set(self, attribute_name, value):
+        # returns True if the entity did not have the attribute yet
+        index = self._index(attribute_name)
+        ref = _uuid_ref(value)
+        if ref is not None:
+            if index >= 0 and type(self._values[index]) is int:
+                offset = self._values[index] * _UUID_REF_SIZE
+                self._refs = self._refs[:offset] + ref + self._refs[offset + _UUID_REF_SIZE:]
+                return False
+            value = len(self._refs) // _UUID_REF_SIZE
+            self._refs += ref
+        elif isinstance(value, str):
+            value = sys.intern(value)
+        if index >= 0:
+            self._values[index] = value
+            return False
+        self._name_ids.append(_attribute_name_id(attribute_name, add=True))
+        self._values.append(value)
+        return True
+
+    def _delete(self, attribute_name):
+        # returns True if the entity had the attribute; a deleted uuid stays in _refs, unreferenced
+        index = self._index(attribute_name)
+        if index < 0:
+            return False
+        del self._name_ids[index]
+        del self._values[index]
+        return True
+
+    def __getitem__(self, attribute_name):
+        index = self._index(attribute_name)
+        if index < 0:
+            raise KeyError(attribute_name)
+        return self._value(self._values[index])
+
+    def __contains__(self, attribute_name):
+        return self._index(attribute_name) >= 0
+
+    def __iter__(self):
+        return (_ATTRIBUTE_NAMES[name_id] for name_id in self._name_ids)
+
+    def __len__(self):
+        return len(self._name_ids)
+
+    def lookup(self, attribute_names, default):
+        """Values of the given attributes, with default for those the entity doesn't have."""
+        values = dict(zip(self._name_ids, self._values))
+        return [self._value(values.get(_ATTRIBUTE_NAME_IDS.get(attribute_name), default)) for attribute_name in attribute_names]
+
+    def __eq__(self, other):
+        if isinstance(other, Entity):
+            return (dict(zip(self._name_ids, map(self._value, self._values))) ==
+                    dict(zip(other._name_ids, map(other._value, other._values))))
+        return super().__eq__(other)
+
+    def __repr__(self):
+        return 'Entity({0!r})'.format(dict(self))
+
+class EntityTable(collections.abc.MutableMapping):
+    """Mapping of entity id -> Entity for the entities of one kind, e.g. participant, with a registry of
+    the attribute names in use.
+
+    Entities are stored by assigning a dict of their attributes, and their attributes set and deleted with
+    set_attribute() and delete_attribute().  The registry keeps the attribute names in the order they first
+    appeared, with the number of entities that have each, so that load file columns are known without
+    scanning the entities.  Entity ids that are uuids are stored as integers.
+
+    Entities are kept in memory; subclasses can store them elsewhere by overriding _load(), _store(), 
+    _discard() and the methods that visit all entities.
+    """
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.columns = dict()
+        self._entities = dict()
+
+    def _load(self, key):
+        return self._entities.get(key)
+
+    def _store(self, key, entity):
+        # called after an entity is created or changed
+        self._entities[key] = entity
+
+    def _discard(self, key):
+        del self._entities[key]
+
+    def __len__(self):
+        return len(self._entities)
+
+    def __iter__(self):
+        return (_entity_id(key) for key in self._entities)
+
+    def __contains__(self, entity_id):
+        return self._load(_entity_key(entity_id)) is not None
+
+    def __getitem__(self, entity_id):
+        entity = self._load(_entity_key(entity_id))
+        if entity is None:
+            raise KeyError(entity_id)
+        return entity
+
+    def __setitem__(self, entity_id, attributes):
+        key = _entity_key(entity_id)
+        previous = self._load(key)
+        if previous is not None:
+            self._unregister(previous)
+        entity = Entity(attributes)
+        for attribute_name in entity:
+            self.columns[attribute_name] = self.columns.get(attribute_name, 0) + 1
+        self._store(key, entity)
+
+    def __delitem__(self, entity_id):
+        self._unregister(self[entity_id])
+        self._discard(_entity_key(entity_id))
+
+    def clear(self):
+        self._entities.clear()
+        self.columns.clear()
+
+    def items(self):
+        return ((_entity_id(key), entity) for key, entity in self._entities.items())
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return self._entities.values()
+
+    def sorted_keys(self):
+        """Ids of all entities, in id order."""
+        return iter(sorted(self))
+
+    def sorted_items(self):
+        """(entity id, entity) of all entities, in entity id order."""
+        return iter(sorted(self.items(), key=lambda item: item[0]))
+
+    def peek(self, entity_id):
+        """The entity, or None; unlike table[entity_id], never overridden to record the access."""
+        return self._load(_entity_key(entity_id))
+
+    def restore(self, entity_id, attributes):
+        """Store an entity read back from a journal; unlike table[entity_id] = ..., never overridden to record the access."""
+        EntityTable.__setitem__(self, entity_id, attributes)
+
+    def restore_change(self, entity_id, change):
+        """Apply a change read back from a journal, see JournaledTable; like restore(), never overridden to record the access."""
+        key = _entity_key(entity_id)
+        entity = self._load(key)
+        if change.get('gone'):
+            if entity is not None:
+                self._unregister(entity)
+                self._discard(key)
+            return
+        if change.get('new') or entity is None:
+            EntityTable.__setitem__(self, entity_id, change.get('set', {}))
+            return
+        for attribute_name, value in change.get('set', {}).items():
+            EntityTable.set_attribute(self, entity_id, attribute_name, value)
+        for attribute_name in change.get('del', ()):
+            EntityTable.delete_attribute(self, entity_id, attribute_name)
+
+    def _unregister(self, entity):
+        for attribute_name in entity:
+            self.columns[attribute_name] -= 1
+
+    def set_attribute(self, entity_id, attribute_name, value):
+        key = _entity_key(entity_id)
+        entity = self._load(key)
+        if entity is None:
+            raise KeyError(entity_id)
+        if entity._set(attribute_name, value):
+            self.columns[attribute_name] = self.columns.get(attribute_name, 0) + 1
+        self._store(key, entity)
+
+    def delete_attribute(self, entity_id, attribute_name):
+        key = _entity_key(entity_id)
+        entity = self._load(key)
+        if entity is None:
+            raise KeyError(entity_id)
+        if entity._delete(attribute_name):
+            self.columns[attribute_name] -= 1
+            self._store(key, entity)
+
+    def attribute_names(self, exclude=()):
+        """Names of the attributes that at least one entity has, in the order they first appeared."""
+        return [attribute_name for attribute_name, count in self.columns.items() if count > 0 and attribute_name not in exclude]
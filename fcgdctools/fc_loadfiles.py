@@ -1,19 +1,63 @@
+import collections
+import concurrent.futures
 import csv
-import requests
+import functools
+import itertools
+import json
 import argparse
+import bz2
+import gzip
+import heapq
+import io
 import pprint
 import os.path
 import sys
-import time
+import threading
 import traceback
 
+import requests
+
+from fcgdctools.gdc_session import configure_session, get_session, AdaptiveRateController
+from fcgdctools.gdc_session import DEFAULT_POOL_SIZE, DEFAULT_RETRIES, DEFAULT_MAX_RATE, DEFAULT_INITIAL_RATE, DEFAULT_TARGET_LATENCY
+from fcgdctools.metadata_cache import MetadataCache, DEFAULT_CACHE_DIR, DEFAULT_TTL_HOURS, DEFAULT_MAX_SIZE_MB
+from fcgdctools.metadata_bundle import MetadataBundle
+from fcgdctools.run_stats import STATS, STATS_FORMATS
+from fcgdctools.run_journal import RunJournal, JournaledTable, DEFAULT_CHECKPOINT_INTERVAL
+from fcgdctools.entity_table import EntityTable, Entity, DRS_URL_PREFIX
+from fcgdctools.entity_store import EntityStore, STORES, DEFAULT_CACHE_ENTITIES
+
 UUID_TO_FILENAME = dict()
 
 DEFERRED_FILE_NUM_OF_CASES = dict()
 
+# metadata of each file associated with multiple cases, kept until the deferred files are processed
+DEFERRED_FILE_METADATA = dict()
+
+# uuids of the index files of BAM files, as reported in the BAMs' file metadata
+BAM_INDEX_FILE_UUIDS = dict()
+
+# (tumor/normal classification, aliquot submitter id) of the samples of each file's case, used to
+# choose between files that map to the same attribute
+FILE_ALIQUOTS = dict()
+
+# (entity id, attribute name) of each attribute a file was a candidate for, whether or not it was chosen
+FILE_ATTRIBUTE_SLOTS = dict()
+
+# (data category, data type, program) of each file that was a candidate for an attribute
+FILE_CLASSIFICATIONS = dict()
+
+# (entity id, attribute name) -> (entity table, BAM uuid) for BAI attributes still to be resolved
+PENDING_INDEX_FILE_ATTRIBUTES = dict()
+
 GDC_API_ROOT = "https://api.gdc.cancer.gov"
 GDC_LEGACY_API_ROOT = "https://api.gdc.cancer.gov/legacy"
 
+# persistent cache of GDC responses shared by all retrievers, or the MetadataBundle answering them; None disables caching
+METADATA_CACHE = None
+
+# in-memory case -> sample -> aliquot graph of the manifest's projects; None disables biospecimen prefetch
+BIOSPECIMEN_INDEX = None
+
 #program
 class GDC_ProgramName:
     TARGET = 'TARGET'
@@ -207,12 +251,22 @@ class MetadataRetriever():
         self.api_endpoint = api_endpoint
 
     def get_metadata(self, uuid):
-        url = "{0}/{1}/{2}?fields={3}".format(self.gdc_api_root, self.api_endpoint, uuid, self.fields)
+        endpoint = "{0}/{1}".format(self.gdc_api_root, self.api_endpoint)
+        if METADATA_CACHE is not None:
+            cached = METADATA_CACHE.get(endpoint, uuid, self.fields)
+            if cached is not None:
+                return cached
+
+        url = "{0}/{1}?fields={2}".format(endpoint, uuid, self.fields)
         #debug
         #print('url: {0}'.format(url))
-        response = requests.get(url, headers=None, timeout=5)
+        response = get_session().get(url, headers=None, timeout=5)
         responseDict = response.json()
-        return responseDict['data']
+        metadata = responseDict['data']
+
+        if METADATA_CACHE is not None:
+            METADATA_CACHE.put(endpoint, uuid, self.fields, metadata)
+        return metadata
 
 class FileCaseMetadataRetriever(MetadataRetriever):
     def __init__(self, gdc_api_root):
@@ -241,26 +295,336 @@ class IndexFileUuidRetriever():
         self.gdc_api_root = gdc_api_root
 
     def get_index_uuid(self, bam_uuid):
-        url = "{0}/files/{1}?expand=index_files".format(self.gdc_api_root, bam_uuid)
-        response = requests.get(url, headers=None, timeout=5)
-        responseDict = response.json()
-        indexFilesList = responseDict['data']['index_files']
+        endpoint = "{0}/files".format(self.gdc_api_root)
+        indexFilesList = None
+        if METADATA_CACHE is not None:
+            indexFilesList = METADATA_CACHE.get(endpoint, bam_uuid, "expand=index_files")
+
+        if indexFilesList is None:
+            url = "{0}/{1}?expand=index_files".format(endpoint, bam_uuid)
+            response = get_session().get(url, headers=None, timeout=5)
+            responseDict = response.json()
+            indexFilesList = responseDict['data']['index_files']
+            if METADATA_CACHE is not None:
+                METADATA_CACHE.put(endpoint, bam_uuid, "expand=index_files", indexFilesList)
+
         assert(len(indexFilesList) == 1)
         return(indexFilesList[0]['file_id'])
-       
-SEPARATOR = '/'
-DRS_URL_ATTRIBUTE_SUFFIX = "drs_url"
 
-def _read_manifestFile(manifestFile):
+class FileBatchMetadataRetriever():
+    # union of the fields requested by FileMetadataRetriever, FileCaseMetadataRetriever and
+    # FileCaseSampleMetadataRetriever, so that a single query answers all three for a batch of files
+    FIELDS = ["file_id", "data_category", "data_type", "data_format", "access", "experimental_strategy",
+              "analysis.workflow_type", "cases.project.program.name",
+              "cases.case_id", "cases.submitter_id", "cases.project.project_id", "cases.tissue_source_site",
+              "cases.samples.sample_id", "cases.samples.submitter_id", "cases.samples.sample_type_id",
+              "cases.samples.sample_type", "cases.samples.tissue_type",
+              "cases.samples.portions.analytes.aliquots.submitter_id", "index_files.file_id"]
+
+    # fields requested when case, sample and aliquot details are joined from the BiospecimenIndex instead
+    JOINED_FIELDS = ["file_id", "data_category", "data_type", "data_format", "access", "experimental_strategy",
+                     "analysis.workflow_type", "cases.project.program.name",
+                     "cases.case_id", "cases.project.project_id", "cases.samples.sample_id",
+                     "cases.samples.portions.analytes.aliquots.aliquot_id", "index_files.file_id"]
+
+    # fields requested when resolving index files of BAMs whose metadata was not retrieved in a batch
+    INDEX_FILE_FIELDS = ["file_id", "index_files.file_id"]
+
+    def __init__(self, gdc_api_root, fields=FIELDS):
+        self.gdc_api_root = gdc_api_root
+        self.fields = ','.join(fields)
+
+    def get_metadata(self, uuids):
+        url = "{0}/files".format(self.gdc_api_root)
+        batchMetadata = dict()
+        if METADATA_CACHE is not None:
+            batchMetadata.update(METADATA_CACHE.get_many(url, uuids, self.fields))
+            uuids = [uuid for uuid in uuids if uuid not in batchMetadata]
+        # files missing from a metadata bundle are not fetched; each fails on its own in the per-file lookups
+        if len(uuids) == 0 or isinstance(METADATA_CACHE, MetadataBundle):
+            return batchMetadata
+
+        filters = {"op" : "in", "content" : {"field" : "file_id", "value" : list(uuids)}}
+        params = {"filters" : filters, "fields" : self.fields, "format" : "JSON", "size" : len(uuids)}
+        response = get_session().post(url, data=json.dumps(params), headers={"Content-Type" : "application/json"}, timeout=60)
+        response.raise_for_status()
+        responseDict = response.json()
+        fetched = {hit['file_id'] : hit for hit in responseDict['data']['hits']}
+
+        if METADATA_CACHE is not None:
+            METADATA_CACHE.put_many(url, fetched, self.fields)
+        batchMetadata.update(fetched)
+        return batchMetadata
 
-    manifestFileList = []
+class ProjectBiospecimenRetriever():
+    FIELDS = ["case_id", "submitter_id", "primary_site", "project.project_id",
+              "samples.sample_id", "samples.submitter_id", "samples.sample_type_id", "samples.sample_type", "samples.tissue_type",
+              "samples.portions.analytes.aliquots.aliquot_id", "samples.portions.analytes.aliquots.submitter_id"]
 
-    with open(manifestFile, 'r') as fp:
-        reader = csv.DictReader(fp, delimiter='\t')
-        for row in reader:
-            manifestFileList.append(row)
+    def __init__(self, gdc_api_root, page_size):
+        self.gdc_api_root = gdc_api_root
+        self.page_size = page_size
+        self.fields = ','.join(self.FIELDS)
+
+    @STATS.timed('biospecimen_prefetch')
+    def get_cases(self, project_id):
+        # retrieves the biospecimen tree of every case in the project, page_size cases per query
+        url = "{0}/cases".format(self.gdc_api_root)
+        cache_key = "project:" + project_id
+        if METADATA_CACHE is not None:
+            cached = METADATA_CACHE.get(url, cache_key, self.fields)
+            if cached is not None:
+                return cached
+
+        filters = {"op" : "in", "content" : {"field" : "project.project_id", "value" : [project_id]}}
+        cases = []
+        total = None
+        while total is None or len(cases) < total:
+            params = {"filters" : filters, "fields" : self.fields, "format" : "JSON",
+                      "from" : len(cases), "size" : self.page_size, "sort" : "case_id:asc"}
+            response = get_session().post(url, data=json.dumps(params), headers={"Content-Type" : "application/json"}, timeout=60)
+            responseDict = response.json()
+            hits = responseDict['data']['hits']
+            total = responseDict['data']['pagination']['total']
+            if len(hits) == 0:
+                break
+            cases.extend(hits)
+
+        if METADATA_CACHE is not None:
+            METADATA_CACHE.put(url, cache_key, self.fields, cases)
+        return cases
 
-    return manifestFileList
+class BiospecimenIndex():
+    """In-memory case -> sample -> aliquot graph, loaded one project at a time with paginated /cases queries.
+
+    File metadata retrieved with FileBatchMetadataRetriever.JOINED_FIELDS only identifies a file's cases, 
+    samples and aliquots; join() fills in their details from the graph.
+    """
+
+    def __init__(self, gdc_api_root, page_size):
+        self.retriever = ProjectBiospecimenRetriever(gdc_api_root, page_size)
+        self.cases = dict()
+        self.samples = dict()
+        self.aliquots = dict()
+        self.projects = set()
+        self._lock = threading.Lock()
+
+    def load_project(self, project_id):
+        with self._lock:
+            if project_id in self.projects:
+                return
+            print("prefetching biospecimen data for project {0}".format(project_id))
+            for case in self.retriever.get_cases(project_id):
+                for sample in case.get('samples', []):
+                    sample['case_id'] = case['case_id']
+                    self.samples[sample['sample_id']] = sample
+                    for portion in sample.get('portions', []):
+                        for analyte in portion.get('analytes', []):
+                            for aliquot in analyte.get('aliquots', []):
+                                self.aliquots[aliquot['aliquot_id']] = aliquot
+                self.cases[case['case_id']] = case
+            self.projects.add(project_id)
+
+    def join(self, file_metadata):
+        # returns file metadata in the form FileBatchMetadataRetriever.FIELDS would have produced, or None 
+        # if one of the file's cases, samples or aliquots is not in the graph
+        for case in file_metadata.get('cases', []):
+            self.load_project(case['project']['project_id'])
+
+        cases = []
+        for file_case in file_metadata.get('cases', []):
+            case = self.cases.get(file_case['case_id'])
+            if case is None:
+                return None
+            joined_case = {'case_id' : case['case_id'], 'submitter_id' : case['submitter_id'], 'project' : file_case['project']}
+            if 'samples' in file_case:
+                joined_case['samples'] = []
+                for file_sample in file_case['samples']:
+                    sample = self.samples.get(file_sample['sample_id'])
+                    if sample is None:
+                        return None
+                    joined_sample = {k : v for k, v in sample.items() if k not in ('portions', 'case_id')}
+                    portions = []
+                    for file_portion in file_sample.get('portions', []):
+                        analytes = []
+                        for file_analyte in file_portion.get('analytes', []):
+                            aliquots = []
+                            for file_aliquot in file_analyte.get('aliquots', []):
+                                aliquot = self.aliquots.get(file_aliquot['aliquot_id'])
+                                if aliquot is None:
+                                    return None
+                                aliquots.append({'submitter_id' : aliquot['submitter_id']})
+                            analytes.append({'aliquots' : aliquots})
+                        portions.append({'analytes' : analytes})
+                    if len(portions) > 0:
+                        joined_sample['portions'] = portions
+                    joined_case['samples'].append(joined_sample)
+            cases.append(joined_case)
+
+        joined = {k : v for k, v in file_metadata.items() if k != 'cases'}
+        joined['cases'] = cases
+        return joined
+
+    def get_primary_site(self, case_id):
+        case = self.cases.get(case_id)
+        return case.get('primary_site') if case is not None else None
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_JOBS = 4
+
+# number of times processing of a manifest file is attempted before it is skipped
+MAX_ATTEMPTS = 5
+
+# number of manifest files between reports of GDC API metrics
+METRICS_REPORT_INTERVAL = 1000
+
+SEPARATOR = '/'
+DRS_URL_ATTRIBUTE_SUFFIX = "drs_url"
+
+# the columns of a GDC manifest row that are used; size and md5 are None if the manifest lacks them
+ManifestRow = collections.namedtuple('ManifestRow', ['id', 'filename', 'size', 'md5'])
+
+def _open_manifest(manifestFile):
+    # opens a manifest file, or stdin if manifestFile is '-', for reading as text; gzip and bzip2
+    # compressed manifests are recognized by their magic numbers
+    raw = sys.stdin.buffer if manifestFile == '-' else open(manifestFile, 'rb')
+    magic = raw.peek(3)[:3]
+    if magic[:2] == b'\x1f\x8b':
+        raw = gzip.open(raw)
+    elif magic == b'BZh':
+        raw = bz2.open(raw)
+    return io.TextIOWrapper(raw, newline='')
+
+def _manifest_basename(manifestFile):
+    # prefix of the load files: the manifest's name without its compression and file extensions
+    if manifestFile == '-':
+        return 'manifest'
+    basename = os.path.basename(manifestFile)
+    for extension in ['.gz', '.bz2']:
+        if basename.endswith(extension):
+            basename = basename[:-len(extension)]
+    return os.path.splitext(basename)[0]
+
+def _uuid_key(file_uuid):
+    # compact key for the set of uuids already seen
+    try:
+        return int(file_uuid.replace('-', ''), 16)
+    except ValueError:
+        return file_uuid
+
+def _read_manifestFile(manifestFile, seen=None):
+    # yields the manifest's rows, one at a time, skipping rows whose uuid was already seen. The uuids are
+    # recorded in seen, a mapping such as a store's DiskMapping, if given, and otherwise in memory
+    if seen is None:
+        seen, key_of = dict(), _uuid_key
+    else:
+        key_of = str
+    num_rows = 0
+    with _open_manifest(manifestFile) as fp:
+        reader = csv.reader(fp, delimiter='\t')
+        header = next(reader)
+        id_column = header.index('id')
+        filename_column = header.index('filename')
+        size_column = header.index('size') if 'size' in header else None
+        md5_column = header.index('md5') if 'md5' in header else None
+        for row in reader:
+            if len(row) == 0:
+                continue
+            key = key_of(row[id_column])
+            if key in seen:
+                print("skipping duplicate manifest entry for file {0}".format(row[id_column]))
+                STATS.increment('duplicate_manifest_rows')
+                continue
+            seen[key] = None
+            num_rows += 1
+            yield ManifestRow(row[id_column], row[filename_column],
+                              int(row[size_column]) if size_column is not None and row[size_column] else None,
+                              row[md5_column] if md5_column is not None else None)
+    STATS.increment('manifest_files', num_rows)
+
+def _parse_shard(value):
+    # argparse type of --shard: "i/N" -> (i, N), with shards numbered from 1
+    try:
+        shard_index, num_shards = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected i/N, e.g. 1/4, not {0}".format(value))
+    if not 1 <= shard_index <= num_shards:
+        raise argparse.ArgumentTypeError("shard index must be between 1 and {0}".format(num_shards))
+    return shard_index, num_shards
+
+def _shard_rows(manifestRows, shard_index, num_shards):
+    # the manifest rows processed by shard shard_index of num_shards, in manifest order.  Files are assigned 
+    # largest first to the shard with the fewest bytes so far (then the fewest files, then the lowest 
+    # index), so that shards get similar amounts of data and every shard computes the same assignment
+    rows = list(manifestRows)
+    shards = [(0, 0, shard) for shard in range(1, num_shards + 1)]
+    assigned = set()
+    for item in sorted(rows, key=lambda item: (-(item.size or 0), item.id)):
+        num_bytes, num_files, shard = heapq.heappop(shards)
+        if shard == shard_index:
+            assigned.add(item.id)
+        heapq.heappush(shards, (num_bytes + (item.size or 0), num_files + 1, shard))
+    return [item for item in rows if item.id in assigned]
+
+@STATS.timed('batch_fetch')
+def _fetch_metadata_batch(batchRetriever, batch, start):
+    try:
+        batchMetadata = batchRetriever.get_metadata([item.id for item in batch])
+        if BIOSPECIMEN_INDEX is not None:
+            # files whose biospecimens are not in the index fall back to per-file queries
+            batchMetadata = {uuid : BIOSPECIMEN_INDEX.join(file_metadata) for uuid, file_metadata in batchMetadata.items()}
+        return batchMetadata
+    except (requests.exceptions.RequestException, ValueError) as x:
+        print("batch query failed for files {0} to {1}, falling back to per-file queries: {2}".format(start+1, start+len(batch), x))
+        return dict()
+
+def _iter_batches(rows, batch_size):
+    start = 0
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if len(batch) == 0:
+            return
+        yield start, batch
+        start += len(batch)
+
+def _iter_file_metadata(manifestRows, gdc_api_root, batch_size, jobs=1):
+    # yields each manifest item, in manifest order, along with its file metadata, retrieved from the GDC 
+    # in batches of batch_size files with up to jobs batch queries in flight at once; if a batch query 
+    # fails, or a file is missing from its response, None is yielded and get_file_metadata falls back 
+    # to per-file queries
+    if BIOSPECIMEN_INDEX is not None:
+        batchRetriever = FileBatchMetadataRetriever(gdc_api_root, FileBatchMetadataRetriever.JOINED_FIELDS)
+    else:
+        batchRetriever = FileBatchMetadataRetriever(gdc_api_root)
+
+    # manifest rows are consumed as batches are submitted, so fetching starts while the manifest is
+    # still being read; make sure a small manifest still keeps all workers busy
+    manifestRows = iter(manifestRows)
+    head = list(itertools.islice(manifestRows, batch_size * jobs))
+    if len(head) < batch_size * jobs:
+        batch_size = max(1, -(-len(head) // jobs))
+    batches = _iter_batches(itertools.chain(head, manifestRows), batch_size)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        for start, batch in itertools.islice(batches, jobs):
+            pending.append((batch, executor.submit(_fetch_metadata_batch, batchRetriever, batch, start)))
+
+        while pending:
+            batch, future = pending.popleft()
+            for start, next_batch in itertools.islice(batches, 1):
+                pending.append((next_batch, executor.submit(_fetch_metadata_batch, batchRetriever, next_batch, start)))
+            batchMetadata = future.result()
+            for item in batch:
+                yield item, batchMetadata.get(item.id)
+
+def _select_case_fields(file_metadata, include_samples):
+    # restrict a batch record to what FileCaseMetadataRetriever (include_samples=False) or
+    # FileCaseSampleMetadataRetriever (include_samples=True) would have returned
+    if include_samples:
+        return file_metadata
+    cases = [{k : v for k, v in case.items() if k != 'samples'} for case in file_metadata['cases']]
+    return {'cases' : cases}
 
 def _add_to_knowncases(case_metadata, known_cases, gdc_api_root):
     case_id = case_metadata['case_id']
@@ -268,9 +632,13 @@ def _add_to_knowncases(case_metadata, known_cases, gdc_api_root):
         submitter_id = case_metadata['submitter_id']
         project_id = case_metadata['project']['project_id']
 
-        caseMetadataRetriever = CaseMetadataRetriever(gdc_api_root)
-        caseMetadata = caseMetadataRetriever.get_metadata(case_id)
-        primary_site = caseMetadata.get('primary_site')
+        if BIOSPECIMEN_INDEX is not None and case_id in BIOSPECIMEN_INDEX.cases:
+            primary_site = BIOSPECIMEN_INDEX.get_primary_site(case_id)
+        else:
+            with STATS.stage('case_lookups'):
+                caseMetadataRetriever = CaseMetadataRetriever(gdc_api_root)
+                caseMetadata = caseMetadataRetriever.get_metadata(case_id)
+            primary_site = caseMetadata.get('primary_site')
 
         new_case = {'submitter_id' : submitter_id, 'project_id' : project_id, 'primary_site' : primary_site}
         known_cases[case_id] = new_case
@@ -383,394 +751,317 @@ def _constructImageAttributeName_base(experimental_strategy, workflow_type, data
 
     return attribute_name_base, portion
 
-def _pick_tcga_submitter(a, b):
-    '''Comparator function for barcodes, using the rules described in the GDAC                                                     
-    FAQ entry for replicate samples: https://confluence.broadinstitute.org/display/GDAC/FAQ                                        
-    '''
-    # Get the analytes and plates                                                                                                  
-    # TCGA-BL-A0C8-01A-11<Analyte>-<plate>-01                                                                                      
-    analyte1 = a[19]
-    analyte2 = b[19]
-    plate1   = a[21:25]
-    plate2   = b[21:25]
-
-    # Equals case                                                                                                                  
-    if a == b:
-        return a
-    elif analyte1 == analyte2:
-        # Prefer the aliquot with the highest lexicographical sort value                                                           
-        return a if a >= b else b
-    elif analyte1 == "H":
-        # Prefer H over R and T                                                                                                    
-        return a
-    elif analyte1 == "R":
-        # Prefer R over T                                                                                                          
-        return a if analyte2 == "T" else b
-    elif analyte1 == "T":
-        # Prefer H and R over T                                                                                                    
-        return b
-    elif analyte1 == "D":
-        # Prefer D over G,W,X, unless plate number is higher                                                                       
-        return a if plate2 <= plate1 else b
-    elif analyte2 == "D":
-        return b if plate1 <= plate2 else a
-    else:
-        # Default back to highest lexicographical sort value                                                                       
-        return a if a >= b else b
-    
-# this seemed clearer to me (Chet), but felt it better to use the same code
-# used by GDAC
-def _pick_tcga_aliquot(a, b):
-    """Comparator function for aliquot barcodes.
+# rank of the TCGA RNA analyte codes among replicates; 
+# see https://gdc.cancer.gov/resources-tcga-users/tcga-code-tables/portion-analyte-codes
+TCGA_RNA_ANALYTE_RANKS = {'T' : 1, 'R' : 2, 'H' : 3}
 
-    Uses rules described in the GDAC FAQ entry for replicate samples: FAQ entry for replicate samples: 
-    https://confluence.broadinstitute.org/display/GDAC/FAQ                                        
-    """
-    # Get the analytes and plates - 
-    # _see https://docs.gdc.cancer.gov/Encyclopedia/pages/images/TCGA-TCGAbarcode-080518-1750-4378.pdf
-
-    # TCGA-XX-XXXX-XXV-XXA-XXXX-XX
-    # 012345678901234567890123456789012345678901234567890123456789
-    #           1         2         3         4         5
-    # tss = 5:7
-    # participant = 8:12
-    # sample = 13:15
-    # vial = 15:17
-    # portion = 17:19
-    # analyte = 19:20
-    # plate = 12:25
-    # center = 26:28
-
-    # see https://gdc.cancer.gov/resources-tcga-users/tcga-code-tables/portion-analyte-codes for analyte codes
-
-    analyte1 = a[19]
-    analyte2 = b[19]
-    plate1   = a[21:25]
-    plate2   = b[21:25]
-    rna_analytes = set(['H', 'R', 'T'])
-    dna_analytes = set(['D', 'W', 'X']) 
-
-    if a == b:
-        return a
-
-    elif analyte1 == analyte2:
-        # Prefer the aliquot with the highest lexicographical sort value
-        return a if a >= b else b
-
-    elif analyte1 in rna_analytes and analyte2 in rna_analytes:
-        # Prefer H over R and T
-        if analyte1 == 'H' or analyte2 == 'H':
-            return a if analyte1 == 'H' else b
-        # Prefer R over T    
-        assert analyte == 'R' or analyte2 == 'R'
-        return a if analyte1 == 'R' else b
-
-    elif analyte1 in dna_analytes and analyte2 in dna_analytes:
-        # Prefer D over G,W,X, unless plate number is higher
-        if analyte1 == 'D' or analyte2 == 'D':
-            if plate1 == plate2:
-                return a if analyte1 == 'D' else b
-            else:
-                return a if plate2 < plate1 else b
-    else:
-        # Default back to highest lexicographical sort value     
-        return a if a >= b else b
+# rank of the TARGET analyte codes among replicates: R over S for RNA, D over E, Y, X and W for DNA
+TARGET_ANALYTE_RANKS = {'S' : 1, 'R' : 2, 'W' : 1, 'X' : 2, 'Y' : 3, 'E' : 4, 'D' : 5}
 
+@functools.total_ordering
+class _TcgaAliquotKey():
+    '''Sort key of a TCGA aliquot barcode, greatest for the aliquot to prefer among replicates, following the
+    rules described in the GDAC FAQ entry for replicate samples: https://confluence.broadinstitute.org/display/GDAC/FAQ
 
-def _pick_tcga_aliquot_pair(aliquot_pair_1, aliquot_pair_2):
-    
-    tumor_aliquot_1 = aliquot_pair_1['tumor']
-    tumor_aliquot_2 = aliquot_pair_2['tumor']
-    normal_aliquot_1 = aliquot_pair_1['normal']
-    normal_aliquot_2 = aliquot_pair_2['normal']
-
-    if tumor_aliquot_1 != tumor_aliquot_2:
-        tumor_aliquot_choice = _pick_tcga_submitter(tumor_aliquot_1, tumor_aliquot_2)
-        return aliquot_pair_1 if tumor_aliquot_choice == tumor_aliquot_1 else aliquot_pair_2
-    elif normal_aliquot_1 != normal_aliquot_2:
-        normal_aliquot_choice = _pick_tcga_submitter(tumor_aliquot_1, tumor_aliquot_2)
-        return aliquot_pair_1 if normal_aliquot_choice == normal_aliquot_1 else aliquot_pair_2
-    else:
-        print("WARNING: aliquot ids are identical, unable to make rational choice")
-        return aliquot_pair_1
-
-def _pick_target_submitter(a,b):
-    # Get the analytes and plates                                                                                                  
-    # TARGET-##-TSS-ABCDEF-TS.TP.N-<portion><analyte>                                                                              
-
-    analyte1 = a[-1]
-    analyte2 = b[-1]
-    portion1 = a[-3:-1]
-    portion2 = b[-3:-1]
-
-    # Equals case                                                                                                                  
-    if a == b:
-        return a
-    elif analyte1 == analyte2:
-        # Prefer the aliquot with the higher portion value                                                                         
-        return a if portion1 >= portion2 else b
-    #If RNA then analyte codes can be only R or S                                                                                  
-    elif analyte1 == "S":
-        #Then analyte2 has to be R (because they can't be equal)                                                                   
-        return b
-    elif analyte1 == "R":
-        #Then analyte2 has to be S (because they can't be equal)                                                                   
-        return a
-    elif analyte1 == "D":
-        #prefer D to E,W,X,Y                                                                                                       
-        return a
-    elif analyte1 == "E":
-        return b if analyte2 == "D" else a
-    elif analyte1 == "W":
-        # "W" is the lowest priority                                                                                               
-        return b
-    elif analyte1 == "X":
-        return a if analyte2 == "W" else b
-    else:
-        # analyte1 is Y                                                                                                            
-        return a if analyte2 == "X" or analyte2 == "W" else b
-    
-def _pick_target_aliquot_pair(aliquot_pair_1, aliquot_pair_2):
-    
-    tumor_aliquot_1 = aliquot_pair_1['tumor']
-    tumor_aliquot_2 = aliquot_pair_2['tumor']
-    normal_aliquot_1 = aliquot_pair_1['normal']
-    normal_aliquot_2 = aliquot_pair_2['normal']
-
-    if tumor_aliquot_1 != tumor_aliquot_2:
-        tumor_aliquot_choice = _pick_target_submitter(tumor_aliquot_1, tumor_aliquot_2)
-        return aliquot_pair_1 if tumor_aliquot_choice == tumor_aliquot_1 else aliquot_pair_2
-    elif normal_aliquot_1 != normal_aliquot_2:
-        normal_aliquot_choice = _pick_target_submitter(tumor_aliquot_1, tumor_aliquot_2)
-        return aliquot_pair_1 if normal_aliquot_choice == normal_aliquot_1 else aliquot_pair_2
-    else:
-        print("WARNING: aliquot ids are identical, unable to make rational choice")
-        return aliquot_pair_1
+    H is preferred over R and T, and R over T.  For DNA, D is preferred over G, W and X unless the other 
+    aliquot is on a higher plate.  Otherwise the aliquot with the highest lexicographical sort value is 
+    preferred.  These rules can rank three DNA aliquots cyclically; any two are ranked as the GDAC ranks them.
+    '''
 
-def _resolve_collision(data_category, data_type, program, uuid1, name1, uuid2, name2, gdc_api_root):
+    __slots__ = ('barcode', 'analyte', 'plate')
+
+    def __init__(self, barcode):
+        # Get the analytes and plates
+        # TCGA-BL-A0C8-01A-11<Analyte>-<plate>-01
+        self.barcode = barcode
+        self.analyte = barcode[19]
+        self.plate = barcode[21:25]
+
+    def __eq__(self, other):
+        return self.barcode == other.barcode
+
+    def __hash__(self):
+        return hash(self.barcode)
+
+    def __lt__(self, other):
+        if self.analyte == other.analyte:
+            return self.barcode < other.barcode
+        self_rna, other_rna = self.analyte in TCGA_RNA_ANALYTE_RANKS, other.analyte in TCGA_RNA_ANALYTE_RANKS
+        if self_rna or other_rna:
+            if self_rna and other_rna:
+                return TCGA_RNA_ANALYTE_RANKS[self.analyte] < TCGA_RNA_ANALYTE_RANKS[other.analyte]
+            return other_rna
+        if self.analyte == 'D':
+            return self.plate < other.plate
+        if other.analyte == 'D':
+            return self.plate <= other.plate
+        return self.barcode < other.barcode
+
+    def __repr__(self):
+        return '_TcgaAliquotKey({0!r})'.format(self.barcode)
+
+@functools.lru_cache(maxsize=None)
+def _tcga_aliquot_key(barcode):
+    return _TcgaAliquotKey(barcode)
+
+@functools.lru_cache(maxsize=None)
+def _target_aliquot_key(barcode):
+    '''Sort key of a TARGET aliquot barcode, greatest for the aliquot to prefer among replicates: by analyte
+    (see TARGET_ANALYTE_RANKS), then by portion, then by lexicographical sort value.
+    '''
+    # Get the analytes and portions
+    # TARGET-##-TSS-ABCDEF-TS.TP.N-<portion><analyte>
+    analyte = barcode[-1]
+    portion = barcode[-3:-1]
+    return (TARGET_ANALYTE_RANKS.get(analyte, 0), portion, barcode)
+
+ALIQUOT_KEYS = {GDC_ProgramName.TCGA : _tcga_aliquot_key, 
+                GDC_ProgramName.TARGET : _target_aliquot_key}
+
+def _get_aliquot_identities(file_uuid):
+    # returns the (tumor/normal classification, aliquot submitter id) of each sample of the file's case, 
+    # as captured from the file's metadata during the initial fetch; empty for files without samples
+    return FILE_ALIQUOTS.get(file_uuid, [])
+
+def _get_aliquot_pair(file_uuid):
+    # (tumor, normal) aliquot submitter ids of a file associated with a tumor and a normal sample, 
+    # or None if the file isn't
+    tumor_aliquot_submitter_ids = []
+    normal_aliquot_submitter_ids = []
+    for sample_type_tn, aliquot_submitter_id in _get_aliquot_identities(file_uuid):
+        if sample_type_tn == SAMPLE_TYPE.TUMOR:
+            tumor_aliquot_submitter_ids.append(aliquot_submitter_id)
+        elif sample_type_tn == SAMPLE_TYPE.NORMAL:
+            normal_aliquot_submitter_ids.append(aliquot_submitter_id)
+        else:
+            return None
+    if len(tumor_aliquot_submitter_ids) != 1 or len(normal_aliquot_submitter_ids) != 1:
+        return None
+    return tumor_aliquot_submitter_ids[0], normal_aliquot_submitter_ids[0]
+
+# sort key of files whose aliquots don't have the structure their data type implies, e.g. clinical
+# files without samples; it ranks below those of all other files, leaving the choice to the uuid
+UNRANKED = (0,)
+
+def _collision_key(data_category, data_type, program, file_uuids):
+    # function returning the sort key of each of several files that map to the same attribute of an entity;
+    # the file with the greatest key is the one the attribute should refer to
 
     # NOTE: we chose not to employ the created_datetime or updated_datetime fields in 
     # our decision logic.  From what we can tell, neither should be used to make a selection between 
     # two files.
 
+    if data_type in set([GDC_DataType.SLIDE_IMAGE]):
+        # prefer the slide with the largest portion ID
+        return lambda file_uuid: _getImageCodeAndPortionFromImageFilename(UUID_TO_FILENAME[file_uuid])[1]
 
     # Files that are associated with multiple cases won't use information encoded in aliquot barcode, 
-    if uuid1 in DEFERRED_FILE_NUM_OF_CASES or uuid2 in DEFERRED_FILE_NUM_OF_CASES:
+    if any(file_uuid in DEFERRED_FILE_NUM_OF_CASES for file_uuid in file_uuids):
         if program == GDC_ProgramName.TARGET and data_category in [GDC_DataCategory.CLINICAL, GDC_DataCategory.BIOSPECIMEN]:
             # special-case logic to deal with TARGET clinical and biospecimin files
             # select file associated with Discovery cohort over file associated with Validation cohort
             # where cohort association is encoded in the filename
             DISCOVERY = "Discovery"
             VALIDATION = "Validation"
-            if DISCOVERY in name1 and VALIDATION in name2:
-                return uuid1, name1
-            if VALIDATION in name1 and DISCOVERY in name2:
-                return uuid2, name2
-
-            print("No criteria for selection - skip new file1")
-            return uuid2, name2
-
-        if uuid1 in DEFERRED_FILE_NUM_OF_CASES:
-            num_cases1 = DEFERRED_FILE_NUM_OF_CASES[uuid1]
-        else:
-            num_cases1 = 1
-
-        if uuid2 in DEFERRED_FILE_NUM_OF_CASES:
-            num_cases2 = DEFERRED_FILE_NUM_OF_CASES[uuid2]
-        else:
-            num_cases2 = 1
-
-        print("number of cases...")
-        print("{0}: {1}, {2}: {3}".format(uuid1,num_cases1,uuid2,num_cases2))
-        # If one of the two files has more cases associated with it, we assume it's the correct file to pick.
-        if num_cases1 >= num_cases2:
-            return uuid1, name1
-        else:
-            return uuid2, name2
+            return lambda file_uuid: (DISCOVERY in UUID_TO_FILENAME[file_uuid], VALIDATION not in UUID_TO_FILENAME[file_uuid])
+        # If one of the files has more cases associated with it, we assume it's the correct file to pick.
+        return lambda file_uuid: DEFERRED_FILE_NUM_OF_CASES.get(file_uuid, 1)
 
     # Now we are left to deal only with files that are associated with one case
-    # get aliquot submitter IDs
-    tumor_aliquot_submitter_id1 = None
-    tumor_aliquot_submitter_id2 = None
-    normal_aliquot_submitter_id1 = None
-    normal_aliquot_submitter_id2 = None
+    if program not in ALIQUOT_KEYS:
+        print('WARNING: no known structure of metadata encoded in aliquot name; choosing file with smallest uuid')
+        return lambda file_uuid: 0
+    aliquot_key = ALIQUOT_KEYS[program]
 
     # SNV and Combined Nucleotide Variation (TARGET only) files are associated with two samples: tumor and normal. 
+    # Prefer the better tumor aliquot, then the better normal aliquot
     if ((data_category in GDC_DataCategory.SNV and 
          data_type not in set([GDC_DataType.AGGREGATED_SOMATIC_MUTATION, GDC_DataType.MASKED_SOMATIC_MUTATION])) or
         (data_category in GDC_DataCategory.COMBINED_NUCLEOTIDE_VARIATION) or
         (data_category in GDC_DataCategory.LEGACY_SNV and
          data_type in GDC_DataType.LEGACY_SIMPLE_NUCLEOTIDE_VARIATION)):
-
-        file_fields = "cases.samples.sample_type,cases.samples.portions.analytes.aliquots.submitter_id,cases.samples.sample_type_id"
-        meta_retriever = MetadataRetriever('files', file_fields, gdc_api_root)
-
-        data1 = meta_retriever.get_metadata(uuid1)
-        samples_list1 = data1['cases'][0]['samples']
-        assert len(samples_list1) == 2
-        for s in samples_list1:
-            sample_type_tn = SAMPLE_TYPE.getTumorNormalClassification(s.get('tissue_type'), s.get('sample_type'), s.get('sample_type_id'))
-            if sample_type_tn == SAMPLE_TYPE.TUMOR:
-                tumor_aliquot_submitter_id1 = s['portions'][0]['analytes'][0]['aliquots'][0]['submitter_id']
-            else:
-                assert sample_type_tn == SAMPLE_TYPE.NORMAL, "expected normal sample type"
-                normal_aliquot_submitter_id1 = s['portions'][0]['analytes'][0]['aliquots'][0]['submitter_id']
-
-        data2 = meta_retriever.get_metadata(uuid2)
-        samples_list2 = data2['cases'][0]['samples']
-        assert len(samples_list2) == 2
-        for s in samples_list2:
-            sample_type_tn = SAMPLE_TYPE.getTumorNormalClassification(s.get('tissue_type_'), s.get('sample_type'), s.get('sample_type_id'))
-            if sample_type_tn == SAMPLE_TYPE.TUMOR:
-                tumor_aliquot_submitter_id2 = s['portions'][0]['analytes'][0]['aliquots'][0]['submitter_id']
-            else:
-                assert sample_type_tn == SAMPLE_TYPE.NORMAL, "expected normal sample type"
-                normal_aliquot_submitter_id2 = s['portions'][0]['analytes'][0]['aliquots'][0]['submitter_id']
-
-        aliquot_pair_1 = {'tumor' : tumor_aliquot_submitter_id1, 'normal' : normal_aliquot_submitter_id1}
-        aliquot_pair_2 = {'tumor' : tumor_aliquot_submitter_id2, 'normal' : normal_aliquot_submitter_id2}
-        
-        print('aliquot pair name for {0}: {1} / {2}'.format(uuid1, aliquot_pair_1['tumor'], aliquot_pair_1['normal']))
-        print('aliquot pair pair for {0}: {1} / {2}'.format(uuid2, aliquot_pair_2['tumor'], aliquot_pair_2['normal']))
-
-        if program == GDC_ProgramName.TCGA:
-            chosen_aliquot_pair = _pick_tcga_aliquot_pair(aliquot_pair_1, aliquot_pair_2)
-        elif program == GDC_ProgramName.TARGET:
-            chosen_aliquot_pair = _pick_target_aliquot_pair(aliquot_pair_1, aliquot_pair_2)
-        else:
-            # no known structure of metadata encoded in aliquot name; just choose 1 arbitrarily
-            print('WARNING: no known structure of metadata encoded in aliquote name; choice is arbitrary!')
-            chosen_aliquot_pair = aliquot_pair_1
-        
-        if chosen_aliquot_pair == aliquot_pair_1:
-            return uuid1, name1
-        else:
-            return uuid2, name2
+        def pair_key(file_uuid):
+            aliquot_pair = _get_aliquot_pair(file_uuid)
+            if aliquot_pair is None or None in aliquot_pair:
+                print('WARNING: no tumor/normal aliquot pair for {0}; ranking it last'.format(file_uuid))
+                return UNRANKED
+            tumor_aliquot_submitter_id, normal_aliquot_submitter_id = aliquot_pair
+            print('aliquot pair for {0}: {1} / {2}'.format(file_uuid, tumor_aliquot_submitter_id, normal_aliquot_submitter_id))
+            return (1, aliquot_key(tumor_aliquot_submitter_id), aliquot_key(normal_aliquot_submitter_id))
+        return pair_key
 
     # Here we handle other file types that are associated with single sample.
-    else:
-        file_fields = "cases.project.program.name,cases.samples.portions.analytes.aliquots.submitter_id"
-        meta_retriever = MetadataRetriever('files', file_fields, gdc_api_root)
-
-        data1 = meta_retriever.get_metadata(uuid1)
-        data2 = meta_retriever.get_metadata(uuid2)
-
-        assert len(data1['cases'][0]['samples']) == 1, "more than one sample associated with file"
-        assert len(data2['cases'][0]['samples']) == 1, "more than one sample associated with file"
-
-        aliquot_submitter_id1 = data1['cases'][0]['samples'][0]['portions'][0]['analytes'][0]['aliquots'][0]['submitter_id']
-        aliquot_submitter_id2 = data2['cases'][0]['samples'][0]['portions'][0]['analytes'][0]['aliquots'][0]['submitter_id']
-
-        print('aliquot name for {0}: {1}'.format(uuid1, aliquot_submitter_id1))
-        print('aliquot name for {0}: {1}'.format(uuid2, aliquot_submitter_id2))
-
-        if aliquot_submitter_id1 != aliquot_submitter_id2:
-            if program == GDC_ProgramName.TCGA:
-                chosen = _pick_tcga_submitter(aliquot_submitter_id1, aliquot_submitter_id2)
-
-            elif program == GDC_ProgramName.TARGET:
-                chosen = _pick_target_submitter(aliquot_submitter_id1, aliquot_submitter_id2)
-            else:
-                print('WARNING: no known structure of metadata encoded in aliquote name; choice is arbitrary!')
-                chosen = aliquot_submitter_id1
-        else:
-            print('WARNING: aliquot ids are identical; unable to make rational choice!')
-            chosen = aliquot_submitter_id1
-
-        if chosen == aliquot_submitter_id1:
-            return uuid1, name1
-        else:
-            return uuid2, name2
-
+    def single_key(file_uuid):
+        aliquots = _get_aliquot_identities(file_uuid)
+        if len(aliquots) != 1 or aliquots[0][1] is None:
+            print('WARNING: {0} aliquots associated with {1}; ranking it last'.format(len(aliquots), file_uuid))
+            return UNRANKED
+        print('aliquot name for {0}: {1}'.format(file_uuid, aliquots[0][1]))
+        return (1, aliquot_key(aliquots[0][1]))
+    return single_key
 
 def _create_drs_url(file_uuid):
-    return 'drs://dataguids.org/{0}'.format(file_uuid)
+    return DRS_URL_PREFIX + file_uuid
 
 def _get_file_uuid_from_drs_url(drs_url):
-    return drs_url.partition('drs://dataguids.org/')[2]
+    return drs_url.partition(DRS_URL_PREFIX)[2]
 
-def _add_file_attribute(entity_id, entity, file_uuid, filename,
+def _add_index_file_attribute(table, entity_id, basename, bam_uuid):
+    bai_attribute_name = basename.replace('__bam__', '__bai__') + DRS_URL_ATTRIBUTE_SUFFIX
+    if bam_uuid in BAM_INDEX_FILE_UUIDS:
+        indexFilesList = BAM_INDEX_FILE_UUIDS[bam_uuid]
+        assert(len(indexFilesList) == 1)
+        table.set_attribute(entity_id, bai_attribute_name, _create_drs_url(indexFilesList[0]))
+        PENDING_INDEX_FILE_ATTRIBUTES.pop((entity_id, bai_attribute_name), None)
+    else:
+        # index file uuid is not yet known; it is resolved, along with those of all other BAMs that
+        # win their attribute, by _resolve_pending_index_files. A placeholder keeps the column order stable.
+        table.set_attribute(entity_id, bai_attribute_name, None)
+        PENDING_INDEX_FILE_ATTRIBUTES[(entity_id, bai_attribute_name)] = (table, bam_uuid)
+
+@STATS.timed('bai_lookups')
+def _resolve_pending_index_files(gdc_api_root, batch_size):
+    pending = list(PENDING_INDEX_FILE_ATTRIBUTES.items())
+    if len(pending) == 0:
+        return
+    print("Resolving index files of {0} BAM files...".format(len(pending)))
+    batchRetriever = FileBatchMetadataRetriever(gdc_api_root, FileBatchMetadataRetriever.INDEX_FILE_FIELDS)
+    bam_uuids = sorted(set(bam_uuid for _, (_, bam_uuid) in pending if bam_uuid not in BAM_INDEX_FILE_UUIDS))
+    for start in range(0, len(bam_uuids), batch_size):
+        for bam_uuid, file_metadata in batchRetriever.get_metadata(bam_uuids[start:start + batch_size]).items():
+            if 'index_files' in file_metadata:
+                BAM_INDEX_FILE_UUIDS[bam_uuid] = [f['file_id'] for f in file_metadata['index_files']]
+
+    for (entity_id, bai_attribute_name), (table, bam_uuid) in pending:
+        try:
+            if bam_uuid not in BAM_INDEX_FILE_UUIDS:
+                indexFileUuidRetriever = IndexFileUuidRetriever(gdc_api_root)
+                BAM_INDEX_FILE_UUIDS[bam_uuid] = [indexFileUuidRetriever.get_index_uuid(bam_uuid)]
+            indexFilesList = BAM_INDEX_FILE_UUIDS[bam_uuid]
+            assert(len(indexFilesList) == 1)
+            table.set_attribute(entity_id, bai_attribute_name, _create_drs_url(indexFilesList[0]))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception as x:
+            print(''.join(traceback.format_exception(type(x), x, x.__traceback__)))
+            print("unable to resolve index file of BAM {0}; leaving {1} of {2} empty".format(bam_uuid, bai_attribute_name, entity_id))
+            table.delete_attribute(entity_id, bai_attribute_name)
+    PENDING_INDEX_FILE_ATTRIBUTES.clear()
+
+def _record_aliquot_identities(file_uuid, file_metadata):
+    # records an entry for every file, empty if its case has no samples, so that collisions are resolved without requests
+    cases = file_metadata.get('cases', [])
+    aliquots = []
+    for s in (cases[0].get('samples', []) if len(cases) > 0 else []):
+        sample_type_tn = SAMPLE_TYPE.getTumorNormalClassification(s.get('tissue_type'), s.get('sample_type'), s.get('sample_type_id'))
+        aliquot_submitter_id = s['portions'][0]['analytes'][0]['aliquots'][0]['submitter_id'] if 'portions' in s else None
+        aliquots.append((sample_type_tn, aliquot_submitter_id))
+    FILE_ALIQUOTS[file_uuid] = aliquots
+
+def _record_index_files(file_uuid, responseDict):
+    if 'index_files' in responseDict:
+        BAM_INDEX_FILE_UUIDS[file_uuid] = [f['file_id'] for f in responseDict['index_files']]
+
+def _record_attribute_slot(file_uuid, entity_id, attribute_name):
+    # slots are [entity id, attribute name] lists, as a DiskMapping returns them; the list is stored
+    # back so that the change reaches a DiskMapping
+    slots = FILE_ATTRIBUTE_SLOTS.get(file_uuid, [])
+    if [entity_id, attribute_name] not in slots:
+        slots.append([entity_id, attribute_name])
+        FILE_ATTRIBUTE_SLOTS[file_uuid] = slots
+
+@STATS.timed('collision_resolution')
+def _choose_file(data_category, data_type, program, file_uuids):
+    # uuid of whichever of several files that map to the same attribute of an entity the attribute should refer to:
+    # the one with the greatest sort key, and of several with the same key, the one with the smallest uuid
+    file_uuids = sorted(file_uuids)
+    key = _collision_key(data_category, data_type, program, file_uuids)
+    keys = {file_uuid : key(file_uuid) for file_uuid in file_uuids}
+    # max() returns the first of several greatest items
+    chosen_uuid = max(file_uuids, key=keys.__getitem__)
+    if sum(1 for file_key in keys.values() if file_key == keys[chosen_uuid]) > 1:
+        print("WARNING: files rank the same, unable to make rational choice; choosing file with smallest uuid")
+    print("chosen file is: {0}/{1}".format(chosen_uuid, UUID_TO_FILENAME[chosen_uuid]))
+    return chosen_uuid
+
+def _add_file_attribute(table, entity_id, file_uuid, filename,
                         data_category, data_type, data_format, experimental_strategy, workflow_type, access, program, gdc_api_root):
+    entity = table[entity_id]
+    FILE_CLASSIFICATIONS[file_uuid] = (data_category, data_type, program)
     # I needed to insert some special-case processing for image data files
     # this probably isn't the cleanest way to handle it, but good enough for now
     if data_type in set([GDC_DataType.SLIDE_IMAGE]):
-        basename, portion = _constructImageAttributeName_base(experimental_strategy, workflow_type,
-                                                              data_category, data_type, data_format, filename)
-        attribute_name = basename + DRS_URL_ATTRIBUTE_SUFFIX
-
-        if attribute_name in entity:
-            existing_drs_url = entity[attribute_name]
-            existing_uuid = _get_file_uuid_from_drs_url(existing_drs_url)
-
-            existing_filename = UUID_TO_FILENAME[existing_uuid]
-
-            print("multiple files for same attribute!") 
-            print("entity id: {0}, attribute name: {1}".format(entity_id, attribute_name))
-            print("new file: {0}/{1}".format(file_uuid, filename))
-            print("existing file: {0}/{1}".format(existing_uuid, existing_filename))
-
-            _, portion_present = _getImageCodeAndPortionFromImageFilename(existing_filename)
-            if portion > portion_present:
-                print("newer file has larger portion ID; use newer file")
-                entity[basename + DRS_URL_ATTRIBUTE_SUFFIX] = _create_drs_url(file_uuid)
-            elif portion < portion_present:
-                print("newer file has smaller portion ID; retain existing file")
-            else:
-                print("Both files have samer portion ID: retain existing file")
-
-        else:
-            entity[basename + DRS_URL_ATTRIBUTE_SUFFIX] = _create_drs_url(file_uuid)
+        basename, _ = _constructImageAttributeName_base(experimental_strategy, workflow_type,
+                                                        data_category, data_type, data_format, filename)
     else:
         basename = _constructAttributeName_base(experimental_strategy, workflow_type,
                                                 data_category, data_type, data_format)
-        attribute_name = basename + DRS_URL_ATTRIBUTE_SUFFIX
-        
-        # see if attribute already defined for entity
-        if attribute_name in entity:
-            existing_drs_url = entity[attribute_name]
-            existing_uuid = _get_file_uuid_from_drs_url(existing_drs_url)
-            existing_filename = UUID_TO_FILENAME[existing_uuid]
-
-            print("multiple files for same attribute!")
-            print("entity id: {0}, attribute name: {1}".format(entity_id, attribute_name))
-            print("new file: {0}/{1}".format(file_uuid, filename))
-            print("existing file: {0}/{1}".format(existing_uuid, existing_filename))
-            
-            chosen_uuid, chosen_filename = _resolve_collision(data_category, data_type, program,
-                                                              file_uuid, filename, existing_uuid, existing_filename, gdc_api_root)
-            print("chosen file is: {0}/{1}".format(chosen_uuid, chosen_filename))
-
-
-            if chosen_uuid == file_uuid:
-                entity[basename + DRS_URL_ATTRIBUTE_SUFFIX] = _create_drs_url(file_uuid)
-                print("experimental strategy: {0}".format(experimental_strategy))
-                # GDC does not provide index files for RNA-Seq BAMs
-                if data_format == 'BAM'and experimental_strategy != 'RNA-Seq':
-                    bai_basename = basename.replace('__bam__', '__bai__')
-                    indexFileUuidRetriever = IndexFileUuidRetriever(gdc_api_root)
-                    bai_uuid = indexFileUuidRetriever.get_index_uuid(file_uuid)
-                    entity[bai_basename + DRS_URL_ATTRIBUTE_SUFFIX] = _create_drs_url(bai_uuid)
-
-            else:
-                return
-        else:
-            entity[basename + DRS_URL_ATTRIBUTE_SUFFIX] = _create_drs_url(file_uuid)
-
-            # GDC does not provide index files for RNA-Seq BAMs
-            if data_format == 'BAM'and experimental_strategy != 'RNA-Seq':
-                bai_basename = basename.replace('__bam__', '__bai__')
-                indexFileUuidRetriever = IndexFileUuidRetriever(gdc_api_root)
-                bai_uuid = indexFileUuidRetriever.get_index_uuid(file_uuid)
-                entity[bai_basename + DRS_URL_ATTRIBUTE_SUFFIX] = _create_drs_url(bai_uuid)
+    attribute_name = basename + DRS_URL_ATTRIBUTE_SUFFIX
+    _record_attribute_slot(file_uuid, entity_id, attribute_name)
 
-def get_file_metadata(file_uuid, filename, known_cases, known_samples, known_pairs, deferred_file_uuids, gdc_api_root):
+    # if the attribute is already defined, the file is one of several candidates for it;
+    # _reduce_collisions chooses between them once all files are processed
+    if attribute_name in entity:
+        return
+    table.set_attribute(entity_id, attribute_name, _create_drs_url(file_uuid))
+
+    # GDC does not provide index files for RNA-Seq BAMs
+    if data_format == 'BAM' and experimental_strategy != 'RNA-Seq':
+        _add_index_file_attribute(table, entity_id, basename, file_uuid)
+
+def _reduce_collisions(tables):
+    # fills each attribute that several files were candidates for with the file chosen among all of them.
+    # The choice depends only on the set of candidates, not on the order in which files were processed, 
+    # fetched or sharded
+    candidates = collections.defaultdict(list)
+    for file_uuid, slots in FILE_ATTRIBUTE_SLOTS.items():
+        for slot in slots:
+            candidates[tuple(slot)].append(file_uuid)
+
+    for (entity_id, attribute_name), file_uuids in sorted(candidates.items()):
+        if len(file_uuids) < 2:
+            continue
+        table = next((table for table in tables if table.peek(entity_id) is not None), None)
+        if table is None:
+            # entity dropped by an incremental run
+            continue
+        file_uuids = sorted(file_uuids)
+        print("multiple files for same attribute!")
+        print("entity id: {0}, attribute name: {1}".format(entity_id, attribute_name))
+        print("files: {0}".format(', '.join('{0}/{1}'.format(file_uuid, UUID_TO_FILENAME[file_uuid]) for file_uuid in file_uuids)))
+        try:
+            data_category, data_type, program = FILE_CLASSIFICATIONS[file_uuids[0]]
+            chosen_uuid = _choose_file(data_category, data_type, program, file_uuids)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception as x:
+            # keep the choice independent of the order of the candidates
+            print(''.join(traceback.format_exception(type(x), x, x.__traceback__)))
+            chosen_uuid = file_uuids[0]
+            print("unable to rank files for {0} of {1}; choosing file with smallest uuid {2}".format(attribute_name, entity_id, chosen_uuid))
+
+        entity = table[entity_id]
+        if entity.get(attribute_name) == _create_drs_url(chosen_uuid):
+            continue
+        table.set_attribute(entity_id, attribute_name, _create_drs_url(chosen_uuid))
+        # all candidates for an attribute have the same experimental strategy and data format, so they all have a BAI or none does
+        bai_attribute_name = attribute_name.replace('__bam__', '__bai__')
+        if bai_attribute_name != attribute_name and bai_attribute_name in entity:
+            _add_index_file_attribute(table, entity_id, attribute_name[:-len(DRS_URL_ATTRIBUTE_SUFFIX)], chosen_uuid)
+
+@STATS.timed('file_metadata')
+def get_file_metadata(file_uuid, filename, known_cases, known_samples, known_pairs, deferred_file_uuids, gdc_api_root,
+                      file_metadata=None):
     
     pp = pprint.PrettyPrinter()
 
     # get from GDC the data file's category, type, access type, format, experimental strategy,
-    # analysis workflow type
-    fileMetadataRetriever = FileMetadataRetriever(gdc_api_root)
-    responseDict = fileMetadataRetriever.get_metadata(file_uuid)
+    # analysis workflow type, unless already retrieved in a batch query
+    if file_metadata is None:
+        fileMetadataRetriever = FileMetadataRetriever(gdc_api_root)
+        responseDict = fileMetadataRetriever.get_metadata(file_uuid)
+    else:
+        responseDict = file_metadata
     
     try:
         data_category = responseDict['data_category']
@@ -784,6 +1075,8 @@ def get_file_metadata(file_uuid, filename, known_cases, known_samples, known_pai
         print("SKIPPING FILE: file uuid = {0}, file name = {1}".format(file_uuid, filename))
         return
     
+    _record_index_files(file_uuid, responseDict)
+
     if 'experimental_strategy' in responseDict:
         experimental_strategy = responseDict['experimental_strategy']
     else: 
@@ -795,19 +1088,24 @@ def get_file_metadata(file_uuid, filename, known_cases, known_samples, known_pai
     
 
     if data_category in set([GDC_DataCategory.CLINICAL, GDC_DataCategory.BIOSPECIMEN]): 
-        if data_type == GDC_DataType.SLIDE_IMAGE:
-            fileMetadataRetriever = FileCaseSampleMetadataRetriever(gdc_api_root)            
-        else:
-            fileMetadataRetriever = FileCaseMetadataRetriever(gdc_api_root)
+        include_samples = data_type == GDC_DataType.SLIDE_IMAGE
     else:
-        fileMetadataRetriever = FileCaseSampleMetadataRetriever(gdc_api_root)
+        include_samples = True
 
     # quick fix for legacy image data - will clean up
     if data_type in set([GDC_DataType.LEGACY_TISSUE_SLIDE_IMAGE, GDC_DataType.LEGACY_DIAGNOSTIC_IMAGE]):
-        fileMetadataRetriever = FileCaseSampleMetadataRetriever(gdc_api_root)
+        include_samples = True
 
+    if file_metadata is None:
+        if include_samples:
+            fileMetadataRetriever = FileCaseSampleMetadataRetriever(gdc_api_root)
+        else:
+            fileMetadataRetriever = FileCaseMetadataRetriever(gdc_api_root)
+        fileMetadata = fileMetadataRetriever.get_metadata(file_uuid)
+    else:
+        fileMetadata = _select_case_fields(file_metadata, include_samples)
 
-    fileMetadata = fileMetadataRetriever.get_metadata(file_uuid)
+    _record_aliquot_identities(file_uuid, file_metadata if file_metadata is not None else fileMetadata)
 
     #debug
     #print('metadata:')
@@ -830,12 +1128,12 @@ def get_file_metadata(file_uuid, filename, known_cases, known_samples, known_pai
     if num_associated_cases == 1:
         if num_associated_samples == 0:
             case_id = _add_to_knowncases(cases[0], known_cases, gdc_api_root)
-            _add_file_attribute(case_id, known_cases[case_id], file_uuid, filename,
+            _add_file_attribute(known_cases, case_id, file_uuid, filename,
                                 data_category, data_type, data_format, experimental_strategy, workflow_type, access, program, gdc_api_root)
         elif num_associated_samples == 1:
             case_id = _add_to_knowncases(cases[0], known_cases, gdc_api_root)
             sample_id, _ = _add_to_knownsamples(samples[0], case_id, known_samples)
-            _add_file_attribute(sample_id, known_samples[sample_id], file_uuid, filename,
+            _add_file_attribute(known_samples, sample_id, file_uuid, filename,
                                 data_category, data_type, data_format, experimental_strategy, 
                                 workflow_type, access, program, gdc_api_root)
 
@@ -852,17 +1150,17 @@ def get_file_metadata(file_uuid, filename, known_cases, known_samples, known_pai
                     tumor_sample_id = sample2_id
                     normal_sample_id = sample1_id
 
-                    pair_id = _add_to_knownpairs(tumor_sample_id, normal_sample_id, known_pairs)
-                    _add_file_attribute(pair_id, known_pairs[pair_id], file_uuid, filename,
-                                        data_category, data_type, data_format, experimental_strategy, 
-                                        workflow_type, access, program, gdc_api_root)
+                pair_id = _add_to_knownpairs(tumor_sample_id, normal_sample_id, known_pairs)
+                _add_file_attribute(known_pairs, pair_id, file_uuid, filename,
+                                    data_category, data_type, data_format, experimental_strategy, 
+                                    workflow_type, access, program, gdc_api_root)
             else:
                     # Within some programs (e.g., CPTAC), if a given specimen did not have enough material for genomics analysis
                     # multiple specimens or cores from a given patient are being combined to get 
                     # sufficient material. 
                     case_id = _add_to_knowncases(cases[0], known_cases, gdc_api_root)
                     sample_id, _pwd = _add_pooled_sample_to_knownsamples(file_uuid, filename, samples, case_id, known_samples)
-                    _add_file_attribute(sample_id, known_samples[sample_id], file_uuid, filename,
+                    _add_file_attribute(known_samples, sample_id, file_uuid, filename,
                                         data_category, data_type, data_format, experimental_strategy, 
                                         workflow_type, access, program, gdc_api_root)
 
@@ -901,14 +1199,14 @@ def get_file_metadata(file_uuid, filename, known_cases, known_samples, known_pai
                     raise ValueError(file_uuid, filename, data_category)
 
                 pair_id = _add_to_knownpairs(tumor_sample_id, normal_sample_id, known_pairs)
-                _add_file_attribute(pair_id, known_pairs[pair_id], file_uuid, filename,
+                _add_file_attribute(known_pairs, pair_id, file_uuid, filename,
                                     data_category, data_type, data_format, experimental_strategy, 
                                     workflow_type, access, program, gdc_api_root)
 
             else:
                 case_id = _add_to_knowncases(cases[0], known_cases, gdc_api_root)
                 sample_id, _pwd = _add_pooled_sample_to_knownsamples(file_uuid, filename, samples, case_id, known_samples)
-                _add_file_attribute(sample_id, known_samples[sample_id], file_uuid, filename,
+                _add_file_attribute(known_samples, sample_id, file_uuid, filename,
                                     data_category, data_type, data_format, experimental_strategy, 
                                     workflow_type, access, program, gdc_api_root)
 
@@ -916,7 +1214,8 @@ def get_file_metadata(file_uuid, filename, known_cases, known_samples, known_pai
         # file associated with multiple cases
         # we will record file_uuid and deal with later
         DEFERRED_FILE_NUM_OF_CASES[file_uuid] = num_associated_cases
-        deferred_file_uuids.append([file_uuid, filename])
+        DEFERRED_FILE_METADATA[file_uuid] = file_metadata
+        deferred_file_uuids.append(file_uuid)
 
 # may eventually drop this and incorporate into get_file_metadata.  Wasn't sure what to do with files
 # associated with multiple cases or files associated with samples across multiple cases.
@@ -925,11 +1224,17 @@ def get_file_metadata(file_uuid, filename, known_cases, known_samples, known_pai
 # can be overridden by setting all_cases to true, in which case a paricipant entity will be created for each
 # case a file is associated with.
 
-def process_deferred_file_uuid(file_uuid, filename, known_cases, known_samples, all_cases, gdc_api_root):
+@STATS.timed('deferred_files')
+def process_deferred_file_uuid(file_uuid, filename, known_cases, known_samples, all_cases, gdc_api_root,
+                               file_metadata=None):
     
-    # get data file's name, category, type, access, format experimental strategy, workflow type
-    fileMetadataRetriever = FileMetadataRetriever(gdc_api_root)
-    responseDict = fileMetadataRetriever.get_metadata(file_uuid)
+    # get data file's name, category, type, access, format experimental strategy, workflow type,
+    # unless already retrieved in a batch query
+    if file_metadata is None:
+        fileMetadataRetriever = FileMetadataRetriever(gdc_api_root)
+        responseDict = fileMetadataRetriever.get_metadata(file_uuid)
+    else:
+        responseDict = file_metadata
 
     data_category = responseDict['data_category']
     data_type = responseDict['data_type']
@@ -951,6 +1256,8 @@ def process_deferred_file_uuid(file_uuid, filename, known_cases, known_samples,
             print('skipping {0} file {1}'.format(data_format, file_uuid))
             return
 
+    _record_index_files(file_uuid, responseDict)
+
     if 'experimental_strategy' in responseDict:
         experimental_strategy = responseDict['experimental_strategy']
     else: 
@@ -960,12 +1267,16 @@ def process_deferred_file_uuid(file_uuid, filename, known_cases, known_samples,
     else:
         workflow_type = None
         
-    if data_category == GDC_DataCategory.CLINICAL or data_category == GDC_DataCategory.BIOSPECIMEN:
-        fileMetadataRetriever = FileCaseMetadataRetriever(gdc_api_root)
-    else:
-        fileMetadataRetriever = FileCaseSampleMetadataRetriever(gdc_api_root)
+    include_samples = not (data_category == GDC_DataCategory.CLINICAL or data_category == GDC_DataCategory.BIOSPECIMEN)
 
-    filedMmetadata = fileMetadataRetriever.get_metadata(file_uuid)
+    if file_metadata is None:
+        if include_samples:
+            fileMetadataRetriever = FileCaseSampleMetadataRetriever(gdc_api_root)
+        else:
+            fileMetadataRetriever = FileCaseMetadataRetriever(gdc_api_root)
+        fileMetadata = fileMetadataRetriever.get_metadata(file_uuid)
+    else:
+        fileMetadata = _select_case_fields(file_metadata, include_samples)
 
     cases = fileMetadata['cases']
     num_associated_cases = len(cases)
@@ -981,131 +1292,111 @@ def process_deferred_file_uuid(file_uuid, filename, known_cases, known_samples,
                 for sample in samples:
                     sample_id = sample['sample_id']
                     if sample_id in known_samples:
-                        _add_file_attribute(sample_id, known_samples[sample_id], file_uuid, filename,
+                        _add_file_attribute(known_samples, sample_id, file_uuid, filename,
                                             data_category, data_type, data_format, experimental_strategy, 
                                             workflow_type, access, program, gdc_api_root)
             else:
                 # associated with multiple cases only
-                _add_file_attribute(case_id, known_cases[case_id], file_uuid, filename,
+                _add_file_attribute(known_cases, case_id, file_uuid, filename,
                                     data_category, data_type, data_format,experimental_strategy, 
                                     workflow_type, access, program, gdc_api_root)
 
 
-def create_participants_file(cases, manifestFileBasename):
-    
-    attribute_names = []
-    for case_id, case in cases.items():
-        for attribute_name in case:
-            if attribute_name not in attribute_names:
-                attribute_names.append(attribute_name)
-    
-    participants_filename = manifestFileBasename + '_participants.tsv'
-    participant_sets_membership_filename = manifestFileBasename + '_participant_sets_membership.tsv'
-    
-    with open(participants_filename, 'w') as participantsFile, open(participant_sets_membership_filename, 'w') as membershipFile:
-        fieldnames = ['entity:participant_id'] + attribute_names
-        participants_writer = csv.DictWriter(participantsFile, fieldnames=fieldnames, delimiter='\t')
-        participants_writer.writeheader()
-
-        fieldnames = ['membership:participant_set_id', 'participant']
-        membership_writer = csv.DictWriter(membershipFile, fieldnames=fieldnames, delimiter='\t')
-        membership_writer.writeheader()
-        
-        for case_id, case in cases.items():
-            entity_row = {'entity:participant_id': case_id}
-            for attribute_name in attribute_names:
-                if attribute_name in case:
-                    entity_row[attribute_name] = case[attribute_name]
-                else:
-                    entity_row[attribute_name] = '__DELETE__'
-                entity_row[attribute_name] = case[attribute_name] if attribute_name in case else '__DELETE__'
-            participants_writer.writerow(entity_row)
+# buffer size of the load file writers
+WRITE_BUFFER_SIZE = 2**20
 
-            membership_row = {'membership:participant_set_id' : 'ALL',
-                              'participant' : case_id}
-            membership_writer.writerow(membership_row)            
+def _attribute_names(entities, exclude=()):
+    # the entities' metadata attributes, in the order they first appeared, then their file attributes by name, 
+    # so that the columns do not depend on the order in which files were processed
+    if isinstance(entities, EntityTable):
+        attribute_names = entities.attribute_names(exclude)
+    else:
+        # any other mapping of entity id -> attribute dict: collect the names in order of first appearance
+        attribute_names = dict()
+        for entity in entities.values():
+            attribute_names.update(dict.fromkeys(entity))
+        attribute_names = [attribute_name for attribute_name in attribute_names if attribute_name not in exclude]
+    file_attribute_names = sorted(attribute_name for attribute_name in attribute_names if attribute_name.endswith(DRS_URL_ATTRIBUTE_SUFFIX))
+    return [attribute_name for attribute_name in attribute_names if not attribute_name.endswith(DRS_URL_ATTRIBUTE_SUFFIX)] + file_attribute_names
+
+def _sorted_items(entities):
+    # (entity id, entity) in entity id order
+    if isinstance(entities, EntityTable):
+        return entities.sorted_items()
+    return iter(sorted(entities.items(), key=lambda item: item[0]))
+
+def _sorted_ids(entities):
+    if isinstance(entities, EntityTable):
+        return entities.sorted_keys()
+    return iter(sorted(entities))
+
+def _attribute_values(entity, attribute_names):
+    if isinstance(entity, Entity):
+        return entity.lookup(attribute_names, '__DELETE__')
+    return [entity[attribute_name] if attribute_name in entity else '__DELETE__' for attribute_name in attribute_names]
+
+def _membership_rows(kind, entities):
+    # header and rows of the load file that puts all entities in the set ALL
+    yield ['membership:{0}_set_id'.format(kind), kind]
+    for entity_id in _sorted_ids(entities):
+        yield ['ALL', entity_id]
+
+def _participant_rows(cases):
+    # header and rows of the participants load file
+    attribute_names = _attribute_names(cases)
+    yield ['entity:participant_id'] + attribute_names
+    for case_id, case in _sorted_items(cases):
+        yield [case_id] + _attribute_values(case, attribute_names)
+
+def _sample_rows(samples):
+    # header and rows of the samples load file
+    attribute_names = _attribute_names(samples, exclude={'submitter_id', 'case_id', 'sample_type_id', 'sample_type', 'tissue_type'})
+    yield ['entity:sample_id', 'participant', 'submitter_id', 'sample_type_code', 'sample_type', 'tissue_type'] + attribute_names
+    for sample_id, sample in _sorted_items(samples):
+        yield ([sample_id, sample['case_id'], sample['submitter_id'],
+                SAMPLE_TYPE.getLetterCode(sample['sample_type_id']) if sample['sample_type_id'] is not None else '__DELETE__',
+                sample['sample_type'] if sample['sample_type'] is not None else '__DELETE__',
+                sample['tissue_type'] if sample['tissue_type'] is not None else '__DELETE__'] +
+               _attribute_values(sample, attribute_names))
+
+def _pair_rows(pairs, samples):
+    # header and rows of the pairs load file
+    attribute_names = _attribute_names(pairs, exclude={'tumor', 'normal'})
+    yield ['entity:pair_id', 'participant', 'case_sample', 'control_sample',
+           'tumor_submitter_id', 'normal_submitter_id',
+           'tumor_type', 'normal_type'] + attribute_names
+    for pair_id, pair in _sorted_items(pairs):
+        tumor_sample = samples[pair['tumor']]
+        normal_sample = samples[pair['normal']]
+        yield ([pair_id, tumor_sample['case_id'], pair['tumor'], pair['normal'],
+                tumor_sample['submitter_id'], normal_sample['submitter_id'],
+                SAMPLE_TYPE.getLetterCode(tumor_sample['sample_type_id']),
+                SAMPLE_TYPE.getLetterCode(normal_sample['sample_type_id'])] +
+               _attribute_values(pair, attribute_names))
+
+def _write_rows(filename, rows):
+    with open(filename, 'w', buffering=WRITE_BUFFER_SIZE) as loadFile:
+        writer = csv.writer(loadFile, delimiter='\t', lineterminator='\r\n')
+        writer.writerows(rows)
+
+@STATS.timed('write_participants')
+def create_participants_file(cases, manifestFileBasename):
+    _write_rows(manifestFileBasename + '_participants.tsv', _participant_rows(cases))
+    _write_rows(manifestFileBasename + '_participant_sets_membership.tsv', _membership_rows('participant', cases))
 
+@STATS.timed('write_samples')
 def create_samples_file(samples, manifestFileBasename):
-    attribute_names = []
-    for sample_id, sample in samples.items():
-        for attribute_name in sample:
-            if attribute_name not in {'submitter_id', 'case_id', 'sample_type_id'} and attribute_name not in attribute_names:
-                attribute_names.append(attribute_name)
-
-    samples_filename = manifestFileBasename + '_samples.tsv'
-    sample_sets_membership_filename = manifestFileBasename + '_sample_sets_membership.tsv'
-    with open(samples_filename, 'w') as samplesFile, open(sample_sets_membership_filename, 'w') as membershipFile:
-        
-        fieldnames = ['entity:sample_id', 'participant', 'submitter_id', 'sample_type_code', 'sample_type', 'tissue_type' ] + attribute_names
-        sample_writer = csv.DictWriter(samplesFile, fieldnames=fieldnames, delimiter='\t')
-        sample_writer.writeheader()
-
-        fieldnames = ['membership:sample_set_id', 'sample']
-        membership_writer = csv.DictWriter(membershipFile, fieldnames=fieldnames, delimiter='\t')
-        membership_writer.writeheader()
-        
-        for sample_id, sample in samples.items():
-            entity_row = {'entity:sample_id' : sample_id, 'participant': sample['case_id'],
-                          'submitter_id' : sample['submitter_id'],
-                          'sample_type_code' : SAMPLE_TYPE.getLetterCode(sample['sample_type_id']) if sample['sample_type_id'] is not None else '__DELETE__',
-                          'sample_type' : sample['sample_type'] if sample['sample_type'] is not None else '__DELETE__',
-                          'tissue_type' : sample['tissue_type'] if sample['tissue_type'] is not None else '__DELETE__'}
-            for attribute_name in attribute_names:
-                if attribute_name in sample:
-                    entity_row[attribute_name] = sample[attribute_name]
-                else:
-                    entity_row[attribute_name] = '__DELETE__'
-            sample_writer.writerow(entity_row)
+    _write_rows(manifestFileBasename + '_samples.tsv', _sample_rows(samples))
+    _write_rows(manifestFileBasename + '_sample_sets_membership.tsv', _membership_rows('sample', samples))
 
-            membership_row = {'membership:sample_set_id' : 'ALL',
-                              'sample': sample_id}
-            membership_writer.writerow(membership_row)
-                        
+@STATS.timed('write_pairs')
 def create_pairs_file(pairs, samples, manifestFileBasename):
-    attribute_names = []
-    for pair_id, pair in pairs.items():
-        for attribute_name in pair:
-            if attribute_name not in {'tumor', 'normal'} and attribute_name not in attribute_names:
-                attribute_names.append(attribute_name)
-
-    pairs_filename = manifestFileBasename + '_pairs.tsv'
-    pair_sets_membership_filename = manifestFileBasename + '_pair_sets_membership.tsv'
-    with open(pairs_filename, 'w') as pairsFile, open(pair_sets_membership_filename, 'w') as membershipFile:
-        fieldnames = ['entity:pair_id', 'participant', 'case_sample', 'control_sample',
-                    'tumor_submitter_id', 'normal_submitter_id',
-                    'tumor_type', 'normal_type'] + attribute_names
-        pairs_writer = csv.DictWriter(pairsFile, fieldnames=fieldnames, delimiter='\t')
-        pairs_writer.writeheader()
-
-        fieldnames = ['membership:pair_set_id', 'pair']
-        membership_writer = csv.DictWriter(membershipFile, fieldnames=fieldnames, delimiter='\t')
-        membership_writer.writeheader()
-        
-        for pair_id, pair in pairs.items():
-
-            tumor_submitter_id = samples[pair['tumor']]['submitter_id']
-            normal_submitter_id = samples[pair['normal']]['submitter_id']
-            entity_row = {'entity:pair_id' : pair_id,
-                          'participant' : samples[pair['tumor']]['case_id'],
-                          'case_sample' : pair['tumor'],
-                          'control_sample' : pair['normal'],
-                          'tumor_submitter_id' : tumor_submitter_id,
-                          'normal_submitter_id' : normal_submitter_id,
-                          'tumor_type' : SAMPLE_TYPE.getLetterCode(samples[pair['tumor']]['sample_type_id']),
-                          'normal_type' : SAMPLE_TYPE.getLetterCode(samples[pair['normal']]['sample_type_id'])}
-            for attribute_name in attribute_names:
-                if attribute_name in pair:
-                    entity_row[attribute_name] = pair[attribute_name]
-                else:
-                    entity_row[attribute_name] = '__DELETE__'
-            pairs_writer.writerow(entity_row)
-
-            row = {'membership:pair_set_id' : 'ALL',
-                   'pair': pair_id}
-            membership_writer.writerow(row)
+    _write_rows(manifestFileBasename + '_pairs.tsv', _pair_rows(pairs, samples))
+    _write_rows(manifestFileBasename + '_pair_sets_membership.tsv', _membership_rows('pair', pairs))
 
 
-def create_workspace_attributes_file(manifestFileBasename, is_legacy):
+def workspace_attributes(is_legacy):
+    """The workspace attributes, in the order FireCloud needs them: name -> value."""
     #This part is hardcoded due to the small number of attributes we need to specify.
     #Please feel free to change this specification according to your needs.
     legacy_flag="false"
@@ -1114,19 +1405,520 @@ def create_workspace_attributes_file(manifestFileBasename, is_legacy):
 
     #Due to a somewhat weird bug in FireCloud, please keep the workspace-colunm-defaults attribute as the last one in the list.
     #Any new attributes should be added before workspace-column-defaults
+    return collections.OrderedDict([
+        ('legacy_flag', legacy_flag),
+        ('workspace-column-defaults', "{\"participant\": {\"shown\": [\"submitter_id\", \"project_id\", \"participant_id\"]}, \"sample\":{\"shown\":[\"submitter_id\", \"sample_id\", \"participant\", \"sample_type\"]}, \"pair\":{\"shown\":[\"tumor_submitter_id\", \"normal_submitter_id\", \"pair_id\"]}}")])
+
+def create_workspace_attributes_file(manifestFileBasename, is_legacy):
+    attributes = workspace_attributes(is_legacy)
     with open(manifestFileBasename + "_workspace_attributes.tsv", 'w') as workspaceColumnOrderFile:
-        workspaceColumnOrderFile.write("workspace:legacy_flag\tworkspace-column-defaults\n")
-        workspaceColumnOrderFile.write(legacy_flag + "\t" + "{\"participant\": {\"shown\": [\"submitter_id\", \"project_id\", \"participant_id\"]}, \"sample\":{\"shown\":[\"submitter_id\", \"sample_id\", \"participant\", \"sample_type\"]}, \"pair\":{\"shown\":[\"tumor_submitter_id\", \"normal_submitter_id\", \"pair_id\"]}}")
+        workspaceColumnOrderFile.write("workspace:" + "\t".join(attributes) + "\n")
+        workspaceColumnOrderFile.write("\t".join(attributes.values()))
 
 
-def main():
-    parser = argparse.ArgumentParser(description='create FireCloud workspace load files from GDC manifest')
-    parser.add_argument("manifest", help="manifest file from the GDC Data Portal")
+def _attempt(process, work_item, attempt, skip_value_errors):
+    file_uuid, filename, file_metadata = work_item
+    try:
+        process(file_uuid, filename, file_metadata)
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except Exception as x:
+        if skip_value_errors and isinstance(x, ValueError):
+            print('Value Error, skip: {0}'.format(x))
+            STATS.increment('files_skipped')
+            return True
+        print(''.join(traceback.format_exception(type(x), x, x.__traceback__)))
+        print("attempt=", attempt, 'file uuid = ', file_uuid)
+        STATS.increment('file_processing_failures')
+        return False
+    return True
+
+def _file_details(file_uuid, filename, deferred):
+    # the per-file state that later files' processing depends on
+    details = {'filename' : filename}
+    if file_uuid in BAM_INDEX_FILE_UUIDS:
+        details['index_files'] = BAM_INDEX_FILE_UUIDS[file_uuid]
+    if file_uuid in FILE_ALIQUOTS:
+        details['aliquots'] = FILE_ALIQUOTS[file_uuid]
+    if file_uuid in FILE_ATTRIBUTE_SLOTS:
+        details['slots'] = FILE_ATTRIBUTE_SLOTS[file_uuid]
+    if file_uuid in FILE_CLASSIFICATIONS:
+        details['classification'] = FILE_CLASSIFICATIONS[file_uuid]
+    if deferred:
+        details['num_cases'] = DEFERRED_FILE_NUM_OF_CASES[file_uuid]
+        details['file_metadata'] = DEFERRED_FILE_METADATA[file_uuid]
+    return details
+
+def _journal_attempt(journal, phase, work_item, done):
+    # journals the entities touched by an attempt at processing a file, along with the file's details
+    file_uuid, filename, _ = work_item
+    deferred = phase == 'files' and done and file_uuid in DEFERRED_FILE_NUM_OF_CASES
+    journal.record(phase, file_uuid, done, **_file_details(file_uuid, filename, deferred))
+
+def _restore_from_journal(journal, deferred_file_uuids):
+    # rebuilds the entity tables and per-file state from a journal; returns, for each phase, the uuids 
+    # of the files that are done, and the (kind, entity id) of the entities touched by each (phase, file uuid)
+    done = {'files' : set(), 'deferred' : set()}
+    touched = collections.defaultdict(set)
+
+    def restore_file(phase, file_uuid, is_done, details):
+        UUID_TO_FILENAME[file_uuid] = details['filename']
+        if 'index_files' in details:
+            BAM_INDEX_FILE_UUIDS[file_uuid] = details['index_files']
+        if 'aliquots' in details:
+            FILE_ALIQUOTS[file_uuid] = details['aliquots']
+        if 'slots' in details:
+            FILE_ATTRIBUTE_SLOTS[file_uuid] = details['slots']
+        if 'classification' in details:
+            FILE_CLASSIFICATIONS[file_uuid] = details['classification']
+        if 'num_cases' in details:
+            DEFERRED_FILE_NUM_OF_CASES[file_uuid] = details['num_cases']
+            DEFERRED_FILE_METADATA[file_uuid] = details['file_metadata']
+            deferred_file_uuids.append(file_uuid)
+        if is_done:
+            done[phase].add(file_uuid)
+        else:
+            done[phase].discard(file_uuid)
+
+    for record in journal.replay():
+        if record['phase'] == 'snapshot':
+            for phase in done:
+                done[phase].clear()
+            touched.clear()
+            del deferred_file_uuids[:]
+            for details in record['files']:
+                restore_file(details['phase'], details['uuid'], details['done'], details)
+                touched[(details['phase'], details['uuid'])].update((kind, entity_id) for kind, entity_ids in details['touched'].items()
+                                                                    for entity_id in entity_ids)
+        elif record['phase'] in done:
+            restore_file(record['phase'], record['uuid'], record['done'], record)
+            touched[(record['phase'], record['uuid'])].update((kind, change[0]) for kind, changes in record['entities'].items()
+                                                              for change in changes)
+
+    _find_pending_index_files(journal.tables.values())
+    return done, touched
+
+def _find_pending_index_files(tables):
+    # BAI placeholders still waiting for _resolve_pending_index_files
+    for table in tables:
+        for entity_id, entity in table.items():
+            for attribute_name, value in entity.items():
+                if value is None and '__bai__' in attribute_name and attribute_name.endswith(DRS_URL_ATTRIBUTE_SUFFIX):
+                    bam_uuid = _get_file_uuid_from_drs_url(entity[attribute_name.replace('__bai__', '__bam__')])
+                    PENDING_INDEX_FILE_ATTRIBUTES[(entity_id, attribute_name)] = (table, bam_uuid)
+
+def _journal_index_files(journal, pending):
+    # journals the entities whose BAI attributes _resolve_pending_index_files filled in or removed, along with
+    # those _reduce_collisions changed
+    for entity_id, _ in pending:
+        for table in journal.tables.values():
+            if table.peek(entity_id) is not None:
+                table.touch(entity_id)
+    journal.record('index_files', None, True)
+
+def _create_table(kind, store=None, journaled=False, name=None, cache_size=DEFAULT_CACHE_ENTITIES):
+    # an entity table kept in memory, or in store if given
+    if store is not None:
+        return store.table(kind, name=name, cache_size=cache_size, journaled=journaled)
+    return JournaledTable(kind) if journaled else EntityTable(kind)
+
+def _load_entities(journal_path, store=None, cache_size=DEFAULT_CACHE_ENTITIES):
+    # the participant, sample and pair entities recorded in a journal, without any per-file state
+    tables = [_create_table(kind, store, name='previous_' + kind, cache_size=cache_size) for kind in ['participant', 'sample', 'pair']]
+    for _ in RunJournal(journal_path, tables).replay():
+        pass
+    return {table.kind : table for table in tables}
+
+def _remove_files(file_uuids, tables):
+    # removes each attribute that refers to one of file_uuids, and the BAI attribute that goes with it;
+    # returns the (entity id, attribute name) of the vacated attributes
+    vacated = set()
+    for table in tables:
+        for entity_id, entity in table.items():
+            for attribute_name in list(entity):
+                value = entity.get(attribute_name)
+                if not attribute_name.endswith(DRS_URL_ATTRIBUTE_SUFFIX) or not isinstance(value, str):
+                    continue
+                if _get_file_uuid_from_drs_url(value) in file_uuids:
+                    table.delete_attribute(entity_id, attribute_name)
+                    table.delete_attribute(entity_id, attribute_name.replace('__bam__', '__bai__'))
+                    vacated.add((entity_id, attribute_name))
+    return vacated
+
+def _start_incremental(journal, manifestRows, all_cases, deferred_file_uuids):
+    # restores the state of a previous run from its journal and reconciles it with the new manifest:
+    # attributes referring to files no longer in the manifest are removed, entities that only such files
+    # created are dropped, and files that competed for the vacated attributes are marked for reprocessing.
+    # Returns, for each phase, the uuids of the files that need no processing, and the files' touched entities
+    done, touched = _restore_from_journal(journal, deferred_file_uuids)
+    manifest_uuids = set(item.id for item in manifestRows)
+    removed = set(file_uuid for phase in done for file_uuid in done[phase] if file_uuid not in manifest_uuids)
+
+    vacated = _remove_files(removed, journal.tables.values())
+    for file_uuid in removed:
+        FILE_ATTRIBUTE_SLOTS.pop(file_uuid, None)
+
+    # an entity survives if some remaining file would create it when processed from scratch
+    surviving = set()
+    for (phase, file_uuid), entities in touched.items():
+        if file_uuid not in manifest_uuids:
+            continue
+        if phase == 'files':
+            surviving.update(entities)
+        elif all_cases:
+            surviving.update(entity for entity in entities if entity[0] == 'participant')
+    for table in journal.tables.values():
+        for entity_id in [entity_id for entity_id in table if (table.kind, entity_id) not in surviving]:
+            del table[entity_id]
+
+    reprocess = set(file_uuid for file_uuid in done['files'] if file_uuid in manifest_uuids
+                    and not vacated.isdisjoint(tuple(slot) for slot in FILE_ATTRIBUTE_SLOTS.get(file_uuid, ())))
+    done['files'] -= removed | reprocess
+    deferred_file_uuids[:] = [file_uuid for file_uuid in deferred_file_uuids if file_uuid in manifest_uuids]
+    added = manifest_uuids - done['files']
+    if len(added) > 0 or len(removed) > 0:
+        # multi-case files attach to whichever cases and samples exist; rerun them all, from their journaled metadata
+        done['deferred'].clear()
+    for (phase, file_uuid) in list(touched):
+        if file_uuid in removed:
+            del touched[(phase, file_uuid)]
+    print("incremental run: {0} files removed, {1} files to process, of which {2} to re-resolve vacated attributes".format(
+          len(removed), len(added), len(reprocess)))
+    return done, touched
+
+def _journal_snapshot(journal, done, touched, deferred_file_uuids):
+    # records the reconciled state of an incremental run, so that it can be resumed or serve as a later run's baseline
+    deferred = set(deferred_file_uuids)
+    files = []
+    for (phase, file_uuid), entities in touched.items():
+        details = _file_details(file_uuid, UUID_TO_FILENAME[file_uuid], phase == 'files' and file_uuid in deferred)
+        entity_ids = collections.defaultdict(list)
+        for kind, entity_id in sorted(entities):
+            entity_ids[kind].append(entity_id)
+        details.update({'phase' : phase, 'uuid' : file_uuid, 'done' : file_uuid in done[phase], 'touched' : entity_ids})
+        files.append(details)
+    journal.snapshot(files)
+
+def _changed_entities(previous, table):
+    # entities added or changed since the previous run, with __DELETE__ for the attributes they lost
+    changed = EntityTable(table.kind)
+    for entity_id, entity in table.items():
+        previous_entity = previous.get(entity_id)
+        if previous_entity == entity:
+            continue
+        delta = dict(entity)
+        if previous_entity is not None:
+            for attribute_name in previous_entity:
+                if attribute_name not in entity:
+                    delta[attribute_name] = '__DELETE__'
+        changed[entity_id] = delta
+    return changed
+
+def create_delta_files(previous, cases, samples, pairs, manifestFileBasename):
+    # load files with only the entities that changed since the previous run, and a list of the entities 
+    # that no longer exist
+    deltaFileBasename = manifestFileBasename + '_delta'
+    changed_cases = _changed_entities(previous['participant'], cases)
+    changed_samples = _changed_entities(previous['sample'], samples)
+    changed_pairs = _changed_entities(previous['pair'], pairs)
+    create_participants_file(changed_cases, deltaFileBasename)
+    create_samples_file(changed_samples, deltaFileBasename)
+    if len(changed_pairs) != 0:
+        create_pairs_file(changed_pairs, samples, deltaFileBasename)
+
+    deleted = [(kind, entity_id) for kind, table in [('participant', cases), ('sample', samples), ('pair', pairs)]
+               for entity_id in previous[kind] if entity_id not in table]
+    if len(deleted) != 0:
+        with open(deltaFileBasename + '_deleted_entities.tsv', 'w') as deletedFile:
+            writer = csv.writer(deletedFile, delimiter='\t')
+            writer.writerow(['entity_type', 'entity_id'])
+            writer.writerows(deleted)
+    print("delta: {0} participants, {1} samples, {2} pairs changed; {3} entities deleted".format(
+          len(changed_cases), len(changed_samples), len(changed_pairs), len(deleted)))
+
+def _process_with_retry_queue(work_items, process, skip_value_errors=False, journal=None, phase=None):
+    # each (file_uuid, filename, file_metadata) work item is processed once; an item whose processing fails
+    # goes to the back of a retry queue instead of blocking the pipeline, and is retried after the remaining
+    # items have been processed. Backoff between attempts is left to the transport layer (see gdc_session).
+    # Every attempt is journaled, if a journal is given.
+    def process_item(work_item, attempt):
+        done = _attempt(process, work_item, attempt, skip_value_errors)
+        if journal is not None:
+            _journal_attempt(journal, phase, work_item, done)
+        return done
+
+    retry_queue = collections.deque()
+    for work_item in work_items:
+        if not process_item(work_item, 0):
+            retry_queue.append((work_item, 1))
+
+    if len(retry_queue) > 0:
+        print("Retrying {0} failed files...".format(len(retry_queue)))
+    while retry_queue:
+        work_item, attempt = retry_queue.popleft()
+        if process_item(work_item, attempt):
+            continue
+        if attempt + 1 < MAX_ATTEMPTS:
+            retry_queue.append((work_item, attempt + 1))
+        else:
+            #failed all attempts
+            # - just move on
+            STATS.increment('files_skipped')
+            print("failed {0} attempts! SKIPPING FILE: file uuid = ".format(MAX_ATTEMPTS), work_item[0])
+
+def _merge_entities(merged, shard):
+    # adds the entities of a shard, and the attributes the merged entities lack, to the merged entities.  Which of 
+    # several files for the same attribute is kept is decided by _reduce_collisions once all shards are merged
+    for entity_id, entity in shard.items():
+        existing = merged.peek(entity_id)
+        if existing is None:
+            merged[entity_id] = entity
+            continue
+        present = set(existing)
+        for attribute_name, value in entity.items():
+            if attribute_name in present:
+                continue
+            # a BAI attribute goes with the BAM attribute it indexes
+            bam_attribute_name = attribute_name.replace('__bai__', '__bam__')
+            if bam_attribute_name != attribute_name and bam_attribute_name in present:
+                continue
+            merged.set_attribute(entity_id, attribute_name, value)
+
+def _add_run_arguments(parser):
+    # arguments shared by genFcWsLoadFiles and genFcWsLoadFiles merge
     parser.add_argument("-l", "--legacy", help="point to GDC Legacy Archive", action="store_true")
+    parser.add_argument("--gdc_api_root", help="root URL of the GDC API, e.g. of a local stand-in started with gdcStubServer " +
+                        "(default: {0}, or {1} with --legacy)".format(GDC_API_ROOT, GDC_LEGACY_API_ROOT))
     parser.add_argument("-c", "--all_cases", help="create participant entities for all referenced cases", action="store_true")
-    args = parser.parse_args()
+    parser.add_argument("-b", "--batch_size", help="number of files whose metadata is retrieved per GDC query (default: {0})".format(DEFAULT_BATCH_SIZE),
+                        type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("-j", "--jobs", help="number of GDC metadata queries kept in flight at once (default: {0})".format(DEFAULT_JOBS),
+                        type=int, default=DEFAULT_JOBS)
+    parser.add_argument("--cache_dir", help="directory of the persistent GDC metadata cache (default: {0})".format(DEFAULT_CACHE_DIR),
+                        default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--cache_ttl", help="hours after which cached GDC metadata is refetched (default: {0})".format(DEFAULT_TTL_HOURS),
+                        type=float, default=DEFAULT_TTL_HOURS)
+    parser.add_argument("--cache_max_size", help="maximum size in MB of the GDC metadata cache (default: {0})".format(DEFAULT_MAX_SIZE_MB),
+                        type=float, default=DEFAULT_MAX_SIZE_MB)
+    parser.add_argument("--no_cache", help="do not read or write the persistent GDC metadata cache", action="store_true")
+    parser.add_argument("--bundle", help="metadata bundle written by manifest_downloader.download_metadata_bundle, optionally " +
+                        "gzip compressed, from which all file and case metadata is read instead of from the GDC: no GDC " +
+                        "request is made, and files missing from the bundle are skipped")
+    parser.add_argument("--pool_size", help="maximum number of pooled connections to the GDC (default: {0})".format(DEFAULT_POOL_SIZE),
+                        type=int, default=DEFAULT_POOL_SIZE)
+    parser.add_argument("--retries", help="number of times a failed GDC request is retried (default: {0})".format(DEFAULT_RETRIES),
+                        type=int, default=DEFAULT_RETRIES)
+    parser.add_argument("--max_rate", help="maximum number of GDC requests per second the adaptive rate may rise to; " +
+                        "0 for no limit (default: {0})".format(DEFAULT_MAX_RATE),
+                        type=float, default=DEFAULT_MAX_RATE)
+    parser.add_argument("--initial_rate", help="number of GDC requests per second the rate starts at (default: {0})".format(DEFAULT_INITIAL_RATE),
+                        type=float, default=DEFAULT_INITIAL_RATE)
+    parser.add_argument("--target_latency", help="GDC response time in seconds below which request concurrency is ramped up (default: {0})".format(DEFAULT_TARGET_LATENCY),
+                        type=float, default=DEFAULT_TARGET_LATENCY)
+    parser.add_argument("--stats_json", help="write a report of per-stage wall time, GDC request counts, latencies, bytes received " +
+                        "and retries to this file")
+    parser.add_argument("--stats_format", help="format of the --stats_json report; openmetrics writes a textfile that " +
+                        "metrics collectors can scrape (default: json)", choices=STATS_FORMATS, default='json')
+    parser.add_argument("--store", help="where to keep the participant, sample and pair entities and the per-file state while " +
+                        "the manifest is processed; disk keeps them in a temporary SQLite database, for builds larger than memory " +
+                        "(default: memory)", choices=STORES, default='memory')
+    parser.add_argument("--store_dir", help="directory of the --store disk database (default: the system's temporary directory)")
+    parser.add_argument("--store_cache_size", help="number of entities of each type that --store disk keeps cached in memory (default: {0})".format(DEFAULT_CACHE_ENTITIES),
+                        type=int, default=DEFAULT_CACHE_ENTITIES)
+    parser.add_argument("-p", "--prefetch_biospecimens", help="retrieve the case/sample/aliquot tree of the manifest's projects in bulk " +
+                        "instead of per file and per case; ignored with --bundle", action="store_true")
+
+def _reset_state():
+    # forget the per-file state of an earlier run in the same process
+    global UUID_TO_FILENAME, DEFERRED_FILE_NUM_OF_CASES, DEFERRED_FILE_METADATA, METADATA_CACHE, BIOSPECIMEN_INDEX
+    global BAM_INDEX_FILE_UUIDS, FILE_ALIQUOTS, FILE_ATTRIBUTE_SLOTS, FILE_CLASSIFICATIONS
+    UUID_TO_FILENAME = dict()
+    DEFERRED_FILE_NUM_OF_CASES = dict()
+    DEFERRED_FILE_METADATA = dict()
+    BAM_INDEX_FILE_UUIDS = dict()
+    FILE_ALIQUOTS = dict()
+    FILE_ATTRIBUTE_SLOTS = dict()
+    FILE_CLASSIFICATIONS = dict()
+    METADATA_CACHE = None
+    BIOSPECIMEN_INDEX = None
+    PENDING_INDEX_FILE_ATTRIBUTES.clear()
+
+def _configure_run(args):
+    # sets up the GDC session, metadata cache, biospecimen index and disk store; returns the GDC API root, 
+    # the request rate controller and the disk store, or None
+    _reset_state()
+
+    if args.gdc_api_root is not None:
+        gdc_api_root = args.gdc_api_root.rstrip('/')
+    else:
+        gdc_api_root = GDC_LEGACY_API_ROOT if args.legacy else GDC_API_ROOT
+
+    controller = AdaptiveRateController(max_rate=args.max_rate, max_concurrency=args.jobs, target_latency=args.target_latency,
+                                        initial_rate=args.initial_rate)
+    configure_session(pool_size=max(args.pool_size, args.jobs), retries=args.retries, controller=controller)
+
+    global METADATA_CACHE
+    if args.bundle is not None:
+        METADATA_CACHE = MetadataBundle(args.bundle)
+        print("metadata bundle {0}: {1} files, {2} cases".format(args.bundle, len(METADATA_CACHE.files), len(METADATA_CACHE.cases)))
+    elif not args.no_cache:
+        METADATA_CACHE = MetadataCache(args.cache_dir, args.cache_ttl * 3600, int(args.cache_max_size * 2**20))
+
+    global BIOSPECIMEN_INDEX
+    if args.prefetch_biospecimens and args.bundle is None:
+        BIOSPECIMEN_INDEX = BiospecimenIndex(gdc_api_root, args.batch_size)
+
+    store = None
+    if args.store == 'disk':
+        store = EntityStore(args.store_dir)
+        global UUID_TO_FILENAME, DEFERRED_FILE_NUM_OF_CASES, DEFERRED_FILE_METADATA
+        global BAM_INDEX_FILE_UUIDS, FILE_ALIQUOTS, FILE_ATTRIBUTE_SLOTS, FILE_CLASSIFICATIONS
+        UUID_TO_FILENAME = store.mapping('filenames')
+        DEFERRED_FILE_NUM_OF_CASES = store.mapping('num_cases')
+        DEFERRED_FILE_METADATA = store.mapping('deferred_metadata')
+        BAM_INDEX_FILE_UUIDS = store.mapping('index_files')
+        FILE_ALIQUOTS = store.mapping('aliquots')
+        FILE_ATTRIBUTE_SLOTS = store.mapping('slots')
+        FILE_CLASSIFICATIONS = store.mapping('classifications')
+    return gdc_api_root, controller, store
+
+def _write_load_files(cases, samples, pairs, manifestFileBasename):
+    create_participants_file(cases, manifestFileBasename)
+    create_samples_file(samples, manifestFileBasename)
+    if len(pairs) != 0:
+        create_pairs_file(pairs, samples, manifestFileBasename)
 
-    gdc_api_root = GDC_LEGACY_API_ROOT if args.legacy else GDC_API_ROOT
+    #This part creates a file that specifies the workspace attributes. 
+    #The attributes are:
+    # 1.Default order of columns when shown in the workspace.
+    # 2.Whether the workspace is meant to deal with data fom the legacy site or not.
+    create_workspace_attributes_file(manifestFileBasename, False)
+
+def _finish_run(args, controller, deferred_file_uuids):
+    print(controller.format_metrics())
+    if METADATA_CACHE is not None:
+        print("metadata {0}: {1} hits, {2} misses".format('bundle' if args.bundle is not None else 'cache', METADATA_CACHE.hits, METADATA_CACHE.misses))
+        METADATA_CACHE.close()
+
+    if args.stats_json is not None:
+        for name, value in controller.metrics().items():
+            STATS.set_gauge('rate_controller_' + name, value)
+        if METADATA_CACHE is not None:
+            STATS.increment('metadata_cache_hits', METADATA_CACHE.hits)
+            STATS.increment('metadata_cache_misses', METADATA_CACHE.misses)
+        STATS.increment('deferred_files', len(deferred_file_uuids))
+        STATS.write(args.stats_json, args.stats_format)
+        print("run statistics written to {0}".format(args.stats_json))
+
+def _process_deferred_files(deferred_file_uuids, done, cases, samples, all_cases, gdc_api_root, journal=None):
+    print("Processing deferred files...")
+    def deferred_work_items():
+        for file_uuid in deferred_file_uuids:
+            if file_uuid in done:
+                continue
+            filename = UUID_TO_FILENAME[file_uuid]
+            file_metadata = DEFERRED_FILE_METADATA[file_uuid]
+            print("{0}, {1} ".format(file_uuid, filename))
+            yield file_uuid, filename, file_metadata
+
+    def process_deferred_file(file_uuid, filename, file_metadata):
+        process_deferred_file_uuid(file_uuid, filename, cases, samples, all_cases, gdc_api_root, file_metadata)
+
+    _process_with_retry_queue(deferred_work_items(), process_deferred_file, journal=journal, phase='deferred')
+
+def merge_main(argv=None):
+    parser = argparse.ArgumentParser(prog='genFcWsLoadFiles merge',
+                                     description='combine the states written by genFcWsLoadFiles --shard runs into FireCloud workspace load files')
+    parser.add_argument("shard_states", metavar="shard_state", nargs='+', help="journal written by a genFcWsLoadFiles --shard run, one per shard")
+    parser.add_argument("-o", "--output_basename", help="prefix of the load files (default: the basename of the shards' manifest)")
+    _add_run_arguments(parser)
+    args = parser.parse_args(argv)
+
+    shards = dict()
+    for path in args.shard_states:
+        journal = RunJournal(path, [])
+        try:
+            header = journal.header()
+        except (OSError, ValueError) as x:
+            parser.error("cannot read shard state {0}: {1}".format(path, x))
+        if 'shard' not in header:
+            parser.error("{0} is not the state of a --shard run".format(path))
+        shard_index, num_shards = header['shard']
+        if shard_index in shards:
+            parser.error("{0} and {1} are both states of shard {2}".format(shards[shard_index][0], path, shard_index))
+        last_record = journal.last_record()
+        if last_record is None or last_record.get('phase') != 'index_files':
+            parser.error("{0} is the state of an unfinished shard; complete it with --resume".format(path))
+        shards[shard_index] = (path, header['manifest'], num_shards)
+    num_shards = set(num_shards for _, _, num_shards in shards.values())
+    if len(num_shards) > 1:
+        parser.error("shard states are from runs split into different numbers of shards: {0}".format(sorted(num_shards)))
+    missing = sorted(set(range(1, num_shards.pop() + 1)) - set(shards))
+    if len(missing) > 0:
+        parser.error("missing the states of shards {0}".format(', '.join(str(shard_index) for shard_index in missing)))
+
+    manifestFileBasename = args.output_basename
+    if manifestFileBasename is None:
+        manifestFileBasename = _manifest_basename(shards[1][1])
+
+    gdc_api_root, controller, store = _configure_run(args)
+
+    cases = _create_table('participant', store, cache_size=args.store_cache_size)
+    samples = _create_table('sample', store, cache_size=args.store_cache_size)
+    pairs = _create_table('pair', store, cache_size=args.store_cache_size)
+    shard_tables = [_create_table(kind, store, name='shard_' + kind, cache_size=args.store_cache_size) for kind in ['participant', 'sample', 'pair']]
+    deferred_file_uuids = []
+
+    for shard_index in sorted(shards):
+        path = shards[shard_index][0]
+        print("merging shard {0}/{1} from {2}".format(shard_index, len(shards), path))
+        for table in shard_tables:
+            table.clear()
+        _restore_from_journal(RunJournal(path, shard_tables), deferred_file_uuids)
+        for merged, shard in zip([cases, samples, pairs], shard_tables):
+            _merge_entities(merged, shard)
+    for table in shard_tables:
+        table.clear()
+    PENDING_INDEX_FILE_ATTRIBUTES.clear()
+    _find_pending_index_files([cases, samples, pairs])
+
+    _process_deferred_files(deferred_file_uuids, set(), cases, samples, args.all_cases, gdc_api_root)
+    _reduce_collisions([cases, samples, pairs])
+    _resolve_pending_index_files(gdc_api_root, args.batch_size)
+
+    _write_load_files(cases, samples, pairs, manifestFileBasename)
+    _finish_run(args, controller, deferred_file_uuids)
+    if store is not None:
+        store.close()
+
+def _create_parser():
+    parser = argparse.ArgumentParser(description='create FireCloud workspace load files from GDC manifest',
+                                     epilog='Run "genFcWsLoadFiles merge -h" for combining the results of --shard runs.')
+    parser.add_argument("manifest", help="manifest file from the GDC Data Portal, optionally gzip or bzip2 compressed, " +
+                        "or - to read it from stdin (load files are then named manifest_*.tsv)")
+    _add_run_arguments(parser)
+    parser.add_argument("--journal", help="journal the processed files and the entity changes they caused to this file, from which an " +
+                        "interrupted run can be resumed; an existing file is overwritten unless --resume is given.  Runs are only " +
+                        "journaled with --journal, --resume, --previous or --shard (default: <manifest basename>_journal.jsonl)")
+    parser.add_argument("--checkpoint_interval", help="maximum number of seconds between journal flushes (default: {0})".format(DEFAULT_CHECKPOINT_INTERVAL),
+                        type=float, default=DEFAULT_CHECKPOINT_INTERVAL)
+    parser.add_argument("--previous", help="journal of a previous run to update: only files added to the manifest, and files competing " +
+                        "for attributes vacated by removed files, are processed, and delta load files with only the changed entities are written")
+    parser.add_argument("--resume", help="restore the state of an interrupted run from its journal and process only the " +
+                        "files it had not finished", action="store_true")
+    parser.add_argument("--shard", help="process only shard i of N of the manifest, e.g. 1/4, and write its state to the journal " +
+                        "(default: <manifest basename>_shard_<i>_of_<N>_journal.jsonl) instead of load files; combine the states " +
+                        "of all shards with genFcWsLoadFiles merge", type=_parse_shard)
+    return parser
+
+def _run(args, error, write_load_files=True):
+    # processes args.manifest, writing the load files (or, for a --shard run, the shard's state) if 
+    # write_load_files, and returns a WorkspaceModel of the entities; invalid arguments are reported 
+    # with error(message), which must not return
+    if args.shard is not None and args.previous is not None:
+        error("--shard cannot be combined with --previous")
+
+    gdc_api_root, controller, store = _configure_run(args)
 
     print("manifestFile = {0}".format(args.manifest))
 
@@ -1134,78 +1926,181 @@ def main():
 
     pp = pprint.PrettyPrinter()
 
-    cases = dict()
-    samples = dict()
-    pairs = dict()
+    manifestFileBasename = _manifest_basename(manifestFile)
+
+    journaled = args.journal is not None or args.resume or args.previous is not None or args.shard is not None
+    cases = _create_table('participant', store, journaled, cache_size=args.store_cache_size)
+    samples = _create_table('sample', store, journaled, cache_size=args.store_cache_size)
+    pairs = _create_table('pair', store, journaled, cache_size=args.store_cache_size)
+    if not journaled:
+        journal = None
+    else:
+        if args.journal is not None:
+            journal_path = args.journal
+        elif args.shard is not None:
+            journal_path = manifestFileBasename + '_shard_{0}_of_{1}_journal.jsonl'.format(*args.shard)
+        else:
+            journal_path = manifestFileBasename + '_journal.jsonl'
+        journal = RunJournal(journal_path, [cases, samples, pairs], args.checkpoint_interval)
     deferred_file_uuids = []
 
-    manifestFileList = _read_manifestFile(manifestFile)
+    manifestRows = _read_manifestFile(manifestFile, store.mapping('manifest_uuids') if store is not None else None)
+    if args.shard is not None:
+        # every file must be seen to compute the assignment of files to shards
+        manifestRows = _shard_rows(manifestRows, *args.shard)
+        print("shard {0}/{1}: {2} files".format(args.shard[0], args.shard[1], len(manifestRows)))
+
+    done = {'files' : set(), 'deferred' : set()}
+    previous = None
+    if journal is not None:
+        header = {'shard' : list(args.shard)} if args.shard is not None else {}
+        if args.previous is not None:
+            if os.path.abspath(args.previous) == os.path.abspath(journal.path):
+                error("the journal of this run must not overwrite the --previous journal; choose another with --journal")
+            previous = _load_entities(args.previous, store, args.store_cache_size)
+        if args.resume:
+            done, _ = _restore_from_journal(journal, deferred_file_uuids)
+            print("resuming from {0}: {1} files already processed".format(journal.path, len(done['files'])))
+            journal.start(manifestFile, True, **header)
+        elif args.previous is not None:
+            # removed files are only known once the whole manifest has been read
+            manifestRows = list(manifestRows)
+            done, touched = _start_incremental(RunJournal(args.previous, [cases, samples, pairs]), manifestRows, 
+                                               args.all_cases, deferred_file_uuids)
+            journal.start(manifestFile, False)
+            _journal_snapshot(journal, done, touched, deferred_file_uuids)
+        else:
+            journal.start(manifestFile, False, **header)
+    remainingRows = (item for item in manifestRows if item.id not in done['files'])
 
-    for i, item in enumerate(manifestFileList):
+    def manifest_work_items():
+        for i, (item, file_metadata) in enumerate(_iter_file_metadata(remainingRows, gdc_api_root, args.batch_size, args.jobs)):
 
-        file_uuid = item['id']
-        filename = item['filename']
+            file_uuid = item.id
+            filename = item.filename
     
-        UUID_TO_FILENAME[file_uuid] = filename
-
-        print('{0} of {1}: {2}, {3}'.format(i+1, len(manifestFileList), file_uuid, filename))
+            UUID_TO_FILENAME[file_uuid] = filename
+
+            print('{0}: {1}, {2}'.format(i+1, file_uuid, filename))
+            if (i+1) % METRICS_REPORT_INTERVAL == 0:
+                print(controller.format_metrics())
+            yield file_uuid, filename, file_metadata
+
+    def process_file(file_uuid, filename, file_metadata):
+        get_file_metadata(file_uuid, filename, cases, samples, 
+                          pairs, deferred_file_uuids, gdc_api_root, file_metadata)
+
+    _process_with_retry_queue(manifest_work_items(), process_file, skip_value_errors=True, journal=journal, phase='files')
+
+    # multi-case files of a shard attach to the cases and samples of all shards, and files of different shards
+    # may compete for the same attribute; both are left to the merge
+    if args.shard is None:
+        _process_deferred_files(deferred_file_uuids, done['deferred'], cases, samples, args.all_cases, gdc_api_root, journal)
+        _reduce_collisions([cases, samples, pairs])
+
+    pending = list(PENDING_INDEX_FILE_ATTRIBUTES)
+    _resolve_pending_index_files(gdc_api_root, args.batch_size)
+    if journal is not None:
+        _journal_index_files(journal, pending)
+        journal.close()
+
+    if args.shard is not None:
+        print("shard state written to {0}".format(journal.path))
+    elif write_load_files:
+        _write_load_files(cases, samples, pairs, manifestFileBasename)
+
+    if previous is not None and write_load_files:
+        create_delta_files(previous, cases, samples, pairs, manifestFileBasename)
+
+    _finish_run(args, controller, deferred_file_uuids)
+    return WorkspaceModel(cases, samples, pairs, workspace_attributes(False), store)
+
+class WorkspaceModel():
+    """The participant, sample and pair entities created from a manifest, and the workspace attributes:
+    the content of genFcWsLoadFiles' load files, as returned by create_workspace_model().
+
+    participants, samples and pairs are EntityTables mapping entity ids to their attributes.  
+    load_file_rows() and membership_file_rows() yield the header and rows of an entity type's load 
+    files exactly as genFcWsLoadFiles writes them.  With --store disk the entities are kept in a 
+    temporary database, which close() removes; the model can't be used after close().
+    """
 
-        for attempt in range(5):
-            try:
-                get_file_metadata(file_uuid, filename, cases, samples, 
-                                  pairs, deferred_file_uuids, gdc_api_root)
-                break
-            except (KeyboardInterrupt, SystemExit):
-                raise
-            except ValueError as x:
-                print('Value Error, skip: {0}'.format(x))
-                break
-            except Exception as x:
-                print(''.join(traceback.format_exception(etype=type(x), value=x, tb=x.__traceback__)))
-                print("attempt=", attempt, 'file uuid = ', file_uuid)
-                time.sleep((attempt+1)**2)
-        else:
-            #failed all attempts
-            # - just move on
-            print("failed 5 attempts! SKIPPING FILE: file uuid = ", file_uuid)
+    ENTITY_TYPES = ['participant', 'sample', 'pair']
+
+    def __init__(self, participants, samples, pairs, attributes, store=None):
+        self.participants = participants
+        self.samples = samples
+        self.pairs = pairs
+        self.attributes = attributes
+        self._store = store
+
+    def entities(self, entity_type):
+        """The EntityTable of the given entity type, e.g. 'sample'."""
+        return {'participant' : self.participants, 'sample' : self.samples, 'pair' : self.pairs}[entity_type]
+
+    def load_file_rows(self, entity_type):
+        """Header and rows of the entity type's load file."""
+        if entity_type == 'participant':
+            return _participant_rows(self.participants)
+        if entity_type == 'sample':
+            return _sample_rows(self.samples)
+        if entity_type == 'pair':
+            return _pair_rows(self.pairs, self.samples)
+        raise ValueError("unknown entity type: {0}".format(entity_type))
+
+    def membership_file_rows(self, entity_type):
+        """Header and rows of the load file that puts all entities of the type in the set ALL."""
+        return _membership_rows(entity_type, self.entities(entity_type))
+
+    def columns(self, entity_type):
+        """Header of the entity type's load file."""
+        return next(self.load_file_rows(entity_type))
+
+    def file_attributes(self, entity_type):
+        """Names of the entity type's attributes that reference GDC files."""
+        return [attribute_name for attribute_name in self.columns(entity_type) if attribute_name.endswith(DRS_URL_ATTRIBUTE_SUFFIX)]
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def create_workspace_model(manifest, write_load_files=False, **options):
+    """Create the workspace entities of a GDC manifest in process, as genFcWsLoadFiles does, and return 
+    them as a WorkspaceModel.
+
+    options are genFcWsLoadFiles' options, by long name, e.g. all_cases=True, jobs=8 or 
+    gdc_api_root='http://127.0.0.1:8000'; an unknown option raises TypeError and an invalid 
+    combination ValueError.  Load files are only written if write_load_files, and, as with 
+    genFcWsLoadFiles, the run is only journaled if journal, resume, previous or shard is given.
+    """
+    parser = _create_parser()
+    args = parser.parse_args([manifest])
+    for name, value in options.items():
+        if name == 'manifest' or not hasattr(args, name):
+            raise TypeError("unknown genFcWsLoadFiles option: {0}".format(name))
+        setattr(args, name, value)
 
+    def error(message):
+        raise ValueError(message)
 
-    print("Processing deferred files...")
-    for uuid_and_filename in deferred_file_uuids:
-        file_uuid = uuid_and_filename[0]
-        filename = uuid_and_filename[1]
-        print("{0}, {1} ".format(file_uuid, filename))
-
-        for attempt in range(5):
-            try:
-                process_deferred_file_uuid(file_uuid, filename, cases, samples, args.all_cases, gdc_api_root)
-            except (KeyboardInterrupt, SystemExit):
-                raise
-            except Exception as x:
-                print(''.join(traceback.format_exception(etype=type(x), value=x, tb=x.__traceback__)))
-                print("attempt=", attempt, 'file uuid = ', file_uuid)
-                time.sleep((attempt+1)**2)
-            else:
-                break
-        else:
-            #failed all attempts
-            # - just move on
-            print("failed 5 attempts! SKIPPING FILE: file uuid = ", file_uuid)
-            continue
+    return _run(args, error, write_load_files)
 
-    manifestFileBasename = os.path.splitext(os.path.basename(manifestFile))[0]
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        merge_main(sys.argv[2:])
+        return
 
-    create_participants_file(cases, manifestFileBasename)
-    create_samples_file(samples, manifestFileBasename)
-    if len(pairs) != 0:
-        create_pairs_file(pairs, samples, manifestFileBasename)
+    parser = _create_parser()
+    args = parser.parse_args()
+    _run(args, parser.error).close()
 
-    #This part creates a file that specifies the workspace attributes. 
-    #The attributes are:
-    # 1.Default order of columns when shown in the workspace.
-    # 2.Whether the workspace is meant to deal with data fom the legacy site or not.
-    create_workspace_attributes_file(manifestFileBasename, False)
-    
 
 if __name__ == '__main__':
     main()
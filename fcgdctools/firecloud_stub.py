@@ -0,0 +1,180 @@
+"""In-process stand-in for the subset of the FireCloud API (firecloud.api) that ws_builder uses.
+
+Keeps workspaces, their entities and method configs, and the templates of the method repository in
+memory, and answers each call with a response that has the status_code, text and json() of FireCloud's,
+so that ws_builder's uploads and provisioning can be run and benchmarked without FireCloud credentials
+or network access.
+Pass a FireCloudStub wherever ws_builder takes an fapi.  Like gdcStubServer, the stand-in can delay
+calls and fail a fraction of them.
+"""
+
+import copy
+import csv
+import io
+import json
+import random
+import threading
+import time
+
+# method repository configs that ws_builder bases its downloader configs on: (namespace, name, snapshot id) -> method config
+DEFAULT_TEMPLATES = {
+    ("broadinstitute_cga", "gdc_file_downloader__default_cfg", 3) : {
+        "namespace" : "broadinstitute_cga", "name" : "gdc_file_downloader__default_cfg",
+        "methodRepoMethod" : {"methodNamespace" : "broadinstitute_cga", "methodName" : "gdc_file_downloader", "methodVersion" : 3},
+        "rootEntityType" : "participant",
+        "inputs" : {"gdc_file_downloader_workflow.uuid_and_filename" : "",
+                    "gdc_file_downloader_workflow.gdc_file_downloader.gdc_user_token" : "workspace.token_file"},
+        "outputs" : {"gdc_file_downloader_workflow.gdc_file_downloader.file" : ""},
+        "prerequisites" : {}, "methodConfigVersion" : 1, "deleted" : False},
+    ("broadinstitute_cga", "gdc_bam_downloader__default_cfg", 2) : {
+        "namespace" : "broadinstitute_cga", "name" : "gdc_bam_downloader__default_cfg",
+        "methodRepoMethod" : {"methodNamespace" : "broadinstitute_cga", "methodName" : "gdc_bam_downloader", "methodVersion" : 2},
+        "rootEntityType" : "sample",
+        "inputs" : {"gdc_bam_downloader_workflow.uuid_and_filename" : ""},
+        "outputs" : {"gdc_bam_downloader_workflow.gdc_bam_downloader.bam_file" : "",
+                     "gdc_bam_downloader_workflow.gdc_bam_downloader.bai_file" : ""},
+        "prerequisites" : {}, "methodConfigVersion" : 1, "deleted" : False},
+}
+
+# columns of each entity type that reference other entities: column -> referenced entity type
+ENTITY_REFERENCES = {'sample' : {'participant' : 'participant'},
+                     'pair' : {'participant' : 'participant', 'case_sample' : 'sample', 'control_sample' : 'sample'}}
+
+class StubResponse():
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.text = body if isinstance(body, str) else json.dumps(body)
+
+    def json(self):
+        return json.loads(self.text)
+
+class FireCloudStub():
+    """Stand-in for firecloud.api: its methods take the arguments of the functions of the same name."""
+
+    def __init__(self, templates=None, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, max_upload_size=None, seed=None):
+        self.templates = copy.deepcopy(templates if templates is not None else DEFAULT_TEMPLATES)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        # size in bytes above which upload_entities fails with 413, standing in for FireCloud's request timeouts
+        self.max_upload_size = max_upload_size
+        self.random = random.Random(seed)
+        # (namespace, name) -> {'attributes' : ..., 'method_configs' : {(config namespace, config name) : config},
+        #                        'entities' : {entity type : {entity id : attributes}}}; a set's attributes are its members' ids
+        self.workspaces = dict()
+        self.request_counts = dict()
+        self.max_in_flight = 0
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def total_requests(self):
+        with self._lock:
+            return sum(self.request_counts.values())
+
+    def _call(self, name, handler):
+        with self._lock:
+            self.request_counts[name] = self.request_counts.get(name, 0) + 1
+            self._in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self._in_flight)
+            delay = self.latency + (self.random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+            failed = self.error_rate and self.random.random() < self.error_rate
+        try:
+            if delay > 0:
+                time.sleep(delay)
+            if failed:
+                return StubResponse(self.error_status, {'message' : 'injected error'})
+            with self._lock:
+                return handler()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _workspace(self, namespace, workspace):
+        return self.workspaces.get((namespace, workspace))
+
+    def create_workspace(self, namespace, name, authorizationDomain="", attributes=dict()):
+        def handler():
+            if (namespace, name) in self.workspaces:
+                return StubResponse(409, {'message' : 'Workspace {0}/{1} already exists'.format(namespace, name)})
+            self.workspaces[(namespace, name)] = {'attributes' : dict(attributes), 'method_configs' : dict(), 'entities' : dict()}
+            return StubResponse(201, {'namespace' : namespace, 'name' : name, 'attributes' : dict(attributes)})
+        return self._call('create_workspace', handler)
+
+    def get_repository_config(self, namespace, config, snapshot_id):
+        def handler():
+            template = self.templates.get((namespace, config, int(snapshot_id)))
+            if template is None:
+                return StubResponse(404, {'message' : 'configuration {0}/{1}/{2} not found'.format(namespace, config, snapshot_id)})
+            return StubResponse(200, {'namespace' : namespace, 'name' : config, 'snapshotId' : int(snapshot_id),
+                                      'entityType' : 'Configuration', 'payload' : json.dumps(template)})
+        return self._call('get_repository_config', handler)
+
+    def get_workspace_config(self, namespace, workspace, cnamespace, config):
+        def handler():
+            ws = self._workspace(namespace, workspace)
+            if ws is None or (cnamespace, config) not in ws['method_configs']:
+                return StubResponse(404, {'message' : 'method config {0}/{1} not found'.format(cnamespace, config)})
+            return StubResponse(200, ws['method_configs'][(cnamespace, config)])
+        return self._call('get_workspace_config', handler)
+
+    def create_workspace_config(self, namespace, workspace, body):
+        def handler():
+            ws = self._workspace(namespace, workspace)
+            if ws is None:
+                return StubResponse(404, {'message' : 'workspace {0}/{1} not found'.format(namespace, workspace)})
+            key = (body['namespace'], body['name'])
+            if key in ws['method_configs']:
+                return StubResponse(409, {'message' : 'method config {0}/{1} already exists'.format(*key)})
+            ws['method_configs'][key] = copy.deepcopy(body)
+            return StubResponse(201, body)
+        return self._call('create_workspace_config', handler)
+
+    def update_workspace_config(self, namespace, workspace, cnamespace, configname, body):
+        def handler():
+            ws = self._workspace(namespace, workspace)
+            if ws is None or (cnamespace, configname) not in ws['method_configs']:
+                return StubResponse(404, {'message' : 'method config {0}/{1} not found'.format(cnamespace, configname)})
+            del ws['method_configs'][(cnamespace, configname)]
+            ws['method_configs'][(body['namespace'], body['name'])] = copy.deepcopy(body)
+            return StubResponse(200, body)
+        return self._call('update_workspace_config', handler)
+
+    def upload_entities(self, namespace, workspace, entity_data, model='firecloud'):
+        """Import a load file's entities, or add the members of a membership load file to their sets.  
+        Like FireCloud, the import fails as a whole if it references an entity that doesn't exist."""
+        def handler():
+            ws = self._workspace(namespace, workspace)
+            if ws is None:
+                return StubResponse(404, {'message' : 'workspace {0}/{1} not found'.format(namespace, workspace)})
+            if self.max_upload_size is not None and len(entity_data.encode()) > self.max_upload_size:
+                return StubResponse(413, {'message' : 'request entity too large'})
+            rows = list(csv.reader(io.StringIO(entity_data), delimiter='\t'))
+            header = rows[0]
+            kind, _, id_column = header[0].partition(':')
+            entities = ws['entities']
+            if kind == 'entity':
+                entity_type = id_column[:-len('_id')]
+                references = ENTITY_REFERENCES.get(entity_type, {})
+                updates = []
+                for row in rows[1:]:
+                    attributes = dict(zip(header[1:], row[1:]))
+                    for column, referenced_type in references.items():
+                        if attributes.get(column) not in entities.get(referenced_type, {}):
+                            return StubResponse(400, {'message' : '{0} {1} not found'.format(referenced_type, attributes.get(column))})
+                    updates.append((row[0], attributes))
+                for entity_id, attributes in updates:
+                    entities.setdefault(entity_type, dict()).setdefault(entity_id, dict()).update(attributes)
+            elif kind == 'membership':
+                set_type = id_column[:-len('_id')]
+                member_type = header[1]
+                for _, member_id in rows[1:]:
+                    if member_id not in entities.get(member_type, {}):
+                        return StubResponse(400, {'message' : '{0} {1} not found'.format(member_type, member_id)})
+                for set_id, member_id in rows[1:]:
+                    entities.setdefault(set_type, dict()).setdefault(set_id, dict())[member_id] = None
+            else:
+                return StubResponse(400, {'message' : 'unknown load file type {0}'.format(header[0])})
+            return StubResponse(200, {'message' : 'imported {0} rows'.format(len(rows) - 1)})
+        return self._call('upload_entities', handler)
@@ -0,0 +1,243 @@
+import collections
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from fcgdctools.run_stats import STATS, endpoint_name
+
+DEFAULT_POOL_SIZE = 16
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_INITIAL_RATE = 10.0
+DEFAULT_MAX_RATE = 100.0
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_TARGET_LATENCY = 2.0
+
+# responses that indicate a transient condition on the GDC side
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+class TokenBucket():
+    """Client-side token bucket: permits bursts of up to burst requests and an average of rate requests per second."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        # returns whether the caller had to wait for a token
+        waited = False
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            waited = True
+            time.sleep(wait)
+
+class AdaptiveRateController():
+    """Gate for all GDC API calls combining a token bucket with an AIMD concurrency limit.
+
+    The token bucket starts at initial_rate requests per second.  The concurrency limit and the bucket's 
+    rate are halved, at most once per cooldown period, when the GDC answers with 429 or 5xx or a request 
+    fails or times out, and raised after each request that completes within target_latency seconds: the 
+    concurrency limit additively, back up to max_concurrency, and the rate by a tenth of itself until the 
+    GDC first pushes back, additively after that.  The rate is only raised while the bucket is what holds 
+    requests back, i.e. when a request had to wait for a token since the last raise, and never above 
+    max_rate.  A max_rate of 0 disables the token bucket, leaving only the concurrency limit.
+    """
+
+    THROTTLE_STATUS_CODES = set(RETRY_STATUS_CODES)
+
+    def __init__(self, max_rate=DEFAULT_MAX_RATE, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 target_latency=DEFAULT_TARGET_LATENCY, cooldown=1.0, latency_window=1000, initial_rate=DEFAULT_INITIAL_RATE):
+        self.max_rate = max_rate
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.cooldown = cooldown
+        self.initial_rate = min(initial_rate, max_rate) if max_rate else initial_rate
+        self.bucket = TokenBucket(self.initial_rate) if max_rate else None
+        # the rate grows multiplicatively until the first throttle event, like TCP slow start
+        self._slow_start = True
+        # whether a request has waited for a token since the rate was last raised
+        self._rate_limited = False
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.requests = 0
+        self.throttle_events = 0
+        self._last_decrease = 0.0
+        self._latencies = collections.deque(maxlen=latency_window)
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        waited = self.bucket.take() if self.bucket is not None else False
+        with self._cond:
+            if waited:
+                self._rate_limited = True
+            while self.in_flight >= int(self.concurrency):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency, throttled):
+        with self._cond:
+            self.in_flight -= 1
+            self.requests += 1
+            self._latencies.append(latency)
+            if throttled:
+                self._decrease()
+            elif latency <= self.target_latency:
+                self._increase()
+            self._cond.notify_all()
+
+    def throttle(self):
+        # called for each failed attempt that the transport layer retries
+        with self._cond:
+            self._decrease()
+
+    def _decrease(self):
+        self.throttle_events += 1
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self._slow_start = False
+        self.concurrency = max(1.0, self.concurrency / 2)
+        if self.bucket is not None:
+            self.bucket.rate = max(self.initial_rate / 100, self.bucket.rate / 2)
+            self.bucket.burst = max(1.0, self.bucket.rate)
+
+    def _increase(self):
+        self.concurrency = min(float(self.max_concurrency), self.concurrency + 1 / self.concurrency)
+        if self.bucket is None or not self._rate_limited:
+            # the rate isn't what limits throughput; raising it would only let it run away
+            return
+        self._rate_limited = False
+        rate = self.bucket.rate + (self.bucket.rate / 10 if self._slow_start else self.initial_rate / 10)
+        self.bucket.rate = min(self.max_rate, rate)
+        self.bucket.burst = max(1.0, self.bucket.rate)
+
+    def metrics(self):
+        with self._cond:
+            latencies = sorted(self._latencies)
+            rate = self.bucket.rate if self.bucket is not None else None
+            metrics = {'concurrency' : int(self.concurrency), 'in_flight' : self.in_flight, 'rate' : rate,
+                       'requests' : self.requests, 'throttle_events' : self.throttle_events}
+        metrics['p50_latency'] = latencies[len(latencies) // 2] if latencies else None
+        metrics['p99_latency'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else None
+        return metrics
+
+    def format_metrics(self):
+        m = self.metrics()
+        fmt = lambda x: '{0:.3f}s'.format(x) if x is not None else 'n/a'
+        return "GDC API: concurrency={0}, in flight={1}, requests={2}, throttle events={3}, p50={4}, p99={5}".format(
+            m['concurrency'], m['in_flight'], m['requests'], m['throttle_events'], fmt(m['p50_latency']), fmt(m['p99_latency']))
+
+class JitteredRetry(Retry):
+    """urllib3 Retry policy with "full jitter" exponential backoff.
+
+    Each sleep is drawn uniformly between zero and the usual exponential backoff time, so that
+    concurrent workers that fail together don't retry together.  Each failed attempt is reported
+    to the controller, if any.
+    """
+
+    controller = None
+
+    def new(self, **kw):
+        retry = super().new(**kw)
+        retry.controller = self.controller
+        return retry
+
+    def increment(self, *args, **kwargs):
+        STATS.record_retry()
+        if self.controller is not None:
+            self.controller.throttle()
+        return super().increment(*args, **kwargs)
+
+    def sleep(self, response=None):
+        start = time.monotonic()
+        try:
+            super().sleep(response)
+        finally:
+            STATS.record_retry_sleep(time.monotonic() - start)
+
+    def get_backoff_time(self):
+        return random.uniform(0, super().get_backoff_time())
+
+class GdcSession(requests.Session):
+    """requests Session whose calls all pass through an AdaptiveRateController, if one is given,
+    and are counted in the run statistics."""
+
+    def __init__(self, controller=None):
+        super().__init__()
+        self.controller = controller
+
+    def request(self, method, url, *args, **kwargs):
+        if self.controller is not None:
+            self.controller.acquire()
+        start = time.monotonic()
+        response = None
+        try:
+            response = super().request(method, url, *args, **kwargs)
+            return response
+        finally:
+            latency = time.monotonic() - start
+            status_code = response.status_code if response is not None else None
+            if self.controller is not None:
+                self.controller.release(latency, status_code is None or status_code in AdaptiveRateController.THROTTLE_STATUS_CODES)
+            STATS.record_request(endpoint_name(method, url), latency, _response_size(response, kwargs.get('stream', False)), status_code)
+
+def _response_size(response, stream):
+    if response is None:
+        return 0
+    if stream:
+        # don't consume a streamed body; rely on the declared length
+        return int(response.headers.get('Content-Length', 0))
+    return len(response.content)
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR, controller=None):
+    """Create a requests Session that keeps up to pool_size connections alive and retries
+    connection errors, read errors and transient HTTP status codes at the transport layer.
+    If a controller is given, all requests made through the session are rate- and concurrency-limited by it.
+    """
+    retry = JitteredRetry(total=retries, connect=retries, read=retries, status=retries,
+                          backoff_factor=backoff_factor, status_forcelist=RETRY_STATUS_CODES,
+                          # GDC queries submitted via POST are read-only, so they are safe to retry
+                          allowed_methods=frozenset(['GET', 'POST']),
+                          respect_retry_after_header=True)
+    retry.controller = controller
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry, pool_block=True)
+
+    session = GdcSession(controller)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+def configure_session(pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR, controller=None):
+    """Replace the shared session with one using the given pool size, retry policy and rate controller."""
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is not None:
+            _SESSION.close()
+        _SESSION = create_session(pool_size, retries, backoff_factor, controller)
+        return _SESSION
+
+def get_session():
+    """Return the session shared by all GDC API calls, creating it with default settings if needed."""
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = create_session()
+        return _SESSION
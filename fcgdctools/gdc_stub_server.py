@@ -0,0 +1,425 @@
+"""Local stand-in for the GDC API's /files and /cases endpoints.
+
+Serves file and case documents from a fixture, which is either recorded from the real GDC or generated
+synthetically, so that genFcWsLoadFiles can be run and benchmarked without network access.  Supports
+the subset of the API that fcgdctools uses: per-uuid GETs with fields= and expand=index_files, and
+GET/POST queries with filters, fields, from/size pagination, sort and return_type=manifest.
+
+In record mode the server proxies every request to an upstream GDC API and merges the documents in its
+responses into the fixture, which is written out when the server shuts down.
+"""
+
+import argparse
+import copy
+import gzip
+import json
+import os.path
+import random
+import threading
+import time
+import urllib.parse
+import uuid as uuidlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+ENDPOINT_ID_FIELDS = {'files' : 'file_id', 'cases' : 'case_id'}
+
+MANIFEST_COLUMNS = ['id', 'filename', 'md5', 'size', 'state']
+
+DEFAULT_PAGE_SIZE = 10
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't')
+    return open(path, mode)
+
+class FixtureStore():
+    """File and case documents, keyed by endpoint and uuid, in insertion order."""
+
+    def __init__(self, documents=None):
+        self.documents = {endpoint : dict() for endpoint in ENDPOINT_ID_FIELDS}
+        self._lock = threading.Lock()
+        if documents is not None:
+            for endpoint, docs in documents.items():
+                for doc in docs:
+                    self.add(endpoint, doc)
+
+    @classmethod
+    def load(cls, path):
+        with _open(path, 'r') as fp:
+            return cls(json.load(fp))
+
+    def save(self, path):
+        with self._lock, _open(path, 'w') as fp:
+            json.dump({endpoint : list(docs.values()) for endpoint, docs in self.documents.items()}, fp)
+
+    def add(self, endpoint, doc):
+        id_field = ENDPOINT_ID_FIELDS[endpoint]
+        self.documents[endpoint][doc[id_field]] = doc
+
+    def merge(self, endpoint, uuid, doc):
+        """Merge a (possibly partial) document into the stored document with the same uuid."""
+        id_field = ENDPOINT_ID_FIELDS[endpoint]
+        doc = {k : v for k, v in doc.items() if k != 'id'}
+        doc[id_field] = uuid
+        with self._lock:
+            docs = self.documents[endpoint]
+            docs[uuid] = _deep_merge(docs.get(uuid), doc)
+
+    def get(self, endpoint, uuid):
+        return self.documents[endpoint].get(uuid)
+
+    def values(self, endpoint):
+        return list(self.documents[endpoint].values())
+
+def _deep_merge(old, new):
+    if isinstance(old, dict) and isinstance(new, dict):
+        merged = dict(old)
+        for k, v in new.items():
+            merged[k] = _deep_merge(old.get(k), v)
+        return merged
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        return [_deep_merge(o, n) for o, n in zip(old, new)]
+    return copy.deepcopy(new)
+
+def _field_values(doc, field):
+    # all values found at the dotted field path, flattening nested lists
+    values = [doc]
+    for key in field.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict) and key in value:
+                v = value[key]
+                found.extend(v if isinstance(v, list) else [v])
+        values = found
+    return values
+
+def _strip_endpoint_prefix(endpoint, field):
+    # filters on the /files endpoint may name fields either as "access" or as "files.access"
+    prefix = endpoint + '.'
+    return field[len(prefix):] if field.startswith(prefix) else field
+
+def matches(endpoint, doc, filters):
+    """Evaluate a GDC filter expression against a document."""
+    if not filters:
+        return True
+    op = filters['op'].lower()
+    content = filters['content']
+    if op == 'and':
+        return all(matches(endpoint, doc, f) for f in content)
+    if op == 'or':
+        return any(matches(endpoint, doc, f) for f in content)
+    if op == 'not':
+        return not matches(endpoint, doc, content)
+
+    values = set(str(v) for v in _field_values(doc, _strip_endpoint_prefix(endpoint, content['field'])))
+    targets = content.get('value')
+    targets = set(str(v) for v in (targets if isinstance(targets, list) else [targets]))
+    if op in ('in', '='):
+        return len(values & targets) > 0
+    if op in ('exclude', '!='):
+        return len(values & targets) == 0
+    if op == 'is':
+        return len(values) == 0
+    if op == 'not is':
+        return len(values) > 0
+    raise ValueError("unsupported filter operator: {0}".format(op))
+
+def project(doc, fields):
+    """Return a copy of doc restricted to the comma-separated dotted field paths in fields."""
+    if not fields:
+        return copy.deepcopy(doc)
+    projected = dict()
+    for field in fields.split(','):
+        _project_path(doc, field.strip().split('.'), projected)
+    return projected
+
+def _project_path(src, path, dst):
+    key = path[0]
+    if not isinstance(src, dict) or key not in src:
+        return
+    value = src[key]
+    if len(path) == 1:
+        dst[key] = copy.deepcopy(value)
+    elif isinstance(value, list):
+        dst_list = dst.setdefault(key, [dict() for _ in value])
+        for src_item, dst_item in zip(value, dst_list):
+            _project_path(src_item, path[1:], dst_item)
+    else:
+        _project_path(value, path[1:], dst.setdefault(key, dict()))
+
+def _manifest_row(doc):
+    return [doc.get('file_id', ''), doc.get('file_name', ''), doc.get('md5sum', ''),
+            str(doc.get('file_size', '')), doc.get('state', 'released')]
+
+class GdcStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, store, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503,
+                 upstream=None, seed=None):
+        super().__init__(server_address, GdcStubRequestHandler)
+        self.store = store
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.upstream = upstream.rstrip('/') if upstream else None
+        self.random = random.Random(seed)
+        self.request_counts = dict()
+        self.bytes_sent = 0
+        self._stats_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://{0}:{1}".format(*self.server_address[:2])
+
+    def count(self, key, num_bytes):
+        with self._stats_lock:
+            self.request_counts[key] = self.request_counts.get(key, 0) + 1
+            self.bytes_sent += num_bytes
+
+    @property
+    def total_requests(self):
+        with self._stats_lock:
+            return sum(self.request_counts.values())
+
+class GdcStubRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _handle(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        params = {k : v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+        body = b''
+        if method == 'POST':
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if body:
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params.update(json.loads(body))
+                else:
+                    params.update({k : v[-1] for k, v in urllib.parse.parse_qs(body.decode()).items()})
+
+        # treat legacy archive requests like main archive requests
+        parts = [p for p in url.path.split('/') if p]
+        if parts and parts[0] == 'legacy':
+            parts = parts[1:]
+
+        server = self.server
+        delay = server.latency + (server.random.uniform(-server.jitter, server.jitter) if server.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+        if server.error_rate and server.random.random() < server.error_rate:
+            self._send(server.error_status, 'application/json', json.dumps({'message' : 'injected error'}).encode(), method, parts)
+            return
+
+        if not parts or parts[0] not in ENDPOINT_ID_FIELDS or len(parts) > 2:
+            self._send(404, 'application/json', json.dumps({'message' : 'not found'}).encode(), method, parts)
+            return
+
+        try:
+            if server.upstream is not None:
+                status, content_type, payload = self._proxy(method, url, body, parts)
+            else:
+                status, content_type, payload = self._serve(parts, params)
+        except Exception as x:
+            status, content_type, payload = 400, 'application/json', json.dumps({'message' : str(x)}).encode()
+        self._send(status, content_type, payload, method, parts)
+
+    def _send(self, status, content_type, payload, method, parts):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        self.server.count((method, parts[0] if parts else ''), len(payload))
+
+    def _serve(self, parts, params):
+        store = self.server.store
+        endpoint = parts[0]
+
+        if len(parts) == 2:
+            doc = store.get(endpoint, parts[1])
+            if doc is None:
+                return 404, 'application/json', json.dumps({'message' : '{0} not found'.format(parts[1])}).encode()
+            data = project(doc, params.get('fields'))
+            if params.get('expand') == 'index_files':
+                data['index_files'] = copy.deepcopy(doc.get('index_files', []))
+            data['id'] = parts[1]
+            return 200, 'application/json', json.dumps({'data' : data, 'warnings' : {}}).encode()
+
+        filters = params.get('filters')
+        if isinstance(filters, str):
+            filters = json.loads(filters)
+        docs = [doc for doc in store.values(endpoint) if matches(endpoint, doc, filters)]
+        sort = params.get('sort')
+        if sort:
+            for key in reversed(sort.split(',')):
+                field, _, direction = key.partition(':')
+                docs.sort(key=lambda d: [str(v) for v in _field_values(d, field)], reverse=(direction == 'desc'))
+        total = len(docs)
+        start = int(params.get('from', 0))
+        size = int(params.get('size', DEFAULT_PAGE_SIZE))
+        page = docs[start:start + size]
+
+        if params.get('return_type') == 'manifest':
+            lines = ['\t'.join(MANIFEST_COLUMNS)] + ['\t'.join(_manifest_row(doc)) for doc in page]
+            return 200, 'text/tab-separated-values', ('\n'.join(lines) + '\n').encode()
+
+        id_field = ENDPOINT_ID_FIELDS[endpoint]
+        hits = []
+        for doc in page:
+            hit = project(doc, params.get('fields'))
+            hit['id'] = doc[id_field]
+            hits.append(hit)
+        pagination = {'count' : len(hits), 'total' : total, 'size' : size, 'from' : start,
+                      'sort' : sort or '', 'page' : start // size + 1 if size else 1,
+                      'pages' : -(-total // size) if size else 1}
+        return 200, 'application/json', json.dumps({'data' : {'hits' : hits, 'pagination' : pagination}, 'warnings' : {}}).encode()
+
+    def _proxy(self, method, url, body, parts):
+        upstream_url = self.server.upstream + url.path + ('?' + url.query if url.query else '')
+        headers = {'Content-Type' : self.headers['Content-Type']} if 'Content-Type' in self.headers else {}
+        response = requests.request(method, upstream_url, data=body if body else None, headers=headers, timeout=300)
+        content_type = response.headers.get('Content-Type', 'application/json')
+        if response.status_code == 200:
+            self._record(parts, response)
+        return response.status_code, content_type, response.content
+
+    def _record(self, parts, response):
+        store = self.server.store
+        endpoint = parts[0]
+        id_field = ENDPOINT_ID_FIELDS[endpoint]
+        if 'json' not in response.headers.get('Content-Type', ''):
+            # manifest
+            lines = response.text.splitlines()
+            if lines and lines[0].split('\t')[0] == 'id':
+                for line in lines[1:]:
+                    row = dict(zip(MANIFEST_COLUMNS, line.split('\t')))
+                    if row.get('id'):
+                        store.merge(endpoint, row['id'], {'file_name' : row.get('filename'), 'md5sum' : row.get('md5'),
+                                                          'file_size' : int(row['size']) if row.get('size', '').isdigit() else row.get('size'),
+                                                          'state' : row.get('state')})
+            return
+        data = response.json().get('data', {})
+        if len(parts) == 2:
+            store.merge(endpoint, parts[1], data)
+        else:
+            for hit in data.get('hits', []):
+                uuid = hit.get(id_field, hit.get('id'))
+                if uuid is not None:
+                    store.merge(endpoint, uuid, hit)
+
+def serve(store, host='127.0.0.1', port=0, **kwargs):
+    """Start a GdcStubServer in a background thread and return it; call shutdown() to stop it."""
+    server = GdcStubServer((host, port), store, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def synthesize_fixture(num_cases, project_id='TCGA-SYN', seed=0):
+    """Generate a fixture of num_cases TCGA-like cases, each with a primary tumor and a blood normal sample,
+    and for each case a clinical supplement, a WXS BAM (with BAI) per sample and a MuTect2 VCF for the pair.
+    """
+    rng = random.Random(seed)
+    uuid = lambda: str(uuidlib.UUID(int=rng.getrandbits(128), version=4))
+    program = project_id.split('-')[0]
+    store = FixtureStore()
+
+    for n in range(num_cases):
+        case_id = uuid()
+        case_barcode = '{0}-{1:02d}-{2:04d}'.format(program, n % 100, n)
+        samples = []
+        for sample_type_id, sample_type, tissue_type in [('01', 'Primary Tumor', 'Tumor'), ('10', 'Blood Derived Normal', 'Normal')]:
+            sample_barcode = '{0}-{1}A'.format(case_barcode, sample_type_id)
+            aliquot = {'aliquot_id' : uuid(), 'submitter_id' : '{0}-01D-A{1:03d}-08'.format(sample_barcode, n % 1000)}
+            samples.append({'sample_id' : uuid(), 'submitter_id' : sample_barcode, 'sample_type_id' : sample_type_id,
+                            'sample_type' : sample_type, 'tissue_type' : tissue_type,
+                            'portions' : [{'analytes' : [{'aliquots' : [aliquot]}]}]})
+        case = {'case_id' : case_id, 'submitter_id' : case_barcode, 'primary_site' : 'Bronchus and lung',
+                'project' : {'project_id' : project_id, 'program' : {'name' : program}}, 'samples' : samples}
+        store.add('cases', case)
+
+        def add_file(data_category, data_type, data_format, file_samples, experimental_strategy=None,
+                     workflow_type=None, file_name=None, with_index=False):
+            file_id = uuid()
+            file_case = {k : v for k, v in case.items() if k != 'samples'}
+            if file_samples is not None:
+                file_case['samples'] = file_samples
+            doc = {'file_id' : file_id, 'file_name' : file_name or file_id + '.' + data_format.lower(),
+                   'md5sum' : uuid().replace('-', ''), 'file_size' : rng.randint(1000, 10**9), 'state' : 'released',
+                   'data_category' : data_category, 'data_type' : data_type, 'data_format' : data_format,
+                   'access' : 'controlled' if data_format in ('BAM', 'VCF') else 'open', 'cases' : [file_case]}
+            if experimental_strategy is not None:
+                doc['experimental_strategy'] = experimental_strategy
+            if workflow_type is not None:
+                doc['analysis'] = {'workflow_type' : workflow_type}
+            if with_index:
+                doc['index_files'] = [{'file_id' : uuid(), 'file_name' : doc['file_name'] + '.bai', 'data_format' : 'BAI'}]
+            store.add('files', doc)
+            return doc
+
+        add_file('Clinical', 'Clinical Supplement', 'BCR XML', None,
+                 file_name='nationwidechildrens.org_clinical.{0}.xml'.format(case_barcode))
+        for sample in samples:
+            add_file('Sequencing Reads', 'Aligned Reads', 'BAM', [sample], 'WXS',
+                     'BWA with Mark Duplicates and Cocleaning', with_index=True)
+        add_file('Simple Nucleotide Variation', 'Raw Simple Somatic Mutation', 'VCF', samples, 'WXS', 'MuTect2')
+
+    return store
+
+def main():
+    parser = argparse.ArgumentParser(description='serve a local stand-in for the GDC API /files and /cases endpoints')
+    parser.add_argument("-f", "--fixture", help="JSON fixture of file and case documents to serve (.gz for compressed)")
+    parser.add_argument("-s", "--synthetic", help="serve a synthetic fixture with this many cases", type=int)
+    parser.add_argument("--seed", help="random seed for synthetic fixtures and error injection", type=int, default=0)
+    parser.add_argument("--host", help="address to listen on (default: 127.0.0.1)", default='127.0.0.1')
+    parser.add_argument("--port", help="port to listen on; 0 for any free port (default: 0)", type=int, default=0)
+    parser.add_argument("--latency", help="seconds added to every response", type=float, default=0.0)
+    parser.add_argument("--jitter", help="maximum random +/- seconds added to the latency", type=float, default=0.0)
+    parser.add_argument("--error_rate", help="fraction of requests answered with --error_status", type=float, default=0.0)
+    parser.add_argument("--error_status", help="HTTP status of injected errors (default: 503)", type=int, default=503)
+    parser.add_argument("-r", "--record", help="proxy requests to --upstream and record the responses into this fixture file",
+                        metavar="FIXTURE")
+    parser.add_argument("-u", "--upstream", help="GDC API root to proxy to in record mode (default: https://api.gdc.cancer.gov)",
+                        default="https://api.gdc.cancer.gov")
+    args = parser.parse_args()
+
+    if args.record:
+        # recording into an existing fixture adds to it
+        store = FixtureStore.load(args.record) if os.path.exists(args.record) else FixtureStore()
+        upstream = args.upstream
+    else:
+        upstream = None
+        if args.fixture:
+            store = FixtureStore.load(args.fixture)
+        elif args.synthetic:
+            store = synthesize_fixture(args.synthetic, seed=args.seed)
+        else:
+            parser.error("one of --fixture, --synthetic or --record is required")
+
+    server = GdcStubServer((args.host, args.port), store, latency=args.latency, jitter=args.jitter,
+                           error_rate=args.error_rate, error_status=args.error_status, upstream=upstream, seed=args.seed)
+    print("serving GDC API stand-in at {0} ({1} files, {2} cases); point genFcWsLoadFiles at it with --gdc_api_root {0}".format(
+        server.url, len(store.documents['files']), len(store.documents['cases'])))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print("requests served: {0}".format(server.request_counts))
+        if args.record:
+            store.save(args.record)
+            print("recorded {0} files and {1} cases to {2}".format(
+                len(store.documents['files']), len(store.documents['cases']), args.record))
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,27 @@
 import requests
+import collections
+import concurrent.futures
+import itertools
 import json
 import sys
 import argparse
 import os
 import datetime
-import firecloud.api as api
+from fcgdctools.gdc_session import get_session
+from fcgdctools.metadata_bundle import MetadataBundleWriter, FILE_FIELDS, CASE_FIELDS
+
+GDC_API_ROOT = 'https://api.gdc.cancer.gov'
+
+#Number of files or cases retrieved per query when downloading a metadata bundle
+BUNDLE_PAGE_SIZE = 1000
+
+MANIFEST_COLUMNS = ['id', 'filename', 'md5', 'size', 'state']
+
+#Number of files per manifest query, and number of queries in flight at once
+MANIFEST_PAGE_SIZE = 10000
+MANIFEST_JOBS = 4
+
+WRITE_BUFFER_SIZE = 2**20
 
 def build_filter_json(filter_attrs):
 	filt = {
@@ -26,25 +43,137 @@ def build_filter_json(filter_attrs):
 	return filt
 
 
-def download_manifest(filt_json):
-	
+def _count_files(files_endpt, filt_json):
+	params = {'filters':json.dumps(filt_json), 'fields':'file_id', 'format':'JSON', 'size':'1'}
+	response = get_session().get(files_endpt, params = params, timeout=300)
+	response.raise_for_status()
+	return response.json()['data']['pagination']['total']
+
+def _fetch_manifest_page(files_endpt, filt_json, page, page_size):
+	#Returns the header line and the rows of the page'th page of the manifest.  Files are sorted by file_id so that pages don't overlap
+	params = {'filters':json.dumps(filt_json), 'from':str(page * page_size), 'size':str(page_size), 'sort':'file_id:asc', 'return_type':'manifest'}
+	response = get_session().get(files_endpt, params = params, timeout=300)
+	response.raise_for_status()
+	header, _, rows = response.content.partition(b'\n')
+	rows = rows.rstrip(b'\n')
+	return header + b'\n', rows + b'\n' if rows else b''
+
+def _write_progress(progress_filename, progress):
+	#Replaces the checkpoint at once, so that an interrupted write leaves the previous one
+	with open(progress_filename + '.tmp', 'w') as fp:
+		json.dump(progress, fp)
+	os.replace(progress_filename + '.tmp', progress_filename)
+
+def download_manifest(filt_json, manifest_filename=None, page_size=MANIFEST_PAGE_SIZE, jobs=MANIFEST_JOBS, gdc_api_root=GDC_API_ROOT):
+	"""Download the manifest of the files selected by filt_json, page_size files per query with up to jobs 
+	queries in flight at once.  The pages are written in order, and progress is checkpointed to 
+	<manifest_filename>.progress after each one: calling download_manifest again with the same manifest_filename 
+	and filters resumes an interrupted download.  Returns the name of the manifest, by default 
+	gdc_manifest_<timestamp>.tsv.
+	"""
+
 	#This is the API endpoint for performing a search on the GDC data portal and retrieving file information.
-	files_endpt = 'https://api.gdc.cancer.gov/files'
+	files_endpt = gdc_api_root + '/files'
 
 	#Creating a new name for the manifest file
-	timestamp='{:%Y-%m-%d_%H-%M-%S}'.format(datetime.datetime.now())
-	manifest_filename="gdc_manifest_"+timestamp+".tsv"
+	if manifest_filename is None:
+		timestamp='{:%Y-%m-%d_%H-%M-%S}'.format(datetime.datetime.now())
+		manifest_filename="gdc_manifest_"+timestamp+".tsv"
+	progress_filename = manifest_filename + ".progress"
 	print("downloading manifest {0}".format(manifest_filename))
 
-	params = {'filters':json.dumps(filt_json),'size':'30000','return_type':'manifest'}
-	
-	# requests URL-encodes automatically
-	response = requests.get(files_endpt, params = params)
+	total = _count_files(files_endpt, filt_json)
+	num_pages = max(1, -(-total // page_size))
+	progress = {'filters':filt_json, 'page_size':page_size, 'total':total, 'pages':0, 'files':0, 'bytes':0}
+	if os.path.exists(progress_filename) and os.path.exists(manifest_filename):
+		with open(progress_filename) as fp:
+			checkpoint = json.load(fp)
+		if all(checkpoint.get(key) == progress[key] for key in ['filters', 'page_size', 'total']):
+			progress = checkpoint
+			print("resuming after page {0} of {1}".format(progress['pages'], num_pages))
+		else:
+			print("the selected files changed since the download was interrupted; starting over")
+
+	#Writing the pages to the manifest file, after the last checkpointed page if resuming
+	with open(manifest_filename, 'r+b' if progress['pages'] > 0 else 'wb', buffering=WRITE_BUFFER_SIZE) as handle:
+		handle.truncate(progress['bytes'])
+		handle.seek(progress['bytes'])
 
-	#Writing the output to the manifest file
-	with open(manifest_filename, 'wb') as handle:
-		for block in response.iter_content(1024):
-			handle.write(block)
+		with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+			pages = iter(range(progress['pages'], num_pages))
+			pending = collections.deque(executor.submit(_fetch_manifest_page, files_endpt, filt_json, page, page_size)
+						    for page in itertools.islice(pages, jobs))
+			while pending:
+				header, rows = pending.popleft().result()
+				for page in itertools.islice(pages, 1):
+					pending.append(executor.submit(_fetch_manifest_page, files_endpt, filt_json, page, page_size))
+
+				num_files = rows.count(b'\n')
+				expected = min(page_size, total - progress['files'])
+				if num_files != expected:
+					raise RuntimeError("page {0} of manifest {1} has {2} files, expected {3}".format(
+						progress['pages'] + 1, manifest_filename, num_files, expected))
+				if progress['bytes'] == 0:
+					handle.write(header)
+				handle.write(rows)
+				handle.flush()
+				os.fsync(handle.fileno())
+
+				progress['pages'] += 1
+				progress['files'] += num_files
+				progress['bytes'] = handle.tell()
+				_write_progress(progress_filename, progress)
+
+	if progress['files'] != total:
+		raise RuntimeError("downloaded {0} files to manifest {1}, but the GDC reported {2}".format(progress['files'], manifest_filename, total))
+	os.remove(progress_filename)
+	print("manifest has {0} files".format(total))
 
 	return manifest_filename
 
+def _query(endpoint, filt_json, fields, start, size, sort):
+	params = {'filters':filt_json, 'fields':','.join(fields), 'format':'JSON', 'from':start, 'size':size, 'sort':sort}
+	response = get_session().post(endpoint, data=json.dumps(params), headers={'Content-Type':'application/json'}, timeout=300)
+	response.raise_for_status()
+	return response.json()['data']
+
+def download_metadata_bundle(filt_json, compress=True, page_size=BUNDLE_PAGE_SIZE, gdc_api_root=GDC_API_ROOT):
+	"""Download the metadata of the files selected by filt_json, and of their cases, to a metadata bundle, 
+	along with the files' manifest.  genFcWsLoadFiles <manifest> --bundle <bundle> then creates the load 
+	files without querying the GDC.  Returns the names of the manifest and of the bundle.
+	"""
+	files_endpt = gdc_api_root + '/files'
+	cases_endpt = gdc_api_root + '/cases'
+
+	timestamp='{:%Y-%m-%d_%H-%M-%S}'.format(datetime.datetime.now())
+	manifest_filename="gdc_manifest_"+timestamp+".tsv"
+	bundle_filename="gdc_metadata_"+timestamp+".jsonl"+(".gz" if compress else "")
+	print("downloading manifest {0} and metadata bundle {1}".format(manifest_filename, bundle_filename))
+
+	case_ids = set()
+	with open(manifest_filename, 'w') as manifest, MetadataBundleWriter(bundle_filename, filt_json) as bundle:
+		manifest.write('\t'.join(MANIFEST_COLUMNS) + '\n')
+
+		#Files are retrieved page_size at a time, in file_id order so that pages don't overlap
+		total = None
+		while total is None or bundle.num_files < total:
+			data = _query(files_endpt, filt_json, FILE_FIELDS, bundle.num_files, page_size, 'file_id:asc')
+			total = data['pagination']['total']
+			if len(data['hits']) == 0:
+				break
+			for hit in data['hits']:
+				bundle.write_file(hit)
+				manifest.write('\t'.join(str(hit.get(field, '')) for field in ['file_id', 'file_name', 'md5sum', 'file_size', 'state']) + '\n')
+				case_ids.update(case['case_id'] for case in hit.get('cases', []))
+		if bundle.num_files != total:
+			raise RuntimeError("retrieved {0} files, but the GDC reported {1}".format(bundle.num_files, total))
+
+		#The cases' primary sites, page_size cases per query
+		case_ids = sorted(case_ids)
+		for start in range(0, len(case_ids), page_size):
+			case_filt = {"op":"in", "content":{"field":"case_id", "value":case_ids[start:start + page_size]}}
+			for hit in _query(cases_endpt, case_filt, CASE_FIELDS, 0, page_size, 'case_id:asc')['hits']:
+				bundle.write_case(hit)
+
+	print("metadata bundle has {0} files and {1} cases".format(bundle.num_files, bundle.num_cases))
+	return manifest_filename, bundle_filename
@@ -0,0 +1,122 @@
+import gzip
+import io
+import json
+
+BUNDLE_VERSION = 1
+
+# fields of each file in a bundle: those genFcWsLoadFiles retrieves for a file (see
+# FileBatchMetadataRetriever.FIELDS), and the file's manifest columns
+FILE_FIELDS = ["file_id", "data_category", "data_type", "data_format", "access", "experimental_strategy",
+               "analysis.workflow_type", "cases.project.program.name",
+               "cases.case_id", "cases.submitter_id", "cases.project.project_id", "cases.tissue_source_site",
+               "cases.samples.sample_id", "cases.samples.submitter_id", "cases.samples.sample_type_id",
+               "cases.samples.sample_type", "cases.samples.tissue_type",
+               "cases.samples.portions.analytes.aliquots.submitter_id", "index_files.file_id",
+               "file_name", "md5sum", "file_size", "state"]
+
+# fields of each case in a bundle
+CASE_FIELDS = ["case_id", "primary_site"]
+
+def open_bundle(path, mode='r'):
+    """Open a bundle for reading or writing as text; bundles whose name ends with .gz are gzip compressed."""
+    if mode == 'w':
+        return gzip.open(path, 'wt') if path.endswith('.gz') else open(path, 'w')
+    raw = open(path, 'rb')
+    if raw.peek(2)[:2] == b'\x1f\x8b':
+        raw = gzip.open(raw)
+    return io.TextIOWrapper(raw)
+
+class MetadataBundleWriter():
+    """Writes a metadata bundle: a JSON line header, then a JSON line per file and per case, holding the
+    file's FILE_FIELDS or the case's CASE_FIELDS as returned by the GDC API."""
+
+    def __init__(self, path, filters=None):
+        self.path = path
+        self.num_files = 0
+        self.num_cases = 0
+        self._fp = open_bundle(path, 'w')
+        self._fp.write(json.dumps({'bundle' : BUNDLE_VERSION, 'filters' : filters}) + '\n')
+
+    def write_file(self, file_metadata):
+        self._fp.write(json.dumps({'file' : file_metadata}, separators=(',', ':')) + '\n')
+        self.num_files += 1
+
+    def write_case(self, case_metadata):
+        self._fp.write(json.dumps({'case' : case_metadata}, separators=(',', ':')) + '\n')
+        self.num_cases += 1
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class MetadataBundle():
+    """The files and cases of a metadata bundle, answering genFcWsLoadFiles' GDC queries in place of the GDC.
+
+    A bundle stands in for the MetadataCache: every GDC query is looked up in it first, and the lookup
+    of a file or case that is not in the bundle fails instead of falling through to the GDC, so that
+    no request is ever made.  A batch lookup returns the files or cases the bundle has; the others
+    fail on their own when they are looked up one at a time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = dict()
+        self.cases = dict()
+        self.hits = 0
+        self.misses = 0
+        with open_bundle(path) as fp:
+            header = json.loads(fp.readline() or '{}')
+            if header.get('bundle') != BUNDLE_VERSION:
+                raise ValueError("{0} is not a version {1} metadata bundle".format(path, BUNDLE_VERSION))
+            for line in fp:
+                record = json.loads(line)
+                if 'file' in record:
+                    self.files[record['file']['file_id']] = record['file']
+                elif 'case' in record:
+                    self.cases[record['case']['case_id']] = record['case']
+
+    def _records(self, endpoint):
+        if endpoint.endswith('/files'):
+            return self.files, 'file'
+        if endpoint.endswith('/cases'):
+            return self.cases, 'case'
+        raise ValueError("no {0} metadata in bundle {1}".format(endpoint, self.path))
+
+    def get(self, endpoint, uuid, fields):
+        """Return the metadata of uuid; raises ValueError if it is not in the bundle."""
+        found = self.get_many(endpoint, [uuid], fields)
+        if uuid not in found:
+            _, kind = self._records(endpoint)
+            raise ValueError("{0} {1} is not in metadata bundle {2}".format(kind, uuid, self.path))
+        return found[uuid]
+
+    def get_many(self, endpoint, uuids, fields):
+        """Return a dict mapping each of uuids that is in the bundle to its metadata; the metadata holds at 
+        least the requested fields."""
+        records, _ = self._records(endpoint)
+        found = dict()
+        for uuid in uuids:
+            if uuid not in records:
+                continue
+            found[uuid] = records[uuid]
+            if fields == "expand=index_files":
+                found[uuid] = records[uuid].get('index_files', [])
+        self.hits += len(found)
+        self.misses += len(uuids) - len(found)
+        return found
+
+    def put(self, endpoint, uuid, fields, value):
+        pass
+
+    def put_many(self, endpoint, values, fields):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,101 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "fcgdctools")
+DEFAULT_TTL_HOURS = 7 * 24
+DEFAULT_MAX_SIZE_MB = 1024
+
+CACHE_FILENAME = "gdc_metadata.sqlite"
+
+class MetadataCache():
+    """Read-through persistent cache of GDC API responses.
+
+    Entries are keyed by endpoint (API root + endpoint name), uuid and the requested field set.
+    Entries older than ttl seconds are treated as missing.  When the total size of the cached
+    responses exceeds max_size bytes, the least recently used entries are evicted.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_TTL_HOURS * 3600, max_size=DEFAULT_MAX_SIZE_MB * 2**20):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, CACHE_FILENAME)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS metadata (
+                                  endpoint TEXT NOT NULL,
+                                  uuid TEXT NOT NULL,
+                                  fields TEXT NOT NULL,
+                                  stored_at REAL NOT NULL,
+                                  accessed_at REAL NOT NULL,
+                                  size INTEGER NOT NULL,
+                                  value TEXT NOT NULL,
+                                  PRIMARY KEY (endpoint, uuid, fields))""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS metadata_accessed_at ON metadata (accessed_at)")
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM metadata").fetchone()[0]
+
+    def get(self, endpoint, uuid, fields):
+        return self.get_many(endpoint, [uuid], fields).get(uuid)
+
+    def get_many(self, endpoint, uuids, fields):
+        """Return a dict mapping each of uuids with a fresh cache entry to its cached value."""
+        found = dict()
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            for uuid in uuids:
+                row = self._conn.execute("SELECT stored_at, value FROM metadata WHERE endpoint=? AND uuid=? AND fields=?",
+                                         (endpoint, uuid, fields)).fetchone()
+                if row is None or now - row[0] > self.ttl:
+                    continue
+                self._conn.execute("UPDATE metadata SET accessed_at=? WHERE endpoint=? AND uuid=? AND fields=?",
+                                   (now, endpoint, uuid, fields))
+                found[uuid] = json.loads(row[1])
+            self._conn.execute("COMMIT")
+            self.hits += len(found)
+            self.misses += len(uuids) - len(found)
+        return found
+
+    def put(self, endpoint, uuid, fields, value):
+        self.put_many(endpoint, {uuid : value}, fields)
+
+    def put_many(self, endpoint, values, fields):
+        """Store each uuid -> value in values, evicting least recently used entries as needed."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            for uuid, value in values.items():
+                encoded = json.dumps(value, separators=(',', ':'))
+                row = self._conn.execute("SELECT size FROM metadata WHERE endpoint=? AND uuid=? AND fields=?",
+                                         (endpoint, uuid, fields)).fetchone()
+                if row is not None:
+                    self._size -= row[0]
+                self._conn.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   (endpoint, uuid, fields, now, now, len(encoded), encoded))
+                self._size += len(encoded)
+            if self._size > self.max_size:
+                self._evict()
+            self._conn.execute("COMMIT")
+
+    def _evict(self):
+        # evict down to 90% of the maximum size so that we don't evict on every subsequent put
+        target = int(self.max_size * 0.9)
+        rows = self._conn.execute("SELECT endpoint, uuid, fields, size FROM metadata ORDER BY accessed_at")
+        evicted = []
+        for endpoint, uuid, fields, size in rows:
+            if self._size <= target:
+                break
+            evicted.append((endpoint, uuid, fields))
+            self._size -= size
+        self._conn.executemany("DELETE FROM metadata WHERE endpoint=? AND uuid=? AND fields=?", evicted)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
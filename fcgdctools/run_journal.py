@@ -0,0 +1,201 @@
+import json
+import os
+import time
+
+from fcgdctools.entity_table import EntityTable
+
+JOURNAL_VERSION = 2
+DEFAULT_CHECKPOINT_INTERVAL = 30
+
+def _line_start(fp, position, chunk_size=65536):
+    # position just after the last newline before position, or 0
+    while position > 0:
+        start = max(0, position - chunk_size)
+        fp.seek(start)
+        chunk = fp.read(position - start)
+        newline = chunk.rfind(b'\n')
+        if newline >= 0:
+            return start + newline + 1
+        position = start
+    return 0
+
+def _truncate_torn_line(path):
+    # drop a torn last line, so that new records start on a line of their own
+    with open(path, 'rb+') as fp:
+        end = fp.seek(0, os.SEEK_END)
+        position = _line_start(fp, end)
+        if position < end:
+            fp.truncate(position)
+
+class JournaledTable(EntityTable):
+    """EntityTable that remembers which entities were tested for, looked up, stored or changed since 
+    the last call to take_touched(), and how they changed.
+
+    All of fc_loadfiles' entity accesses go through the table, so the touched entities are a superset 
+    of those that a file's processing created, used or changed.  Each entity's change is a dict holding
+    'new' if the entity was stored anew, 'set' the attributes set since, 'del' the names of the 
+    attributes deleted, or 'gone' if the entity was deleted; an entity that was only looked up has an 
+    empty change.  EntityTable.restore_change() applies a change.
+    """
+
+    def __init__(self, kind, **kwargs):
+        super().__init__(kind, **kwargs)
+        # dict to keep the entities in the order they were first touched
+        self._changes = dict()
+
+    def __getitem__(self, entity_id):
+        self._changes.setdefault(entity_id, {})
+        return super().__getitem__(entity_id)
+
+    def __contains__(self, entity_id):
+        self._changes.setdefault(entity_id, {})
+        return super().__contains__(entity_id)
+
+    def __setitem__(self, entity_id, attributes):
+        attributes = dict(attributes)
+        self._changes[entity_id] = {'new' : True, 'set' : attributes}
+        super().__setitem__(entity_id, attributes)
+
+    def __delitem__(self, entity_id):
+        super().__delitem__(entity_id)
+        self._changes[entity_id] = {'gone' : True}
+
+    def set_attribute(self, entity_id, attribute_name, value):
+        super().set_attribute(entity_id, attribute_name, value)
+        change = self._changes.setdefault(entity_id, {})
+        change.setdefault('set', {})[attribute_name] = value
+        if attribute_name in change.get('del', ()):
+            change['del'].remove(attribute_name)
+
+    def delete_attribute(self, entity_id, attribute_name):
+        super().delete_attribute(entity_id, attribute_name)
+        change = self._changes.setdefault(entity_id, {})
+        change.get('set', {}).pop(attribute_name, None)
+        if not change.get('new') and attribute_name not in change.get('del', ()):
+            change.setdefault('del', []).append(attribute_name)
+
+    def touch(self, entity_id):
+        self._changes.setdefault(entity_id, {})
+
+    def take_touched(self):
+        """(entity id, change) of each entity touched since the last call."""
+        changes = self._changes
+        self._changes = dict()
+        return list(changes.items())
+
+class RunJournal():
+    """Append-only journal of the files processed by a genFcWsLoadFiles run and the entity changes they caused.
+
+    Each record is a JSON line naming a phase and file uuid, whether the file is done, the entities 
+    the file touched with the attributes it set or deleted on each (see JournaledTable), and any 
+    per-file details the caller adds.  A snapshot record holds the state of all entities and the 
+    details of all files at once.  Records are buffered and flushed to disk at most 
+    checkpoint_interval seconds apart; replaying the journal applies the changes, in order, on top of 
+    the last snapshot, restoring the entity tables as they were at the last flush.  A torn last line, 
+    left by a crash during a flush, is ignored.
+    """
+
+    def __init__(self, path, tables, checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL):
+        self.path = path
+        self.tables = {table.kind : table for table in tables}
+        self.checkpoint_interval = checkpoint_interval
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        self._fp = None
+
+    def start(self, manifest, resume, **header):
+        """Open the journal for appending, truncating it unless resuming.  Any header items are 
+        recorded, along with the manifest, in the journal's first line."""
+        if resume and os.path.exists(self.path):
+            _truncate_torn_line(self.path)
+            self._fp = open(self.path, 'a')
+        else:
+            self._fp = open(self.path, 'w')
+            header.update({'journal' : JOURNAL_VERSION, 'manifest' : manifest})
+            self._buffer.append(json.dumps(header) + '\n')
+            self.flush()
+
+    def header(self):
+        """The journal's first line, e.g. {'journal' : 2, 'manifest' : 'manifest.tsv'}."""
+        with open(self.path, 'r') as fp:
+            header = json.loads(fp.readline())
+        if 'journal' not in header:
+            raise ValueError("{0} is not a genFcWsLoadFiles journal".format(self.path))
+        return header
+
+    def replay(self):
+        """Restore the entity tables from the journal and yield each file record, in the order written."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    print("ignoring incomplete journal record: {0}".format(line[:80]))
+                    continue
+                if 'journal' in record:
+                    if record['journal'] != JOURNAL_VERSION:
+                        raise ValueError("unsupported journal version {0} in {1}; only version {2} journals can be resumed or updated".format(
+                            record['journal'], self.path, JOURNAL_VERSION))
+                    continue
+                if record['phase'] == 'snapshot':
+                    for table in self.tables.values():
+                        table.clear()
+                    for kind, entities in record['entities'].items():
+                        table = self.tables[kind]
+                        for entity_id, entity in entities:
+                            table.restore(entity_id, entity)
+                else:
+                    for kind, changes in record['entities'].items():
+                        table = self.tables[kind]
+                        for change in changes:
+                            if len(change) > 1:
+                                table.restore_change(change[0], change[1])
+                yield record
+
+    def last_record(self):
+        """The journal's last complete record, or None if it has none."""
+        with open(self.path, 'rb') as fp:
+            end = _line_start(fp, fp.seek(0, os.SEEK_END))
+            if end == 0:
+                return None
+            start = _line_start(fp, end - 1)
+            fp.seek(start)
+            return json.loads(fp.read(end - start).decode())
+
+    def record(self, phase, file_uuid, done, **details):
+        entities = dict()
+        for kind, table in self.tables.items():
+            touched = table.take_touched()
+            if len(touched) > 0:
+                # [entity id] for an entity that was only looked up, [entity id, change] for one that changed
+                entities[kind] = [[entity_id, change] if change else [entity_id] for entity_id, change in touched]
+        record = {'phase' : phase, 'uuid' : file_uuid, 'done' : done, 'entities' : entities}
+        record.update(details)
+        # encode now; the entities may change again before the next flush
+        self._buffer.append(json.dumps(record, separators=(',', ':')) + '\n')
+        if time.monotonic() - self._last_flush >= self.checkpoint_interval:
+            self.flush()
+
+    def snapshot(self, files):
+        """Record the state of all entities, and the given per-file details, in a single record."""
+        entities = {kind : [(entity_id, dict(entity)) for entity_id, entity in table.items()] for kind, table in self.tables.items()}
+        for table in self.tables.values():
+            table.take_touched()
+        self._buffer.append(json.dumps({'phase' : 'snapshot', 'entities' : entities, 'files' : files}, separators=(',', ':')) + '\n')
+        self.flush()
+
+    def flush(self):
+        if len(self._buffer) > 0:
+            self._fp.write(''.join(self._buffer))
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+            self._buffer = []
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        if self._fp is not None:
+            self.flush()
+            self._fp.close()
+            self._fp = None
@@ -0,0 +1,166 @@
+import collections
+import contextlib
+import functools
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+# upper bounds, in seconds, of the GDC request latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf')]
+
+STATS_FORMATS = ['json', 'openmetrics']
+
+_ID_SEGMENT = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+
+def endpoint_name(method, url):
+    """Name of the GDC endpoint a request goes to, e.g. "GET /files/{id}" or "POST /cases"."""
+    path = urllib.parse.urlsplit(url).path
+    segments = ['{id}' if _ID_SEGMENT.match(segment) else segment for segment in path.split('/') if segment]
+    return "{0} /{1}".format(method.upper(), '/'.join(segments))
+
+class RunStats():
+    """Per-stage wall time, per-endpoint request counts, latency histograms and bytes received,
+    transport-level retries and general counters for one genFcWsLoadFiles run.
+
+    Stage times are inclusive: a stage that runs inside another (e.g. collision resolution while
+    processing a file) is counted in both.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = collections.OrderedDict()
+        self.endpoints = collections.OrderedDict()
+        self.retries = 0
+        self.retry_sleep_seconds = 0.0
+        self.counters = collections.OrderedDict()
+        self.gauges = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                stage = self.stages.setdefault(name, {'seconds' : 0.0, 'calls' : 0})
+                stage['seconds'] += elapsed
+                stage['calls'] += 1
+
+    def timed(self, name):
+        """Decorator recording each call of the decorated function as the named stage."""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record_request(self, endpoint, latency, num_bytes, status_code):
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = {'requests' : 0, 'errors' : 0, 'bytes' : 0, 'latency_seconds' : 0.0,
+                         'latency_buckets' : [0] * len(LATENCY_BUCKETS), 'status_codes' : dict()}
+                self.endpoints[endpoint] = stats
+            stats['requests'] += 1
+            stats['bytes'] += num_bytes
+            stats['latency_seconds'] += latency
+            if status_code is None or status_code >= 400:
+                stats['errors'] += 1
+            status = str(status_code) if status_code is not None else 'error'
+            stats['status_codes'][status] = stats['status_codes'].get(status, 0) + 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    stats['latency_buckets'][i] += 1
+                    break
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def record_retry_sleep(self, seconds):
+        with self._lock:
+            self.retry_sleep_seconds += seconds
+
+    def increment(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def to_dict(self):
+        with self._lock:
+            endpoints = dict()
+            for endpoint, stats in self.endpoints.items():
+                stats = dict(stats)
+                stats['latency_histogram'] = {('+Inf' if bound == float('inf') else str(bound)) : count
+                                              for bound, count in zip(LATENCY_BUCKETS, stats.pop('latency_buckets'))}
+                endpoints[endpoint] = stats
+            return {'started' : self.started,
+                    'wall_seconds' : time.time() - self.started,
+                    'stages' : json.loads(json.dumps(self.stages)),
+                    'endpoints' : endpoints,
+                    'retries' : self.retries,
+                    'retry_sleep_seconds' : self.retry_sleep_seconds,
+                    'counters' : dict(self.counters),
+                    'gauges' : dict(self.gauges)}
+
+    def to_openmetrics(self, prefix='fcgdctools'):
+        stats = self.to_dict()
+        lines = []
+        def metric(name, metric_type, help_text, samples):
+            lines.append("# TYPE {0}_{1} {2}".format(prefix, name, metric_type))
+            lines.append("# HELP {0}_{1} {2}".format(prefix, name, help_text))
+            for suffix, labels, value in samples:
+                label_text = ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+                lines.append("{0}_{1}{2}{3} {4}".format(prefix, name, suffix, '{' + label_text + '}' if label_text else '', value))
+
+        metric('run_wall_seconds', 'gauge', 'Wall time of the run.', [('', [], stats['wall_seconds'])])
+        metric('stage_seconds', 'counter', 'Inclusive wall time spent in each stage.',
+               [('_total', [('stage', name)], s['seconds']) for name, s in stats['stages'].items()])
+        metric('stage_calls', 'counter', 'Number of times each stage was entered.',
+               [('_total', [('stage', name)], s['calls']) for name, s in stats['stages'].items()])
+        metric('gdc_requests', 'counter', 'GDC API requests per endpoint.',
+               [('_total', [('endpoint', name)], s['requests']) for name, s in stats['endpoints'].items()])
+        metric('gdc_request_errors', 'counter', 'GDC API requests per endpoint that failed or returned an error status.',
+               [('_total', [('endpoint', name)], s['errors']) for name, s in stats['endpoints'].items()])
+        metric('gdc_received_bytes', 'counter', 'Bytes received from each GDC API endpoint.',
+               [('_total', [('endpoint', name)], s['bytes']) for name, s in stats['endpoints'].items()])
+        histogram = []
+        for name, s in stats['endpoints'].items():
+            cumulative = 0
+            for bound, count in s['latency_histogram'].items():
+                cumulative += count
+                histogram.append(('_bucket', [('endpoint', name), ('le', bound)], cumulative))
+            histogram.append(('_sum', [('endpoint', name)], s['latency_seconds']))
+            histogram.append(('_count', [('endpoint', name)], s['requests']))
+        metric('gdc_request_duration_seconds', 'histogram', 'GDC API request latency.', histogram)
+        metric('gdc_retries', 'counter', 'GDC API request attempts retried by the transport layer.',
+               [('_total', [], stats['retries'])])
+        metric('gdc_retry_sleep_seconds', 'counter', 'Time spent sleeping between retried attempts.',
+               [('_total', [], stats['retry_sleep_seconds'])])
+        for name, value in stats['counters'].items():
+            metric(name, 'counter', name.replace('_', ' ') + '.', [('_total', [], value)])
+        for name, value in stats['gauges'].items():
+            if value is not None:
+                metric(name, 'gauge', name.replace('_', ' ') + '.', [('', [], value)])
+        lines.append("# EOF")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, stats_format='json'):
+        with open(path, 'w') as fp:
+            if stats_format == 'openmetrics':
+                fp.write(self.to_openmetrics())
+            else:
+                json.dump(self.to_dict(), fp, indent=2)
+                fp.write('\n')
+
+# statistics of the current run, shared by all modules
+STATS = RunStats()
@@ -1,11 +1,22 @@
+import concurrent.futures
+import contextlib
+import copy
+import csv
+import io
 import requests
 import json
 import sys
 import argparse
 import os
 import datetime
-import firecloud.api as api
-from manifest_downloader import build_filter_json, download_manifest
+import time
+try:
+	import firecloud.api as api
+except ImportError:
+	#only needed to talk to FireCloud itself; functions that take an fapi also accept a firecloud_stub.FireCloudStub
+	api = None
+from fcgdctools.manifest_downloader import build_filter_json, download_manifest
+from fcgdctools.fc_loadfiles import create_workspace_model, DRS_URL_ATTRIBUTE_SUFFIX
 
 FILE_TYPE_DICT = {
 	"default": ["open"],
@@ -17,94 +28,230 @@ FILE_TYPE_DICT = {
 TCGA_AUTH_DOMAIN_NAME = "TCGA-dbGaP-Authorized"
 TARGET_AUTH_DOMAIN_NAME = "TARGET-dbGaP-Authorized"
 
-def prepare_workspace_attribute_list(attr_file, auth_domain):
-	fp = open(attr_file, 'r')
-	attr_names = fp.readline().strip().split(":")[1].split("\t")
-	attr_values = fp.readline().split("\t")
-	attrs = dict()
-	for i in range(len(attr_names)):
-		attrs[attr_names[i]] = attr_values[i]
+#method repository configs that the downloader method configs are based on
+CONFIG_NAMESPACE = "broadinstitute_cga"
+FILE_DOWNLOADER_NAME = "gdc_file_downloader__default_cfg"
+BAM_DOWNLOADER_NAME = "gdc_bam_downloader__default_cfg"
+FILE_DOWNLOADER_CFG_SNAPSHOT_ID = 3
+BAM_DOWNLOADER_CFG_SNAPSHOT_ID = 2
+
+#number of FireCloud calls in flight at once
+DEFAULT_JOBS = 8
+
+#number of times a failed FireCloud call is retried, and seconds before the first retry, doubled for each subsequent one
+DEFAULT_RETRIES = 3
+RETRY_BACKOFF = 1.0
+
+#maximum number of rows and characters of each chunk of an entity upload
+UPLOAD_CHUNK_ROWS = 2000
+UPLOAD_CHUNK_SIZE = 2**21
+
+#FireCloud statuses worth retrying a call for
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+#method configs of method repository config snapshots, by (fapi, namespace, name, snapshot id)
+_CONFIG_TEMPLATES = dict()
+
+def prepare_workspace_attribute_list(workspace_attributes, auth_domain):
+	attrs = dict(workspace_attributes)
 
 	if auth_domain:
 		attrs["token_file"] = "file_path_for_gdc_token_file"
 
 	return attrs
 
-def list_downloadable_attrs(prefix, entities):
+def list_downloadable_attrs(model):
 	downloadable_attr_names = []
-	for ent in entities:
-		filename = prefix + "_" + ent + "s.txt"
-		if os.path.exists(filename):
-			fp = open(filename, 'r')
-			attribute_list = fp.readline().strip().split(":")[1].split("\t")
-			for attr in attribute_list:
-				if attr.endswith("uuid_and_filename"):
-					downloadable_attr_names.append((attr, ent))
+	for ent in model.ENTITY_TYPES:
+		for attr in model.file_attributes(ent):
+			#BAIs are downloaded along with their BAMs
+			if "__bai__" not in attr:
+				downloadable_attr_names.append((attr, ent))
 
 	return downloadable_attr_names
 
-
-def create_method_configs(billing_project, ws_name, attr_list, auth_domain):
-
-	config_namespace = "broadinstitute_cga"
-	file_downloader_name = "gdc_file_downloader__default_cfg"
-	bam_downloader_name = "gdc_bam_downloader__default_cfg"
-	file_downloader_cfg_snapshot_id = 3
-	bam_downloader_cfg_snapshot_id = 2
-
-	for attr in attr_list:
-		
-		attr_name = attr[0]
-		attr_name_base = attr_name[:-17]
-		attr_entity = attr[1]
-		if "aligned_reads" in attr_name:
-			new_config_name = "gdc_bam_downloader__" + attr_name_base + "cfg"
-			print("Uploading and configuring method config {0}, based on {1}".format(new_config_name, bam_downloader_name))
-			api.copy_config_from_repo(billing_project, ws_name, config_namespace, bam_downloader_name, bam_downloader_cfg_snapshot_id,
-						  config_namespace, new_config_name)
-			
-			current_config = api.get_workspace_config(billing_project, ws_name, config_namespace, new_config_name)
-			current_config = current_config.json()
-
-			inputs = current_config['inputs']
-			outputs = current_config['outputs']
-
-			inputs['gdc_bam_downloader_workflow.uuid_and_filename'] = "this.{0}".format(attr_name)
-			
-			outputs['gdc_bam_downloader_workflow.gdc_bam_downloader.bam_file'] = "this.{0}bam_url".format(attr_name_base)
-			outputs['gdc_bam_downloader_workflow.gdc_bam_downloader.bai_file'] = "this.{0}bai_url".format(attr_name_base)
-
-			current_config['inputs'] = inputs
-			current_config['outputs'] = outputs
-			current_config['rootEntityType'] = attr_entity
-			
-			api.update_workspace_config(billing_project, ws_name, config_namespace, new_config_name, current_config)
-
-		else:
-			new_config_name = "gdc_file_downloader__" + attr_name_base + "cfg"
-			print("Uploading and configuring method config {0}, based on {1}".format(new_config_name, file_downloader_name))
-			api.copy_config_from_repo(billing_project, ws_name, config_namespace, file_downloader_name, file_downloader_cfg_snapshot_id, 
-						  config_namespace, new_config_name)
-			
-			current_config = api.get_workspace_config(billing_project, ws_name, config_namespace, new_config_name)
-			current_config = current_config.json()
-
-			inputs = current_config['inputs']
-			outputs = current_config['outputs']
-
-			if not auth_domain:
-				inputs.pop('gdc_file_downloader_workflow.gdc_file_downloader.gdc_user_token', None)
-				
-			inputs['gdc_file_downloader_workflow.uuid_and_filename'] = "this.{0}".format(attr_name)
-			
-			outputs['gdc_file_downloader_workflow.gdc_file_downloader.file'] = "this.{0}url".format(attr_name_base)
-			
-			current_config['inputs'] = inputs
-			current_config['outputs'] = outputs
-			current_config['rootEntityType'] = attr_entity
-
-			api.update_workspace_config(billing_project, ws_name, config_namespace, new_config_name, current_config)
-			
+def entities_tsv(rows):
+	#text of a load file with the given header and rows, as genFcWsLoadFiles writes it
+	buffer = io.StringIO()
+	csv.writer(buffer, delimiter='\t', lineterminator='\r\n').writerows(rows)
+	return buffer.getvalue()
+
+def _chunks(rows, max_rows, max_size):
+	#TSV texts of a load file's rows, each with the header, at most max_rows rows and, unless a single row is larger, max_size characters
+	rows = iter(rows)
+	header = entities_tsv([next(rows)])
+	buffer = io.StringIO()
+	writer = csv.writer(buffer, delimiter='\t', lineterminator='\r\n')
+	lines = []
+	size = len(header)
+	for row in rows:
+		writer.writerow(row)
+		line = buffer.getvalue()
+		buffer.seek(0)
+		buffer.truncate()
+		if len(lines) > 0 and (len(lines) == max_rows or size + len(line) > max_size):
+			yield header + ''.join(lines)
+			lines = []
+			size = len(header)
+		lines.append(line)
+		size += len(line)
+	if len(lines) > 0:
+		yield header + ''.join(lines)
+
+def _chunk_tasks(entity_type, rows, chunk_rows, chunk_size):
+	#(description, chunks) of each chunk of an entity type's load file
+	for i, chunk in enumerate(_chunks(rows, chunk_rows, chunk_size)):
+		yield "{0}s chunk {1}".format(entity_type, i + 1), [chunk]
+
+def _upload_chunks(billing_project, ws_name, chunks, fapi, retries):
+	#uploads the chunks one after the other, each retried on its own
+	for chunk in chunks:
+		response = _call_with_retry(retries, fapi.upload_entities, billing_project, ws_name, chunk)
+		if response.status_code != 200:
+			raise RuntimeError("{0} {1}".format(response.status_code, response.text))
+
+def _upload_stage(executor, jobs, tasks, billing_project, ws_name, fapi, retries):
+	#uploads the (description, chunks) tasks, at most 2 * jobs of them submitted at a time; returns the descriptions of those that failed
+	pending = dict()
+	failed = []
+
+	def collect(done):
+		for future in done:
+			description = pending.pop(future)
+			try:
+				future.result()
+				print("Uploaded {0}".format(description))
+			except (requests.exceptions.RequestException, RuntimeError) as x:
+				print("Could not upload {0}: {1}".format(description, x))
+				failed.append(description)
+
+	for description, chunks in tasks:
+		if len(pending) >= 2 * jobs:
+			collect(concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)[0])
+		pending[executor.submit(_upload_chunks, billing_project, ws_name, chunks, fapi, retries)] = description
+	collect(concurrent.futures.wait(pending)[0])
+	return failed
+
+def upload_entities(billing_project, ws_name, model, jobs=DEFAULT_JOBS, retries=DEFAULT_RETRIES, 
+                    chunk_rows=UPLOAD_CHUNK_ROWS, chunk_size=UPLOAD_CHUNK_SIZE, fapi=None):
+	"""Upload the model's participants, samples and pairs, and their sets, to the workspace.
+
+	Each load file is split into chunks of at most chunk_rows rows and chunk_size characters, each 
+	with the load file's header.  Participants, samples, pairs and sets are uploaded in that order, 
+	so that the entities a chunk references already exist, and the chunks of each jobs at a time; 
+	the chunks of a set's membership, which all add members to the same set, are uploaded one after 
+	the other.  A failed chunk is retried up to retries times on its own.  If a chunk still fails, the 
+	entities that depend on it are not uploaded and a RuntimeError is raised.
+	"""
+	fapi = api if fapi is None else fapi
+	entity_types = [ent for ent in model.ENTITY_TYPES if len(model.entities(ent)) > 0]
+
+	#the chunks are cut in this thread, as they are uploaded: the entities of a --store disk model can't be read from others
+	stages = [_chunk_tasks(ent, model.load_file_rows(ent), chunk_rows, chunk_size) for ent in entity_types]
+	stages.append([(ent + "_sets_membership", list(_chunks(model.membership_file_rows(ent), chunk_rows, chunk_size)))
+	               for ent in entity_types])
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+		for tasks in stages:
+			failed = _upload_stage(executor, jobs, tasks, billing_project, ws_name, fapi, retries)
+			if len(failed) > 0:
+				raise RuntimeError("could not upload {0}".format(", ".join(sorted(failed))))
+
+
+def _call_with_retry(retries, function, *args):
+	#the response of function(*args), retried with exponential backoff after connection errors and retryable statuses
+	for attempt in range(retries + 1):
+		try:
+			response = function(*args)
+			if response.status_code not in RETRY_STATUSES or attempt == retries:
+				return response
+			print("{0} returned {1}, retrying".format(function.__name__, response.status_code))
+		except requests.exceptions.RequestException as x:
+			if attempt == retries:
+				raise
+			print("{0} failed, retrying: {1}".format(function.__name__, x))
+		time.sleep(RETRY_BACKOFF * 2**attempt)
+
+def get_config_template(namespace, name, snapshot_id, fapi=None, retries=DEFAULT_RETRIES):
+	"""The method config of a method repository config snapshot.  Each snapshot is only fetched once."""
+	fapi = api if fapi is None else fapi
+	key = (fapi, namespace, name, snapshot_id)
+	if key not in _CONFIG_TEMPLATES:
+		response = _call_with_retry(retries, fapi.get_repository_config, namespace, name, snapshot_id)
+		if response.status_code != 200:
+			raise RuntimeError("could not get method config {0}/{1} snapshot {2}: {3} {4}".format(namespace, name, snapshot_id, 
+			                   response.status_code, response.text))
+		_CONFIG_TEMPLATES[key] = json.loads(response.json()['payload'])
+	return copy.deepcopy(_CONFIG_TEMPLATES[key])
+
+def build_method_config(attr_name, attr_entity, auth_domain, fapi=None, retries=DEFAULT_RETRIES):
+	"""The method config that downloads the files referenced by attribute attr_name of attr_entity entities."""
+	attr_name_base = attr_name[:-len(DRS_URL_ATTRIBUTE_SUFFIX)]
+	if "aligned_reads" in attr_name:
+		config = get_config_template(CONFIG_NAMESPACE, BAM_DOWNLOADER_NAME, BAM_DOWNLOADER_CFG_SNAPSHOT_ID, fapi, retries)
+		config['name'] = "gdc_bam_downloader__" + attr_name_base + "cfg"
+		print("Configuring method config {0}, based on {1}".format(config['name'], BAM_DOWNLOADER_NAME))
+
+		inputs = config['inputs']
+		outputs = config['outputs']
+
+		inputs['gdc_bam_downloader_workflow.uuid_and_filename'] = "this.{0}".format(attr_name)
+
+		outputs['gdc_bam_downloader_workflow.gdc_bam_downloader.bam_file'] = "this.{0}bam_url".format(attr_name_base)
+		outputs['gdc_bam_downloader_workflow.gdc_bam_downloader.bai_file'] = "this.{0}bai_url".format(attr_name_base)
+
+	else:
+		config = get_config_template(CONFIG_NAMESPACE, FILE_DOWNLOADER_NAME, FILE_DOWNLOADER_CFG_SNAPSHOT_ID, fapi, retries)
+		config['name'] = "gdc_file_downloader__" + attr_name_base + "cfg"
+		print("Configuring method config {0}, based on {1}".format(config['name'], FILE_DOWNLOADER_NAME))
+
+		inputs = config['inputs']
+		outputs = config['outputs']
+
+		if not auth_domain:
+			inputs.pop('gdc_file_downloader_workflow.gdc_file_downloader.gdc_user_token', None)
+
+		inputs['gdc_file_downloader_workflow.uuid_and_filename'] = "this.{0}".format(attr_name)
+
+		outputs['gdc_file_downloader_workflow.gdc_file_downloader.file'] = "this.{0}url".format(attr_name_base)
+
+	config['namespace'] = CONFIG_NAMESPACE
+	config['rootEntityType'] = attr_entity
+	return config
+
+def _push_method_config(billing_project, ws_name, config, fapi, retries):
+	response = _call_with_retry(retries, fapi.create_workspace_config, billing_project, ws_name, config)
+	if response.status_code == 409:
+		#left by an earlier run
+		response = _call_with_retry(retries, fapi.update_workspace_config, billing_project, ws_name, 
+		                            config['namespace'], config['name'], config)
+	if response.status_code not in (200, 201):
+		raise RuntimeError("{0} {1}".format(response.status_code, response.text))
+
+def create_method_configs(billing_project, ws_name, attr_list, auth_domain, jobs=DEFAULT_JOBS, retries=DEFAULT_RETRIES, fapi=None):
+	"""Create a downloader method config for each (attribute name, entity type) of attr_list in the workspace.
+
+	The configs are built locally from the downloader templates, which are fetched from the method 
+	repository once, and pushed to the workspace jobs at a time.  Calls that fail are retried up to 
+	retries times; configs that still could not be created are reported in a RuntimeError once all
+	others are.
+	"""
+	fapi = api if fapi is None else fapi
+	configs = [build_method_config(attr[0], attr[1], auth_domain, fapi, retries) for attr in attr_list]
+
+	failed = []
+	with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+		futures = {executor.submit(_push_method_config, billing_project, ws_name, config, fapi, retries) : config['name'] for config in configs}
+		for future in concurrent.futures.as_completed(futures):
+			try:
+				future.result()
+				print("Uploaded method config {0}".format(futures[future]))
+			except (requests.exceptions.RequestException, RuntimeError) as x:
+				print("Could not upload method config {0}: {1}".format(futures[future], x))
+				failed.append(futures[future])
+
+	if len(failed) > 0:
+		raise RuntimeError("could not upload method configs {0}".format(", ".join(sorted(failed))))
 
 def main():
 
@@ -114,6 +261,13 @@ def main():
     parser.add_argument("billing_project", help="name of billing project to create the workspace under. e.g: broad-firecloud-tcga")
     parser.add_argument("ws_suffix", help="descriptive suffix to add to the workspace auto-generated name. e.g: ControlledAccess_hg38_V1-0_DATA")
     parser.add_argument("-a", "--auth_domain", help="authorization domain. for dbGaP controlled access the domain name is TCGA-dbGaP-Authorized.", default="")
+    parser.add_argument("-l", "--load_files", help="also write the workspace load files to the cohort directory", action="store_true")
+    parser.add_argument("-j", "--jobs", help="number of FireCloud calls kept in flight at once (default: {0})".format(DEFAULT_JOBS),
+                        type=int, default=DEFAULT_JOBS)
+    parser.add_argument("--retries", help="number of times a failed FireCloud call is retried (default: {0})".format(DEFAULT_RETRIES),
+                        type=int, default=DEFAULT_RETRIES)
+    parser.add_argument("--chunk_rows", help="maximum number of rows uploaded per entity upload request (default: {0})".format(UPLOAD_CHUNK_ROWS),
+                        type=int, default=UPLOAD_CHUNK_ROWS)
     
     args = parser.parse_args()
 
@@ -154,19 +308,14 @@ def main():
     print("manifest downloaded")
     
     #Step 3:
-    #Run fcgdctools on the manifest file
-    if args.project_name == "TARGET":
-        fcgdctools_command = "genFcWsLoadFiles -c " + manifest_filename + ">genFcWsLoadFiles_output.txt"
-    else:
-        fcgdctools_command = "genFcWsLoadFiles " + manifest_filename + ">genFcWsLoadFiles_output.txt"
-
-    print("Executing command {0}\nPlease check the output file to see progress and check for errors.".format(fcgdctools_command))
-    os.system(fcgdctools_command)
+    #Create the workspace entities from the manifest file with fcgdctools
+    print("Creating workspace entities from {0}\nPlease check genFcWsLoadFiles_output.txt to see progress and check for errors.".format(manifest_filename))
+    with open("genFcWsLoadFiles_output.txt", 'w') as output, contextlib.redirect_stdout(output):
+        model = create_workspace_model(manifest_filename, write_load_files=args.load_files, all_cases=(args.project_name == "TARGET"))
     
     #Step 4:
     #Prepare attributes to be loaded
-    workspace_attribute_filename = manifest_filename.split(".")[0] + "_workspace_attributes.txt"
-    attribute_list = prepare_workspace_attribute_list(workspace_attribute_filename, args.auth_domain)
+    attribute_list = prepare_workspace_attribute_list(model.attributes, args.auth_domain)
     
     #Step 5:
     #Create the new workspace on FireCloud
@@ -175,24 +324,17 @@ def main():
     api.create_workspace(args.billing_project, workspace_name, args.auth_domain, attribute_list)
 
     #Step 6:
-    #Upload data model .tsv files to the newly created workspace
-    data_model_file_prefix = manifest_filename.split(".")[0]
-    data_files = ["participants", "participant_sets_membership", "samples", "sample_sets_membership", "pairs", "pair_sets_membership"]
-    for filetype in data_files:
-    	full_name = data_model_file_prefix + "_" + filetype + ".txt"
-    	if os.path.exists(full_name):
-    		print("Uploading file {0}".format(full_name))
-    		api.upload_entities_tsv(args.billing_project, workspace_name, full_name)
+    #Upload the data model to the newly created workspace
+    upload_entities(args.billing_project, workspace_name, model, args.jobs, args.retries, args.chunk_rows)
 
     #Step 7:
     #Create and Upload method configurations for downloading files to the new workspace
-    downloadable_attrs = list_downloadable_attrs(data_model_file_prefix, ["participant", "sample", "pair"])
+    downloadable_attrs = list_downloadable_attrs(model)
     print("The downloadable attributes are:")
     for attr in downloadable_attrs:
     	print(attr[0])
-    create_method_configs(args.billing_project, workspace_name, downloadable_attrs, args.auth_domain)
+    create_method_configs(args.billing_project, workspace_name, downloadable_attrs, args.auth_domain, args.jobs, args.retries)
+    model.close()
 
 if __name__ == '__main__':
     main()
-
-
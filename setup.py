@@ -25,7 +25,10 @@ setup(
     entry_points={
         'console_scripts': [
             'genFcWsLoadFiles=fcgdctools.fc_loadfiles:main',
+            'gdcStubServer=fcgdctools.gdc_stub_server:main',
+            'fcgdctoolsBenchmark=fcgdctools.benchmark:main',
         ],
     },
-    install_requires=['requests']
+    # urllib3 1.26 introduced Retry(allowed_methods=...)
+    install_requires=['requests', 'urllib3>=1.26']
 )    
@@ -0,0 +1,269 @@
+import csv
+import io
+import itertools
+import json
+import os
+
+import pytest
+
+from fcgdctools import fc_loadfiles
+from fcgdctools.benchmark import synthesize_cohort, write_manifest
+from fcgdctools.gdc_stub_server import serve
+from fcgdctools.entity_table import EntityTable
+from fcgdctools.fc_loadfiles import ALIQUOT_KEYS, GDC_ProgramName, GDC_DataCategory, GDC_DataType
+
+def _baseline_pick_tcga_submitter(a, b):
+    # the pairwise comparator that replicate selection used before aliquot sort keys
+    analyte1 = a[19]
+    analyte2 = b[19]
+    plate1   = a[21:25]
+    plate2   = b[21:25]
+    if a == b:
+        return a
+    elif analyte1 == analyte2:
+        return a if a >= b else b
+    elif analyte1 == "H":
+        return a
+    elif analyte1 == "R":
+        return a if analyte2 == "T" else b
+    elif analyte1 == "T":
+        return b
+    elif analyte1 == "D":
+        return a if plate2 <= plate1 else b
+    elif analyte2 == "D":
+        return b if plate1 <= plate2 else a
+    else:
+        return a if a >= b else b
+
+def _barcodes(analytes):
+    # TCGA-BL-A0C8-01A-<portion><analyte>-<plate>-01
+    return ['TCGA-BL-A0C8-01A-{0}{1}-{2}-01'.format(portion, analyte, plate)
+            for portion, analyte, plate in itertools.product(['11', '21'], analytes, ['A050', 'A100', 'A277'])]
+
+PAIRS = (list(itertools.combinations(_barcodes('DGWX'), 2)) +
+         list(itertools.combinations(_barcodes('HRT'), 2)))
+
+@pytest.mark.parametrize('a,b', PAIRS)
+def test_tcga_aliquot_key_agrees_with_baseline_comparator(a, b):
+    key = ALIQUOT_KEYS[GDC_ProgramName.TCGA]
+    expected = _baseline_pick_tcga_submitter(a, b)
+    assert expected == _baseline_pick_tcga_submitter(b, a)
+    assert max([a, b], key=key) == expected
+    assert max([b, a], key=key) == expected
+
+@pytest.mark.parametrize('a,b,expected', [
+    # same analyte: highest barcode, whatever the plates
+    ('TCGA-BL-A0C8-01A-11D-A100-01', 'TCGA-BL-A0C8-01A-21D-A050-01', 'TCGA-BL-A0C8-01A-21D-A050-01'),
+    ('TCGA-BL-A0C8-01A-11W-A100-01', 'TCGA-BL-A0C8-01A-21W-A050-01', 'TCGA-BL-A0C8-01A-21W-A050-01'),
+    # neither is D: highest barcode
+    ('TCGA-BL-A0C8-01A-11X-A050-01', 'TCGA-BL-A0C8-01A-21W-A100-01', 'TCGA-BL-A0C8-01A-21W-A100-01'),
+    # D against another DNA analyte: higher plate, D on the same plate
+    ('TCGA-BL-A0C8-01A-21D-A050-01', 'TCGA-BL-A0C8-01A-11W-A100-01', 'TCGA-BL-A0C8-01A-11W-A100-01'),
+    ('TCGA-BL-A0C8-01A-11D-A100-01', 'TCGA-BL-A0C8-01A-21X-A100-01', 'TCGA-BL-A0C8-01A-11D-A100-01'),
+])
+def test_tcga_aliquot_key_examples(a, b, expected):
+    key = ALIQUOT_KEYS[GDC_ProgramName.TCGA]
+    assert max([a, b], key=key) == expected
+    assert max([b, a], key=key) == expected
+
+def test_tcga_aliquot_pair_keys_rank_tumor_then_normal():
+    key = ALIQUOT_KEYS[GDC_ProgramName.TCGA]
+    tumor_1, tumor_2 = 'TCGA-BL-A0C8-01A-11D-A100-01', 'TCGA-BL-A0C8-01A-21D-A050-01'
+    normal_1, normal_2 = 'TCGA-BL-A0C8-10A-01D-A100-01', 'TCGA-BL-A0C8-10A-01D-A277-01'
+    assert max([(key(tumor_1), key(normal_2)), (key(tumor_2), key(normal_1))]) == (key(tumor_2), key(normal_1))
+    assert max([(key(tumor_1), key(normal_1)), (key(tumor_1), key(normal_2))]) == (key(tumor_1), key(normal_2))
+
+@pytest.fixture
+def file_state(monkeypatch):
+    # fresh per-file state, and a session that must not be used: collisions are resolved without requests
+    def no_session():
+        raise AssertionError("no GDC request may be made to resolve collisions")
+    for name in ['UUID_TO_FILENAME', 'DEFERRED_FILE_NUM_OF_CASES', 'FILE_ALIQUOTS', 'FILE_ATTRIBUTE_SLOTS', 'FILE_CLASSIFICATIONS']:
+        monkeypatch.setattr(fc_loadfiles, name, dict())
+    monkeypatch.setattr(fc_loadfiles, 'get_session', no_session)
+    return fc_loadfiles
+
+def _tcga_file(state, file_uuid, samples):
+    state.UUID_TO_FILENAME[file_uuid] = file_uuid + '.txt'
+    state._record_aliquot_identities(file_uuid, {'cases' : [{'case_id' : 'case-1', 'samples' : samples}] if samples is not None
+                                                 else [{'case_id' : 'case-1'}]})
+
+def _sample(sample_type, barcode):
+    return {'sample_type' : sample_type, 'portions' : [{'analytes' : [{'aliquots' : [{'submitter_id' : barcode}]}]}]}
+
+def test_sample_less_files_are_recorded_and_ranked_by_uuid(file_state):
+    _tcga_file(file_state, 'uuid-b', None)
+    _tcga_file(file_state, 'uuid-a', None)
+    assert file_state.FILE_ALIQUOTS == {'uuid-a' : [], 'uuid-b' : []}
+
+    chosen = file_state._choose_file(GDC_DataCategory.CLINICAL, GDC_DataType.CLINICAL_SUPPLEMENT, GDC_ProgramName.TCGA, ['uuid-b', 'uuid-a'])
+    assert chosen == 'uuid-a'
+
+def test_files_with_unexpected_aliquots_rank_last(file_state):
+    _tcga_file(file_state, 'uuid-a', [])
+    _tcga_file(file_state, 'uuid-b', [_sample('Primary Tumor', 'TCGA-BL-A0C8-01A-11D-A100-01'),
+                                      _sample('Blood Derived Normal', 'TCGA-BL-A0C8-10A-01D-A100-01')])
+    _tcga_file(file_state, 'uuid-c', [_sample('Primary Tumor', 'TCGA-BL-A0C8-01A-11D-A050-01')])
+
+    chosen = file_state._choose_file(GDC_DataCategory.COPY_NUMBER_VARIATION, GDC_DataType.COPY_NUMBER_SEGMENT, GDC_ProgramName.TCGA,
+                                     ['uuid-a', 'uuid-b', 'uuid-c'])
+    assert chosen == 'uuid-c'
+    chosen = file_state._choose_file(GDC_DataCategory.SNV, GDC_DataType.ANNOTATED_SOMATIC_MUTATION, GDC_ProgramName.TCGA,
+                                     ['uuid-a', 'uuid-b', 'uuid-c'])
+    assert chosen == 'uuid-b'
+
+ATTRIBUTE = 'clinical_supplement__bcr_xml__drs_url'
+
+def _collide(state, entity_id, attribute_name, file_uuids, classification):
+    # a participants table in which file_uuids all map to the entity's attribute, which refers to the first of them,
+    # as if that file had been processed first
+    table = EntityTable('participant')
+    table[entity_id] = {'submitter_id' : 'TCGA-BL-A0C8'}
+    table.set_attribute(entity_id, attribute_name, state._create_drs_url(file_uuids[0]))
+    for file_uuid in file_uuids:
+        state.FILE_ATTRIBUTE_SLOTS[file_uuid] = [[entity_id, attribute_name]]
+        state.FILE_CLASSIFICATIONS[file_uuid] = classification
+    return table
+
+def test_reduce_collisions_of_sample_less_files(file_state):
+    for file_uuid in ['uuid-b', 'uuid-a']:
+        _tcga_file(file_state, file_uuid, None)
+    table = _collide(file_state, 'case-1', ATTRIBUTE, ['uuid-b', 'uuid-a'],
+                     (GDC_DataCategory.CLINICAL, GDC_DataType.CLINICAL_SUPPLEMENT, GDC_ProgramName.TCGA))
+    file_state._reduce_collisions([table])
+    assert table['case-1'][ATTRIBUTE] == file_state._create_drs_url('uuid-a')
+
+def test_reduce_collisions_keeps_smallest_uuid_of_files_that_cannot_be_ranked(file_state):
+    # slide images are ranked by the portion in their filename, which these don't have
+    file_state.UUID_TO_FILENAME.update({'uuid-b' : 'slide_b.svs', 'uuid-a' : 'slide_a.svs'})
+    other = ATTRIBUTE.replace('clinical', 'other')
+    table = _collide(file_state, 'case-1', ATTRIBUTE, ['uuid-b', 'uuid-a'],
+                     (GDC_DataCategory.BIOSPECIMEN, GDC_DataType.SLIDE_IMAGE, GDC_ProgramName.TCGA))
+    # a later attribute is still resolved
+    table.set_attribute('case-1', other, file_state._create_drs_url('uuid-d'))
+    for file_uuid in ['uuid-d', 'uuid-c']:
+        _tcga_file(file_state, file_uuid, None)
+        file_state.FILE_ATTRIBUTE_SLOTS[file_uuid] = [['case-1', other]]
+        file_state.FILE_CLASSIFICATIONS[file_uuid] = (GDC_DataCategory.CLINICAL, GDC_DataType.CLINICAL_SUPPLEMENT, GDC_ProgramName.TCGA)
+
+    file_state._reduce_collisions([table])
+    assert table['case-1'][ATTRIBUTE] == file_state._create_drs_url('uuid-a')
+    assert table['case-1'][other] == file_state._create_drs_url('uuid-c')
+
+# candidates for a sample's attribute: the best aliquot, two files of a tied aliquot, and a file without samples
+COLLIDING_FILES = [('uuid-1', [_sample('Primary Tumor', 'TCGA-BL-A0C8-01A-11D-A050-01')]),
+                   ('uuid-2', [_sample('Primary Tumor', 'TCGA-BL-A0C8-01A-21D-A050-01')]),
+                   ('uuid-3', [_sample('Primary Tumor', 'TCGA-BL-A0C8-01A-21D-A050-01')]),
+                   ('uuid-4', None)]
+
+@pytest.mark.parametrize('candidates,expected', [
+    (COLLIDING_FILES[:2], 'uuid-2'),
+    # equal keys: the smaller uuid
+    (COLLIDING_FILES[1:3], 'uuid-2'),
+    (COLLIDING_FILES[2:], 'uuid-3'),
+    (COLLIDING_FILES, 'uuid-2'),
+])
+def test_collision_choice_is_order_independent(file_state, candidates, expected):
+    attribute_name = 'WXS__copy_number_segment__drs_url'
+    classification = (GDC_DataCategory.COPY_NUMBER_VARIATION, GDC_DataType.COPY_NUMBER_SEGMENT, GDC_ProgramName.TCGA)
+    for permutation in itertools.permutations(candidates):
+        for name in ['UUID_TO_FILENAME', 'FILE_ALIQUOTS', 'FILE_ATTRIBUTE_SLOTS', 'FILE_CLASSIFICATIONS']:
+            getattr(file_state, name).clear()
+        file_uuids = [file_uuid for file_uuid, _ in permutation]
+        for file_uuid, samples in permutation:
+            _tcga_file(file_state, file_uuid, samples)
+        assert file_state._choose_file(*classification, file_uuids) == expected
+
+        table = _collide(file_state, 'sample-1', attribute_name, file_uuids, classification)
+        file_state._reduce_collisions([table])
+        assert table['sample-1'][attribute_name] == file_state._create_drs_url(expected)
+
+@pytest.fixture(scope='module')
+def cohort(tmp_path_factory):
+    # a synthetic cohort served by the GDC stand-in, and its manifest
+    store = synthesize_cohort(300)
+    server = serve(store)
+    path = str(tmp_path_factory.mktemp('cohort') / 'manifest.tsv')
+    write_manifest(store, path)
+    yield server.url, path
+    server.shutdown()
+    server.server_close()
+
+def _load_files(model):
+    # text of each of the model's load files, as genFcWsLoadFiles writes them
+    load_files = dict()
+    for entity_type in model.ENTITY_TYPES:
+        for name, rows in [(entity_type, model.load_file_rows(entity_type)),
+                           (entity_type + '_set_membership', model.membership_file_rows(entity_type))]:
+            buffer = io.StringIO()
+            csv.writer(buffer, delimiter='\t', lineterminator='\r\n').writerows(rows)
+            load_files[name] = buffer.getvalue()
+    return load_files
+
+def _create_load_files(cohort, manifest=None, **options):
+    gdc_api_root, path = cohort
+    with fc_loadfiles.create_workspace_model(manifest or path, gdc_api_root=gdc_api_root, no_cache=True, max_rate=0, **options) as model:
+        return _load_files(model)
+
+def _cut_journal(journal_path, keep):
+    # the journal as an interrupted run would have left it: its header and the file records for which keep(record) holds
+    with open(journal_path) as fp:
+        lines = fp.readlines()
+    kept = lines[:1] + [line for line in lines[1:] if keep(json.loads(line))]
+    assert len(kept) < len(lines)
+    with open(journal_path, 'w') as fp:
+        fp.writelines(kept)
+
+@pytest.fixture(scope='module')
+def plain_run(cohort):
+    return _create_load_files(cohort)
+
+@pytest.mark.parametrize('store', ['memory', 'disk'])
+def test_journaled_run_matches_plain_run(cohort, plain_run, tmp_path, monkeypatch, store):
+    monkeypatch.chdir(tmp_path)
+    assert _create_load_files(cohort, journal='journal.jsonl', store=store) == plain_run
+    assert os.path.exists('journal.jsonl')
+
+@pytest.mark.parametrize('phase', ['files', 'deferred'])
+@pytest.mark.parametrize('store', ['memory', 'disk'])
+def test_resumed_run_matches_plain_run(cohort, plain_run, tmp_path, monkeypatch, phase, store):
+    monkeypatch.chdir(tmp_path)
+    _create_load_files(cohort, journal='journal.jsonl')
+    if phase == 'files':
+        # interrupted halfway through the files
+        seen = []
+        _cut_journal('journal.jsonl', lambda record: record['phase'] == 'files' and len(seen) < 100 and not seen.append(record))
+    else:
+        # interrupted after the first multi-case file
+        seen = []
+        _cut_journal('journal.jsonl', lambda record: record['phase'] == 'files' or 
+                     (record['phase'] == 'deferred' and len(seen) < 1 and not seen.append(record)))
+    assert _create_load_files(cohort, journal='journal.jsonl', resume=True, store=store) == plain_run
+
+def test_incremental_run_matches_plain_run(cohort, plain_run, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # the previous run lacked every fourth file, and had one that is no longer in the manifest
+    with open(cohort[1]) as fp:
+        lines = fp.readlines()
+    removed = lines[1].split('\t')
+    removed[0] = '00000000-0000-4000-8000-000000000000'
+    with open('old_manifest.tsv', 'w') as fp:
+        fp.writelines(lines[:1] + [line for i, line in enumerate(lines[1:]) if i % 4 != 3] + ['\t'.join(removed)])
+    _create_load_files(cohort, 'old_manifest.tsv', journal='old_journal.jsonl')
+
+    assert _create_load_files(cohort, journal='new_journal.jsonl', previous='old_journal.jsonl') == plain_run
+
+def test_merged_shards_match_plain_run(cohort, plain_run, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    gdc_api_root, _ = cohort
+    for shard_index in range(1, 4):
+        _create_load_files(cohort, shard=(shard_index, 3), journal='shard_{0}.jsonl'.format(shard_index))
+    fc_loadfiles.merge_main(['shard_1.jsonl', 'shard_2.jsonl', 'shard_3.jsonl', '-o', 'merged',
+                             '--gdc_api_root', gdc_api_root, '--no_cache', '--max_rate', '0'])
+    for name, text in plain_run.items():
+        if name.endswith('_set_membership'):
+            filename = 'merged_{0}_sets_membership.tsv'.format(name[:-len('_set_membership')])
+        else:
+            filename = 'merged_{0}s.tsv'.format(name)
+        with open(filename, newline='') as fp:
+            assert fp.read() == text
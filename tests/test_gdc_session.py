@@ -0,0 +1,36 @@
+import math
+
+from fcgdctools.gdc_session import AdaptiveRateController, DEFAULT_INITIAL_RATE, DEFAULT_MAX_RATE
+
+def _run_fast_requests(controller, n, waited):
+    # each request passes the controller as GdcSession would; the bucket reports whether it made the request wait
+    controller.bucket.take = lambda: waited
+    for _ in range(n):
+        controller.acquire()
+        controller.release(0.01, False)
+
+def test_rate_does_not_rise_while_bucket_does_not_limit():
+    controller = AdaptiveRateController(cooldown=0)
+    _run_fast_requests(controller, 5000, waited=False)
+    assert controller.bucket.rate == DEFAULT_INITIAL_RATE
+    controller.release(0.01, True)
+    assert controller.bucket.rate <= DEFAULT_INITIAL_RATE / 2
+
+def test_rate_stays_finite_and_recovers_after_throttle():
+    controller = AdaptiveRateController(cooldown=0)
+    _run_fast_requests(controller, 5000, waited=True)
+    assert math.isfinite(controller.bucket.rate)
+    assert controller.bucket.rate <= DEFAULT_MAX_RATE
+    controller.release(0.01, True)
+    assert controller.bucket.rate <= DEFAULT_MAX_RATE / 2
+    assert controller.bucket.burst <= DEFAULT_MAX_RATE / 2
+
+def test_zero_max_rate_disables_bucket():
+    controller = AdaptiveRateController(max_rate=0, cooldown=0)
+    assert controller.bucket is None
+    for _ in range(100):
+        controller.acquire()
+        controller.release(0.01, False)
+    controller.release(0.01, True)
+    assert controller.metrics()['rate'] is None
+    assert controller.concurrency >= 1
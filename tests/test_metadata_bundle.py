@@ -0,0 +1,35 @@
+import pytest
+
+from fcgdctools import fc_loadfiles
+from fcgdctools.metadata_bundle import MetadataBundle, MetadataBundleWriter
+
+GDC_API_ROOT = 'https://api.gdc.cancer.gov'
+
+@pytest.fixture
+def bundle(tmp_path):
+    path = str(tmp_path / 'bundle.jsonl.gz')
+    with MetadataBundleWriter(path) as writer:
+        for file_id in ['f1', 'f2']:
+            writer.write_file({'file_id' : file_id, 'data_category' : 'Clinical', 'index_files' : [{'file_id' : file_id + '.bai'}]})
+        writer.write_case({'case_id' : 'c1', 'primary_site' : 'Breast'})
+    return MetadataBundle(path)
+
+def test_get_many_returns_files_in_bundle(bundle):
+    found = bundle.get_many(GDC_API_ROOT + '/files', ['f1', 'missing', 'f2'], 'data_category')
+    assert sorted(found) == ['f1', 'f2']
+    assert bundle.hits == 2
+    assert bundle.misses == 1
+
+def test_get_of_missing_file_fails(bundle):
+    assert bundle.get(GDC_API_ROOT + '/cases', 'c1', 'primary_site')['primary_site'] == 'Breast'
+    assert bundle.get(GDC_API_ROOT + '/files', 'f1', 'expand=index_files') == [{'file_id' : 'f1.bai'}]
+    with pytest.raises(ValueError):
+        bundle.get(GDC_API_ROOT + '/files', 'missing', 'data_category')
+
+def test_batch_retriever_answers_from_bundle_without_requests(bundle, monkeypatch):
+    def no_session():
+        raise AssertionError("no GDC request may be made with a metadata bundle")
+    monkeypatch.setattr(fc_loadfiles, 'METADATA_CACHE', bundle)
+    monkeypatch.setattr(fc_loadfiles, 'get_session', no_session)
+    retriever = fc_loadfiles.FileBatchMetadataRetriever(GDC_API_ROOT)
+    assert sorted(retriever.get_metadata(['f1', 'missing', 'f2'])) == ['f1', 'f2']
@@ -0,0 +1,160 @@
+import importlib
+import sys
+import types
+
+import pytest
+
+from fcgdctools import ws_builder
+from fcgdctools.entity_table import EntityTable
+from fcgdctools.fc_loadfiles import WorkspaceModel
+from fcgdctools.firecloud_stub import FireCloudStub
+
+def test_ws_builder_imports_with_firecloud_api(monkeypatch):
+    firecloud = types.ModuleType('firecloud')
+    firecloud_api = types.ModuleType('firecloud.api')
+    firecloud.api = firecloud_api
+    monkeypatch.setitem(sys.modules, 'firecloud', firecloud)
+    monkeypatch.setitem(sys.modules, 'firecloud.api', firecloud_api)
+    monkeypatch.delitem(sys.modules, 'fcgdctools.ws_builder', raising=False)
+
+    ws_builder = importlib.import_module('fcgdctools.ws_builder')
+
+    assert ws_builder.api is firecloud_api
+    assert callable(ws_builder.create_workspace_model)
+    assert callable(ws_builder.download_manifest)
+
+NAMESPACE, WORKSPACE = 'billing-project', 'workspace'
+
+ATTRIBUTES = [('WXS__aligned_reads__bam__drs_url', 'sample'),
+              ('RNA__gene_expression_quantification__tsv__drs_url', 'sample'),
+              ('clinical_supplement__bcr_xml__drs_url', 'participant'),
+              ('WXS__masked_somatic_mutation__maf__drs_url', 'pair')]
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(ws_builder, 'RETRY_BACKOFF', 0.0)
+
+def _stub(error_rate=0.0, **options):
+    # the workspace is created before any errors are injected
+    stub = FireCloudStub(seed=1, **options)
+    stub.create_workspace(NAMESPACE, WORKSPACE)
+    stub.error_rate = error_rate
+    return stub
+
+def _method_configs(stub):
+    return stub.workspaces[(NAMESPACE, WORKSPACE)]['method_configs']
+
+def test_create_method_configs_fetches_each_template_once():
+    stub = _stub()
+    ws_builder.create_method_configs(NAMESPACE, WORKSPACE, ATTRIBUTES, '', jobs=4, fapi=stub)
+
+    configs = _method_configs(stub)
+    assert sorted(name for _, name in configs) == sorted([
+        'gdc_bam_downloader__WXS__aligned_reads__bam__cfg',
+        'gdc_file_downloader__RNA__gene_expression_quantification__tsv__cfg',
+        'gdc_file_downloader__clinical_supplement__bcr_xml__cfg',
+        'gdc_file_downloader__WXS__masked_somatic_mutation__maf__cfg'])
+    assert stub.request_counts['get_repository_config'] == 2
+    bam_config = configs[(ws_builder.CONFIG_NAMESPACE, 'gdc_bam_downloader__WXS__aligned_reads__bam__cfg')]
+    assert bam_config['rootEntityType'] == 'sample'
+    assert bam_config['inputs']['gdc_bam_downloader_workflow.uuid_and_filename'] == 'this.WXS__aligned_reads__bam__drs_url'
+    assert bam_config['outputs']['gdc_bam_downloader_workflow.gdc_bam_downloader.bai_file'] == 'this.WXS__aligned_reads__bam__bai_url'
+    maf_config = configs[(ws_builder.CONFIG_NAMESPACE, 'gdc_file_downloader__WXS__masked_somatic_mutation__maf__cfg')]
+    assert maf_config['rootEntityType'] == 'pair'
+    assert 'gdc_file_downloader_workflow.gdc_file_downloader.gdc_user_token' not in maf_config['inputs']
+
+    # a second run updates the configs left by the first, without fetching the templates again
+    ws_builder.create_method_configs(NAMESPACE, WORKSPACE, ATTRIBUTES, 'TCGA-dbGaP-Authorized', fapi=stub)
+    assert stub.request_counts['get_repository_config'] == 2
+    assert stub.request_counts['update_workspace_config'] == len(ATTRIBUTES)
+    maf_config = _method_configs(stub)[(ws_builder.CONFIG_NAMESPACE, 'gdc_file_downloader__WXS__masked_somatic_mutation__maf__cfg')]
+    assert 'gdc_file_downloader_workflow.gdc_file_downloader.gdc_user_token' in maf_config['inputs']
+
+def test_create_method_configs_retries_injected_errors():
+    stub = _stub(error_rate=0.3)
+    ws_builder.create_method_configs(NAMESPACE, WORKSPACE, ATTRIBUTES, '', jobs=4, retries=10, fapi=stub)
+
+    assert len(_method_configs(stub)) == len(ATTRIBUTES)
+    assert stub.request_counts['create_workspace_config'] > len(ATTRIBUTES)
+    assert stub.max_in_flight <= 4
+
+def test_create_method_configs_reports_configs_that_could_not_be_pushed():
+    stub = _stub()
+    for namespace, name, snapshot_id in stub.templates:
+        ws_builder.get_config_template(namespace, name, snapshot_id, fapi=stub)
+    stub.error_rate = 1.0
+
+    with pytest.raises(RuntimeError, match='could not upload method configs'):
+        ws_builder.create_method_configs(NAMESPACE, WORKSPACE, ATTRIBUTES, '', retries=2, fapi=stub)
+    assert stub.request_counts['create_workspace_config'] == 3 * len(ATTRIBUTES)
+    assert len(_method_configs(stub)) == 0
+
+def test_missing_template_fails():
+    stub = _stub(templates={})
+    with pytest.raises(RuntimeError, match='could not get method config'):
+        ws_builder.create_method_configs(NAMESPACE, WORKSPACE, ATTRIBUTES, '', fapi=stub)
+
+def _model(num_cases=5, large_sample=None):
+    # a model with a tumor and a normal sample and a pair per case; the attribute of sample large_sample, if given, is 10 kB
+    participants, samples, pairs = EntityTable('participant'), EntityTable('sample'), EntityTable('pair')
+    for i in range(num_cases):
+        case_id = 'case-{0}'.format(i)
+        participants[case_id] = {'submitter_id' : 'TCGA-AA-{0:04d}'.format(i), 'project_id' : 'TCGA-BRCA'}
+        for sample_type_id, code in [('01', 'TP'), ('10', 'NB')]:
+            sample_id = '{0}-{1}'.format(case_id, code)
+            samples[sample_id] = {'case_id' : case_id, 'submitter_id' : 'TCGA-AA-{0:04d}-{1}'.format(i, sample_type_id),
+                                  'sample_type_id' : sample_type_id, 'sample_type' : None, 'tissue_type' : None}
+            value = 'x' * 10000 if sample_id == large_sample else 'drs://dg.4DFC/{0}'.format(sample_id)
+            samples.set_attribute(sample_id, 'WXS__aligned_reads__bam__drs_url', value)
+        pairs['{0}-TP-NB'.format(case_id)] = {'tumor' : case_id + '-TP', 'normal' : case_id + '-NB'}
+    return WorkspaceModel(participants, samples, pairs, dict())
+
+def _entities(stub, entity_type):
+    return stub.workspaces[(NAMESPACE, WORKSPACE)]['entities'].get(entity_type, {})
+
+def test_upload_entities_splits_load_files_into_chunks_of_rows():
+    stub = _stub()
+    ws_builder.upload_entities(NAMESPACE, WORKSPACE, _model(), jobs=3, chunk_rows=2, fapi=stub)
+
+    assert len(_entities(stub, 'participant')) == 5
+    assert len(_entities(stub, 'sample')) == 10
+    assert len(_entities(stub, 'pair')) == 5
+    for set_type, num_members in [('participant_set', 5), ('sample_set', 10), ('pair_set', 5)]:
+        assert len(_entities(stub, set_type)['ALL']) == num_members
+    # participants in 3 chunks, samples in 5, pairs in 3, and the memberships in as many again
+    assert stub.request_counts['upload_entities'] == 2 * (3 + 5 + 3)
+    assert stub.max_in_flight <= 3
+
+def test_upload_entities_splits_chunks_by_size():
+    model = _model(num_cases=40)
+    stub = _stub(max_upload_size=1000)
+    with pytest.raises(RuntimeError):
+        # whole load files are too large to upload in one request
+        ws_builder.upload_entities(NAMESPACE, WORKSPACE, model, fapi=stub)
+
+    stub = _stub(max_upload_size=1000)
+    ws_builder.upload_entities(NAMESPACE, WORKSPACE, model, chunk_size=1000, fapi=stub)
+    assert len(_entities(stub, 'sample')) == 80
+    assert len(_entities(stub, 'pair')) == 40
+    assert len(_entities(stub, 'sample_set')['ALL']) == 80
+    assert stub.request_counts['upload_entities'] > 6
+
+def test_upload_entities_retries_failed_chunks_on_their_own():
+    stub = _stub(error_rate=0.3)
+    ws_builder.upload_entities(NAMESPACE, WORKSPACE, _model(), chunk_rows=2, retries=10, fapi=stub)
+
+    assert len(_entities(stub, 'sample')) == 10
+    assert len(_entities(stub, 'pair')) == 5
+    assert stub.request_counts['upload_entities'] > 2 * (3 + 5 + 3)
+
+def test_upload_entities_skips_dependents_of_failed_chunk():
+    stub = _stub(max_upload_size=2000)
+    with pytest.raises(RuntimeError, match='could not upload samples chunk 2'):
+        ws_builder.upload_entities(NAMESPACE, WORKSPACE, _model(large_sample='case-1-TP'), chunk_rows=2, fapi=stub)
+
+    # the other samples chunks were uploaded, but no pairs or sets, which could reference the missing samples
+    assert len(_entities(stub, 'participant')) == 5
+    assert sorted(_entities(stub, 'sample')) == ['case-0-NB', 'case-0-TP', 'case-2-NB', 'case-2-TP', 'case-3-NB',
+                                                 'case-3-TP', 'case-4-NB', 'case-4-TP']
+    assert len(_entities(stub, 'pair')) == 0
+    assert len(_entities(stub, 'sample_set')) == 0